@@ -13,6 +13,7 @@ from pybasicbayes.util.text import progprint_xrange
 from pyglm.utils.basis import cosine_basis
 from pyglm.plotting import plot_glm
 from pyglm.models import SparseBernoulliGLM
+from pyglm.monitoring import LiveMonitor
 
 T = 10000   # Number of time bins to generate
 N = 4       # Number of neurons
@@ -43,9 +44,9 @@ test_model = \
 
 test_model.add_data(Y)
 
-# Plot the test model
-fig, axs, handles = test_model.plot(title="Sample 0")
-plt.pause(0.1)
+# Plot the test model in a separate process, at most a few times a second
+monitor = LiveMonitor(fps=5, pltslice=slice(0, 500))
+monitor.update(test_model, title="Sample 0")
 
 # Fit with Gibbs sampling
 def _collect(m):
@@ -53,15 +54,14 @@ def _collect(m):
 
 def _update(m, itr):
     m.resample_model()
-    test_model.plot(handles=handles,
-                    pltslice=slice(0, 500),
-                    title="Sample {}".format(itr+1))
+    monitor.update(m, title="Sample {}".format(itr+1))
     return _collect(m)
 
 N_samples = 100
 samples = []
 for itr in progprint_xrange(N_samples):
     samples.append(_update(test_model, itr))
+monitor.close(timeout=0)
 
 # Unpack the samples
 samples = zip(*samples)
@@ -0,0 +1,299 @@
+"""
+Fit many small network GLMs at once.
+
+For small networks (N of 4 to 20 neurons), a Gibbs sweep is dominated by
+interpreter overhead: every regression makes its own tiny matrix products,
+Polya-gamma draws and Cholesky factorizations. BatchedGLMs stacks M
+independent models with the same N and basis, so each step of the sweep
+runs once over all M*N regressions:
+
+- the activations are one batched contraction;
+- the Polya-gamma variables are one stacked draw;
+- the likelihood potentials are batched matrix products;
+- the collapsed updates of the adjacency flip one entry of every
+  regression at a time. The Gaussian marginal likelihoods of the
+  variable active sets are evaluated with one batched Cholesky, by
+  replacing the rows and columns of inactive weights with the identity;
+- the weights are drawn with the same masked factorization.
+
+The models may have recordings of different lengths. Shorter recordings
+are padded, and the padded bins get zero precision, so they do not
+contribute. The models' own parameter arrays are updated in place, and
+their networks are resampled one model at a time.
+"""
+import numpy as np
+import numpy.random as npr
+
+from pyglm.regression import _SparsePGRegressionBase
+from pyglm.utils.utils import logistic
+
+
+class BatchedGLMs(object):
+    """
+    Gibbs sampling for a list of independent network GLMs with
+    Polya-gamma regressions, e.g. SparseBernoulliGLMs.
+    """
+    def __init__(self, models):
+        """
+        :param models:  List of models with the same N and basis, whose
+                        data has already been added.
+        """
+        assert len(models) > 0
+        self.models = models
+        M = self.M = len(models)
+        N, B = self.N, self.B = models[0].N, models[0].B
+
+        # The batch draws the auxiliary variables and the adjacency of
+        # every regression the same way, so their settings must agree
+        reg0 = models[0].regressions[0]
+        assert isinstance(reg0, _SparsePGRegressionBase), \
+            "Only Polya-gamma regressions can be batched"
+        for model in models:
+            assert model.N == N and model.B == B
+            assert not model.sparse, "Only models with dense parameters can be batched"
+            assert len(model.data_list) > 0
+            for data in model.data_list:
+                assert isinstance(data, tuple), \
+                    "Only datasets held in memory as (X, Y) can be batched"
+            for reg in model.regressions:
+                assert type(reg) is type(reg0)
+                assert reg.W_sampler == "cholesky"
+                assert reg.collapsed, "The batch resamples the adjacency collapsed"
+                assert getattr(reg, "case_control", None) is None, \
+                    "Case-control subsampling cannot be batched"
+                assert reg.pg_method == reg0.pg_method and reg.pg_tol == reg0.pg_tol
+                assert reg.inv_temperature == reg0.inv_temperature
+
+        # Stack each model's datasets in time, and pad to the longest.
+        # The last column of the inputs is the constant for the bias.
+        datas = []
+        for model in models:
+            X = np.concatenate([np.reshape(X, (-1, N*B)) for X, Y in model.data_list])
+            Y = np.concatenate([Y for X, Y in model.data_list])
+            datas.append((X, Y))
+        T = max(Y.shape[0] for X, Y in datas)
+
+        D = self.D = N*B + 1
+        self.X = np.zeros((M, T, D))
+        self.Y = np.zeros((M, T, N))
+        self.mask = np.zeros((M, T), dtype=bool)
+        for m, (X, Y) in enumerate(datas):
+            Tm = Y.shape[0]
+            self.X[m, :Tm, :-1] = X
+            self.X[m, :Tm, -1] = 1
+            self.Y[m, :Tm] = Y
+            self.mask[m, :Tm] = True
+
+        # The Polya-gamma draws and the likelihood are shared by the batch
+        self._reg = reg0
+
+    # Stacked views of the models' parameters, shaped M x N x ...
+    def _gather(self):
+        A = np.array([model._adjacency for model in self.models])
+        W = np.array([model._weights for model in self.models])
+        b = np.array([model._biases for model in self.models])
+        return A, W, b
+
+    def _scatter(self, A, W, b):
+        for m, model in enumerate(self.models):
+            model._adjacency[...] = A[m]
+            model._weights[...] = W[m]
+            model._biases[...] = b[m]
+
+    def activations(self, A=None, W=None, b=None):
+        """
+        :return:  M x T x N activations of every neuron in every model
+        """
+        if A is None:
+            A, W, b = self._gather()
+        M, N, B = self.M, self.N, self.B
+        Weff = np.concatenate(((A[..., None] * W).reshape((M, N, N*B)), b[..., None]), axis=2)
+        return np.matmul(self.X, Weff.transpose((0, 2, 1)))
+
+    def log_likelihoods(self):
+        """
+        :return:  length M array of the log likelihood of each model's data
+        """
+        reg, Y = self._reg, self.Y
+        psi = self.activations()
+        ll = np.log(reg.c_func(Y)) + reg.a_func(Y) * psi - reg.b_func(Y) * np.log1p(np.exp(psi))
+        return np.sum(ll * self.mask[:, :, None], axis=(1, 2))
+
+    def means(self):
+        """
+        :return:  M x T x N expected spike counts (padded bins are zero)
+        """
+        return logistic(self.activations()) * self.mask[:, :, None]
+
+    def _prior(self):
+        """
+        Stack the information-form priors of all regressions:
+        J_w (M, N, N, B, B), h_w (M, N, N, B), J_b (M, N) and h_b (M, N).
+        """
+        M, N, B = self.M, self.N, self.B
+        J_w = np.zeros((M, N, N, B, B))
+        h_w = np.zeros((M, N, N, B))
+        J_b = np.zeros((M, N))
+        h_b = np.zeros((M, N))
+        for m, model in enumerate(self.models):
+            for n, reg in enumerate(model.regressions):
+                J_w[m, n], h_w[m, n], Jb, hb = reg.natural_params
+                J_b[m, n], h_b[m, n] = Jb[0, 0], hb[0]
+        return J_w, h_w, J_b, h_b
+
+    def resample_model(self):
+        self.resample_regressions()
+        for model in self.models:
+            if hasattr(model, "resample_network"):
+                model.resample_network()
+
+    def resample_regressions(self):
+        M, N, B, D = self.M, self.N, self.B, self.D
+        reg = self._reg
+        A, W, b = self._gather()
+
+        # Draw the Polya-gamma auxiliary variables of all bins at once
+        psi = self.activations(A, W, b)
+        shape = reg.inv_temperature * np.broadcast_to(reg.b_func(self.Y), self.Y.shape)
+        omega = reg.draw_pg(shape.ravel(), psi.ravel()).reshape(psi.shape)
+        omega *= self.mask[:, :, None]
+        kappa = reg.inv_temperature * (reg.a_func(self.Y) - reg.b_func(self.Y) / 2.0)
+        kappa *= self.mask[:, :, None]
+
+        # The posterior potentials of the M*N regressions, as one batch
+        J_post, h_post, c_w, c_b = self._posterior_potentials(omega, kappa)
+        R = M * N
+        a = A.reshape((R, N)).copy()
+        rho = np.array([model._rho for model in self.models]).reshape((R, N))
+
+        def marginal_likelihood(a):
+            return self._marginal_likelihoods(J_post, h_post, c_w, c_b, a)
+
+        # Collapsed Gibbs updates of the indicators, one entry of
+        # every regression at a time, in a random order per regression
+        with np.errstate(divide="ignore"):
+            log_rho, log_1m_rho = np.log(rho), np.log1p(-rho)
+
+        perms = np.argsort(npr.rand(R, N), axis=1)
+        rows = np.arange(R)
+        ml = marginal_likelihood(a)
+        for j in range(N):
+            idx = perms[:, j]
+            a_new = a.copy()
+            a_new[rows, idx] = ~a[rows, idx]
+            ml_new = marginal_likelihood(a_new)
+
+            # Log prior of the proposed and current values of the entry
+            lp_on, lp_off = log_rho[rows, idx], log_1m_rho[rows, idx]
+            lp_new = ml_new + np.where(a_new[rows, idx], lp_on, lp_off)
+            lp_cur = ml + np.where(a[rows, idx], lp_on, lp_off)
+
+            with np.errstate(over="ignore", invalid="ignore"):
+                p_flip = logistic(lp_new - lp_cur)
+            flip = npr.rand(R) < np.nan_to_num(p_flip)
+            a[flip] = a_new[flip]
+            ml[flip] = ml_new[flip]
+
+        # Sample the weights given the indicators
+        mask = self._mask(a)
+        _, L, v = _masked_gaussian_log_normalizer(J_post, h_post, mask, return_factors=True)
+        z = v + npr.randn(R, D)
+        w = _batched_triangular_solve(L, z, trans=True) * mask
+
+        self._scatter(a.reshape((M, N, N)),
+                      w[:, :-1].reshape((M, N, N, B)),
+                      w[:, -1].reshape((M, N)))
+
+
+    def _posterior_potentials(self, omega, kappa):
+        """
+        The posterior potentials of every regression given the
+        Polya-gamma variables omega and the normalized observations
+        kappa (M x T x N, zero in the padded bins), flattened into a
+        batch of R = M*N regressions: J_post (R, D, D), h_post (R, D),
+        and the prior log normalizers of the weight groups c_w (R, N)
+        and of the biases c_b (R,).
+        """
+        M, N, B, D = self.M, self.N, self.B, self.D
+
+        # Likelihood potentials of each regression: (M, N, D, D) and (M, N, D)
+        # One neuron at a time, so the weighted inputs are only M x T x D
+        J_post = np.empty((M, N, D, D))
+        Xt = self.X.transpose((0, 2, 1))
+        for n in range(N):
+            J_post[:, n] = np.matmul(Xt, self.X * omega[:, :, n, None])
+        h_post = np.matmul(kappa.transpose((0, 2, 1)), self.X)
+
+        # Add the block diagonal prior
+        J_w, h_w, J_b, h_b = self._prior()
+        for j in range(N):
+            J_post[:, :, j*B:(j+1)*B, j*B:(j+1)*B] += J_w[:, :, j]
+        J_post[:, :, -1, -1] += J_b
+        h_post[:, :, :-1] += h_w.reshape((M, N, N*B))
+        h_post[:, :, -1] += h_b
+
+        # Prior log normalizers of each group, which the marginal
+        # likelihood subtracts for the active groups
+        L_w = np.linalg.cholesky(J_w)
+        v_w = np.linalg.solve(L_w, h_w[..., None])[..., 0]
+        c_w = 0.5 * np.sum(v_w**2, axis=-1) - np.sum(np.log(np.diagonal(L_w, axis1=-2, axis2=-1)), axis=-1)
+        c_b = 0.5 * h_b**2 / J_b - 0.5 * np.log(J_b)
+
+        R = M * N
+        return J_post.reshape((R, D, D)), h_post.reshape((R, D)), \
+               c_w.reshape((R, N)), c_b.reshape((R,))
+
+    def _mask(self, a):
+        """
+        The inputs of the active groups, and the bias, of each regression.
+        """
+        return np.concatenate((np.repeat(a, self.B, axis=1),
+                               np.ones((a.shape[0], 1), dtype=bool)), axis=1)
+
+    def _marginal_likelihoods(self, J_post, h_post, c_w, c_b, a):
+        """
+        The log marginal likelihood of each regression's active set,
+        given its row of the R x N indicators a.
+        """
+        ml = _masked_gaussian_log_normalizer(J_post, h_post, self._mask(a))
+        return ml - np.sum(c_w * a, axis=1) - c_b
+
+def _masked_gaussian_log_normalizer(J, h, mask, return_factors=False):
+    """
+    The log normalizer 0.5 h^T J^{-1} h - 0.5 log |J| of a batch of
+    information-form Gaussians restricted to the entries in 'mask'.
+    The other rows and columns are replaced with the identity, which
+    contributes nothing, so the whole batch has the same shape.
+
+    :return:  The log normalizers, and if return_factors, the Cholesky
+              factors L and v = L^{-1} h of the masked potentials.
+    """
+    R, D = h.shape
+    mm = mask[:, :, None] & mask[:, None, :]
+    Jm = np.where(mm, J, 0)
+    diag = np.arange(D)
+    Jm[:, diag, diag] += ~mask
+    hm = h * mask
+
+    L = np.linalg.cholesky(Jm)
+    v = _batched_triangular_solve(L, hm)
+    ml = 0.5 * np.sum(v**2, axis=1) - np.sum(np.log(L[:, diag, diag]), axis=1)
+    if return_factors:
+        return ml, L, v
+    return ml
+
+
+def _batched_triangular_solve(L, b, trans=False):
+    """
+    Solve L x = b (or L^T x = b) for a batch of lower triangular L by
+    substitution, vectorized over the batch.
+    """
+    R, D = b.shape
+    x = np.zeros((R, D))
+    if not trans:
+        for i in range(D):
+            x[:, i] = (b[:, i] - np.einsum('rj,rj->r', L[:, i, :i], x[:, :i])) / L[:, i, i]
+    else:
+        for i in reversed(range(D)):
+            x[:, i] = (b[:, i] - np.einsum('rj,rj->r', L[:, i+1:, i], x[:, i+1:])) / L[:, i, i]
+    return x
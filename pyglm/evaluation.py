@@ -0,0 +1,181 @@
+"""
+Posterior predictive evaluation over stored samples.
+
+Rather than loading each posterior sample back into a model and looping
+over its regressions, PosteriorPredictive keeps the samples stacked and
+computes the activations of every sample and neuron with one tensor
+contraction per chunk of time bins. This gives the held-out log
+likelihood of each sample, the log posterior predictive density
+
+    log p(Y | data) ~= log (1/S) sum_s p(Y | theta_s),
+
+and predictive simulations that draw each batch element from its own
+parameter sample.
+"""
+import numpy as np
+import numpy.random as npr
+from scipy.special import logsumexp
+
+from pyglm.regression import SparseBernoulliRegression, SparseGaussianRegression
+from pyglm.utils.basis import convolve_with_basis, recursive_form
+from pyglm.utils.utils import logistic
+
+
+class PosteriorPredictive(object):
+    """
+    Stacked posterior samples of a NonlinearAutoregressiveModel.
+    """
+    families = ("bernoulli", "gaussian")
+
+    def __init__(self, basis, weights, adjacency, biases, eta=None, family="bernoulli"):
+        """
+        :param basis:      LxB basis
+        :param weights:    SxNxNxB weight samples (post x pre x basis)
+        :param adjacency:  SxNxN adjacency samples
+        :param biases:     SxN bias samples
+        :param eta:        SxN noise variance samples, for Gaussian models
+        :param family:     "bernoulli" or "gaussian"
+        """
+        assert family in self.families
+        S, N, _, B = weights.shape
+        assert basis.shape[1] == B
+        assert adjacency.shape == (S, N, N) and biases.shape == (S, N)
+        assert (eta is not None) == (family == "gaussian")
+        self.S, self.N, self.B = S, N, B
+        self.basis = basis
+        self.family = family
+
+        self.W = np.reshape(adjacency[..., None] * weights, (S, N, N*B))
+        self.b = np.asarray(biases, dtype=float)
+        self.eta = None if eta is None else np.asarray(eta, dtype=float)
+
+    @classmethod
+    def from_samples(cls, model, samples):
+        """
+        :param model:    Model whose regressions determine the family
+        :param samples:  dict of stacked samples with keys weights,
+                         adjacency, biases and (for Gaussian models) eta
+        """
+        reg = model.regressions[0]
+        if isinstance(reg, SparseBernoulliRegression):
+            family = "bernoulli"
+        elif isinstance(reg, SparseGaussianRegression):
+            family = "gaussian"
+        else:
+            raise Exception("Unsupported regression class: {}".format(type(reg)))
+
+        return cls(model.basis, samples["weights"], samples["adjacency"],
+                   samples["biases"], eta=samples.get("eta"), family=family)
+
+    def activations(self, X):
+        """
+        :param X:  TxNxB regressors
+        :return:   SxTxN activations under every sample
+        """
+        X = np.reshape(X, (-1, self.N * self.B))
+        return np.matmul(X, self.W.transpose((0, 2, 1))) + self.b[:, None, :]
+
+    def _log_likelihood(self, Psi, Y):
+        if self.family == "bernoulli":
+            return Y * Psi - np.logaddexp(0, Psi)
+        eta = self.eta[:, None, :]
+        return -0.5 * np.log(2 * np.pi * eta) - 0.5 * (Y - Psi)**2 / eta
+
+    def log_likelihoods(self, Y, X=None, chunk_size=1000):
+        """
+        Log likelihood of the data under each sample, per neuron.
+
+        :param Y:  TxN counts
+        :param X:  TxNxB regressors. If not given, each chunk of Y is
+                   convolved with the basis along with the L bins that
+                   precede it, so only chunk_size x N x B regressors
+                   are held at a time.
+        :return:   SxN log likelihoods
+        """
+        L = self.basis.shape[0]
+        ll = np.zeros((self.S, self.N))
+        for start in range(0, Y.shape[0], chunk_size):
+            stop = min(start + chunk_size, Y.shape[0])
+            Yc = np.asarray(Y[start:stop])
+            if X is None:
+                pad = min(start, L)
+                Xc = convolve_with_basis(np.asarray(Y[start-pad:stop], dtype=float),
+                                         self.basis)[pad:]
+            else:
+                Xc = X[start:stop]
+            ll += self._log_likelihood(self.activations(Xc), Yc).sum(axis=1)
+        return ll
+
+    def log_predictive_density(self, Y, X=None, per_neuron=False, chunk_size=1000):
+        """
+        Log posterior predictive density, log (1/S) sum_s p(Y | theta_s).
+
+        :param per_neuron:  Return the density of each neuron's spike train
+                            separately rather than of the population.
+        """
+        ll = self.log_likelihoods(Y, X=X, chunk_size=chunk_size)
+        if not per_neuron:
+            ll = ll.sum(axis=1)
+        return logsumexp(ll, axis=0) - np.log(self.S)
+
+    def means(self, X, chunk_size=1000):
+        """
+        :return:  SxTxN expected observations under every sample
+        """
+        out = np.zeros((self.S, X.shape[0], self.N))
+        for start in range(0, X.shape[0], chunk_size):
+            Psi = self.activations(X[start:start+chunk_size])
+            out[:, start:start+chunk_size] = logistic(Psi) if self.family == "bernoulli" else Psi
+        return out
+
+    def simulate(self, T, samples=None, history=None):
+        """
+        Simulate from the model like NonlinearAutoregressiveModel.generate,
+        with each batch element driven by its own parameter sample.
+
+        :param T:        Number of time bins to simulate
+        :param samples:  Indices of the sample behind each batch element.
+                         Defaults to one batch element per sample.
+        :param history:  Optional LxN (or batch x L x N) spike history
+                         preceding the simulation. A shorter history is
+                         preceded by zeros, as is no history at all.
+        :return:         batch x T x N simulated observations
+        """
+        samples = np.arange(self.S) if samples is None else np.asarray(samples)
+        M, N, B = samples.size, self.N, self.B
+        L = self.basis.shape[0]
+        W, b = self.W[samples], self.b[samples]
+        eta = None if self.eta is None else self.eta[samples]
+
+        # Flip the basis so the history is ordered from oldest to newest,
+        # as in NonlinearAutoregressiveModel.generate
+        basis = np.flipud(self.basis)
+
+        Y = np.zeros((M, T+L, N))
+        if history is not None:
+            history = np.asarray(history)
+            H = min(history.shape[-2], L)
+            if H > 0:
+                Y[:, L-H:L] = history[..., -H:, :]
+
+        # Recursive bases update the regressors of all batch
+        # elements in O(MNB) per bin, given the history so far
+        stepper = None
+        if recursive_form(self.basis) is not None:
+            stepper = self.basis.stepper(M * N)
+            for t in range(L-1):
+                stepper.push(Y[:, t].ravel())
+
+        for t in range(L, T+L):
+            if stepper is not None:
+                X = stepper.push(Y[:, t-1].ravel()).reshape((B, M, N)).transpose((1, 2, 0))
+            else:
+                X = np.einsum('mln,lb->mnb', Y[:, t-L:t], basis)
+            X = X.reshape((M, N*B, 1))
+            psi = np.matmul(W, X)[:, :, 0] + b
+            if self.family == "bernoulli":
+                Y[:, t] = npr.rand(M, N) < logistic(psi)
+            else:
+                Y[:, t] = psi + np.sqrt(eta) * npr.randn(M, N)
+
+        return Y[:, L:]
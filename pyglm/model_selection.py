@@ -0,0 +1,236 @@
+"""
+Choose the basis and the hyperparameters of a GLM by held-out likelihood.
+
+ModelSelection fits one model per (basis, configuration, fold) in a
+pool of worker processes and scores it by the log posterior predictive
+density of the held-out time bins. The expensive preprocessing is shared:
+
+- each basis is convolved with each dataset once, through a
+  ConvolutionCache on disk, and the workers memory-map the results
+  rather than receiving copies. The bases are convolved one at a time,
+  just before their fits, and their entries are pinned in the cache
+  until the fits are done;
+- for Gaussian regressions, the Gram statistics of the full recording
+  are computed once per basis (from the spike-train cross-correlations
+  when that is cheaper), and each fold subtracts the statistics of its
+  held-out blocks;
+- the held-out likelihood of all posterior samples is evaluated by a
+  PosteriorPredictive, with one batched contraction per chunk of bins.
+
+Folds split each recording into contiguous blocks of time. The
+regressors of a held-out block are computed from the full recording,
+so the block sees its true spike history.
+"""
+import time
+import tempfile
+import itertools
+import multiprocessing as mp
+import numpy as np
+import numpy.random as npr
+
+from pyglm.evaluation import PosteriorPredictive
+from pyglm.regression import SparseGaussianRegression
+from pyglm.utils.basis import basis_gram_statistics, gram_statistics, correlations_are_cheaper
+from pyglm.utils.cache import ConvolutionCache
+
+
+def expand_grid(grid):
+    """
+    Expand a dict of lists of values into a list of configurations.
+    Keys of the form "regression_kwargs__S_w" set nested arguments.
+
+    >>> expand_grid({"regression_kwargs__S_w": [0.1, 1.0]})
+    [{'regression_kwargs': {'S_w': 0.1}}, {'regression_kwargs': {'S_w': 1.0}}]
+    """
+    keys = sorted(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        config = {}
+        for key, value in zip(keys, values):
+            path = key.split("__")
+            d = config
+            for p in path[:-1]:
+                d = d.setdefault(p, {})
+            d[path[-1]] = value
+        configs.append(config)
+    return configs
+
+
+def _fit(job):
+    npr.seed(job["seed"])
+    Xs = [np.load(path, mmap_mode='r') for path in job["X_paths"]]
+    Ys = job["Ys"]
+    N = Ys[0].shape[1]
+
+    model = job["model_class"](N, basis=job["basis"], **job["config"])
+    for d, slc in job["train"]:
+        model.add_data(np.asarray(Ys[d][slc]), X=Xs[d][slc])
+
+    # Reuse the statistics of the full recordings, minus the held-out blocks
+    if job["stats"] is not None and model.regressions[0].uses_gram_statistics:
+        stats = dict((k, np.copy(v)) for k, v in job["stats"].items())
+        for d, slc in job["test"]:
+            for k, v in gram_statistics(Xs[d][slc], Ys[d][slc]).items():
+                stats[k] = stats[k] - v
+        model.set_gram_statistics(stats)
+
+    tic = time.time()
+    samples = dict(weights=[], adjacency=[], biases=[], eta=[])
+    for itr in range(job["N_samples"]):
+        model.resample_model()
+        if itr >= job["burnin"]:
+            samples["weights"].append(model.weights)
+            samples["adjacency"].append(model.adjacency)
+            samples["biases"].append(model.biases)
+            if isinstance(model.regressions[0], SparseGaussianRegression):
+                samples["eta"].append([reg.eta for reg in model.regressions])
+    fit_time = time.time() - tic
+
+    samples = dict((k, np.array(v)) for k, v in samples.items() if len(v) > 0)
+    predictive = PosteriorPredictive.from_samples(model, samples)
+    ll = sum(predictive.log_predictive_density(Ys[d][slc], X=Xs[d][slc])
+             for d, slc in job["test"])
+    T_test = sum(slc.stop - slc.start for _, slc in job["test"])
+
+    return dict(basis_index=job["basis_index"], config_index=job["config_index"],
+                fold=job["fold"], heldout_ll=ll, T_test=T_test, fit_time=fit_time)
+
+
+class ModelSelection(object):
+    """
+    Grid search over bases and model configurations, scored by
+    cross-validated held-out log likelihood.
+    """
+    def __init__(self, model_class, datas, bases, configs,
+                 n_folds=5,
+                 N_samples=100,
+                 burnin=50,
+                 processes=None,
+                 cache=None):
+        """
+        :param model_class:  Model class, e.g. SparseBernoulliGLM, called as
+                             model_class(N, basis=basis, **config)
+        :param datas:        List of TxN spike count arrays
+        :param bases:        List of LxB bases to compare
+        :param configs:      List of dicts of model arguments to compare,
+                             e.g. from expand_grid
+        :param n_folds:      Number of contiguous blocks per recording.
+                             With n_folds=1 the last fifth is held out.
+        :param N_samples:    Gibbs iterations per fit
+        :param burnin:       Iterations discarded before collecting samples
+        :param processes:    Number of worker processes. 1 fits in this process.
+        :param cache:        ConvolutionCache, or a directory for one. A
+                             temporary directory is used by default.
+        """
+        self.model_class = model_class
+        self.datas = [np.asarray(Y) for Y in datas]
+        self.bases = bases
+        self.configs = configs
+        self.n_folds = n_folds
+        self.N_samples = N_samples
+        self.burnin = burnin
+        self.processes = processes
+
+        if cache is None:
+            cache = tempfile.mkdtemp(prefix="pyglm_cache_")
+        self.cache = cache if isinstance(cache, ConvolutionCache) else ConvolutionCache(cache)
+        self.results = []
+
+    def folds(self):
+        """
+        Yield (train, test) lists of (dataset index, slice) pairs.
+        """
+        if self.n_folds == 1:
+            train, test = [], []
+            for d, Y in enumerate(self.datas):
+                split = int(0.8 * Y.shape[0])
+                train.append((d, slice(0, split)))
+                test.append((d, slice(split, Y.shape[0])))
+            yield train, test
+            return
+
+        for k in range(self.n_folds):
+            train, test = [], []
+            for d, Y in enumerate(self.datas):
+                edges = np.linspace(0, Y.shape[0], self.n_folds + 1).astype(int)
+                for j in range(self.n_folds):
+                    (test if j == k else train).append((d, slice(edges[j], edges[j+1])))
+            yield train, test
+
+    def _uses_gram_statistics(self):
+        reg_class = getattr(self.model_class, "_regression_class", None)
+        return reg_class is not None and issubclass(reg_class, SparseGaussianRegression)
+
+    def jobs(self):
+        """
+        Yield the list of jobs of each basis in turn. A basis is only
+        convolved when its jobs are requested, and its cache entries
+        are pinned while later bases are convolved, so run the jobs of
+        one basis before asking for the next.
+        """
+        seeds = iter(npr.randint(2**31, size=len(self.bases) * len(self.configs) * max(self.n_folds, 1)))
+        folds = list(self.folds())
+        for i, basis in enumerate(self.bases):
+            # One convolution per basis and dataset, shared through the cache
+            X_paths = []
+            for Y in self.datas:
+                X_paths.append(self.cache.convolve(Y, basis, keep=X_paths).filename)
+
+            stats = None
+            if self._uses_gram_statistics():
+                for Y, path in zip(self.datas, X_paths):
+                    s = basis_gram_statistics(Y, basis) if correlations_are_cheaper(Y, basis) \
+                        else gram_statistics(np.load(path, mmap_mode='r'), Y)
+                    stats = s if stats is None else dict((k, stats[k] + v) for k, v in s.items())
+
+            yield [dict(model_class=self.model_class, config=config,
+                        basis=basis, basis_index=i, config_index=j, fold=k,
+                        X_paths=X_paths, Ys=self.datas, stats=stats,
+                        train=train, test=test,
+                        N_samples=self.N_samples, burnin=self.burnin,
+                        seed=next(seeds))
+                   for j, config in enumerate(self.configs)
+                   for k, (train, test) in enumerate(folds)]
+
+    def run(self, verbose=False):
+        """
+        Fit every (basis, configuration, fold) and record the held-out
+        log likelihoods in self.results.
+        """
+        pool = mp.Pool(self.processes) if self.processes != 1 else None
+        try:
+            # Finish the fits of each basis before convolving the next,
+            # which may evict its regressors from the cache
+            for jobs in self.jobs():
+                results = map(_fit, jobs) if pool is None else pool.imap_unordered(_fit, jobs)
+                for result in results:
+                    self.results.append(result)
+                    if verbose:
+                        print("Basis {basis_index}, config {config_index}, fold {fold}: "
+                              "held-out LL {heldout_ll:.1f} ({fit_time:.1f}s)".format(**result))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return self.summary()
+
+    def summary(self):
+        """
+        Held-out log likelihood per time bin of each (basis, configuration),
+        pooled over folds, as a (number of bases) x (number of configs) array.
+        """
+        ll = np.zeros((len(self.bases), len(self.configs)))
+        T = np.zeros_like(ll)
+        for r in self.results:
+            ll[r["basis_index"], r["config_index"]] += r["heldout_ll"]
+            T[r["basis_index"], r["config_index"]] += r["T_test"]
+        with np.errstate(invalid="ignore"):
+            return ll / T
+
+    def best(self):
+        """
+        The basis and configuration with the highest held-out likelihood.
+        """
+        i, j = np.unravel_index(np.nanargmax(self.summary()), (len(self.bases), len(self.configs)))
+        return self.bases[i], self.configs[j]
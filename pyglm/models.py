@@ -1,9 +1,16 @@
+from contextlib import contextmanager
+
 import numpy as np
+import scipy.sparse as sp
 from pybasicbayes.abstractions import ModelGibbsSampling
 
 import pyglm.networks
 import pyglm.regression
-from pyglm.utils.basis import convolve_with_basis
+from pyglm.utils.basis import convolve_with_basis, basis_gram_statistics, gram_statistics, \
+    neuron_statistics, correlations_are_cheaper, recursive_form
+from pyglm.utils.data import ChunkedDataset
+from pyglm.utils.utils import sparse_connectivity
+from pyglm.sharded import ShardedDataset
 
 class NonlinearAutoregressiveModel(ModelGibbsSampling):
     """
@@ -25,19 +32,23 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
     computational neuroscience.
     """
 
-    def __init__(self, N, regressions, basis=None, B=10):
+    def __init__(self, N, regressions, basis=None, B=10, sparse=False):
         """
         :param N:             Observation dimension
         :param regressions:   Regression objects, one per observation dim.
+                              With sparse=True, any iterable, so that each
+                              regression can be compressed before the next
+                              is built.
         :param basis:         Basis onto which the preceding activity is projected
                               In the "identity" case, this is just a lag matrix
         :param B:             Basis dimensionality.
                               In the "identity" case, this is the number of lags.
+        :param sparse:        Keep the adjacency matrix in CSR form and only the
+                              weights of its entries, rather than NxN and NxNxB
+                              arrays. Meant for large networks with few connections.
         """
         self.N = N
-
-        assert len(regressions) == N
-        self.regressions = regressions
+        self.sparse = sparse
 
         # Initialize the basis
         if basis is None:
@@ -47,31 +58,201 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
         self.basis = basis
         self.B = self.basis.shape[1]
 
+        # Keep the parameters of all regressions in contiguous arrays.
+        # Each regression's a, W, b and rho are views of one row.
+        # Sparse models keep the connections in CSR form instead,
+        # and bind a regression to its row only while it is in use.
+        if sparse:
+            self.regressions = self._compress_regressions(regressions)
+        else:
+            self.regressions = regressions
+            self._bind_regressions()
+        assert len(self.regressions) == N
+
         # Initialize the data list to empty
         self.data_list = []
 
-    # Expose the autoregressive weights and adjacency matrix
+        # Whether each dataset's regressors are the basis convolution
+        # of its counts, in which case their Gram statistics can be
+        # computed from the spike trains alone (see _gram_statistics)
+        self._convolved = []
+        self._gram_stats = None
+
+    def _bind_regressions(self):
+        N, B = self.N, self.B
+        self._adjacency = np.zeros((N, N), dtype=bool)
+        self._weights = np.zeros((N, N, B))
+        self._biases = np.zeros(N)
+        self._rho = np.zeros((N, N))
+        for n, reg in enumerate(self.regressions):
+            reg.bind(self._adjacency[n], self._weights[n],
+                     self._biases[n:n+1], rho=self._rho[n])
+
+    def _compress_regressions(self, regressions):
+        """
+        Move the parameters of the regressions into the sparse store:
+        a CSR adjacency matrix, the nnz x B weights of its entries, and
+        the biases. The regressions' own arrays are released.
+        """
+        N, B = self.N, self.B
+        self._biases = np.zeros(N)
+        self._scratch = (np.zeros(N, dtype=bool), np.zeros((N, B)), np.zeros(N))
+        self._rho_from_network = False
+
+        regs, rows, rhos = [], [], []
+        for n, reg in enumerate(regressions):
+            rows.append(self._compress_row(reg))
+            self._biases[n] = reg.b[0]
+            # Most regressions share one connection probability
+            rho = reg.rho
+            rhos.append(rho[0] if np.all(rho == rho[0]) else rho.copy())
+            reg.release()
+            regs.append(reg)
+
+        self._regression_rho = rhos
+        self._set_rows(rows)
+        return regs
+
+    @staticmethod
+    def _compress_row(reg):
+        inds = np.flatnonzero(reg.a)
+        return inds, reg.W[inds]
+
+    def _set_rows(self, rows):
+        """
+        Rebuild the sparse store from a list of (indices, weights) rows.
+        """
+        N, B = self.N, self.B
+        assert len(rows) == N
+        indices = np.concatenate([inds for inds, _ in rows]).astype(np.int32)
+        indptr = np.concatenate(([0], np.cumsum([inds.size for inds, _ in rows])))
+        self._adjacency = sp.csr_matrix(
+            (np.ones(indices.size, dtype=bool), indices, indptr), shape=(N, N))
+        self._weights = np.concatenate([W for _, W in rows]).reshape((-1, B))
+
+    def _rho_row(self, n):
+        """
+        Connection probabilities of the inputs of the n-th regression.
+        """
+        return self._regression_rho[n]
+
+    @contextmanager
+    def _regression(self, n):
+        """
+        The n-th regression, bound to its parameters. For sparse models,
+        its row is scattered into dense scratch arrays of size N and NxB,
+        which it may modify; see resample_regressions for how changes are
+        kept.
+        """
+        reg = self.regressions[n]
+        if not self.sparse:
+            yield reg
+            return
+
+        a, W, rho = self._scratch
+        A = self._adjacency
+        inds = A.indices[A.indptr[n]:A.indptr[n+1]]
+        a[:] = False
+        a[inds] = True
+        W[:] = 0
+        W[inds] = self._weights[A.indptr[n]:A.indptr[n+1]]
+        rho[:] = self._rho_row(n)
+        reg.bind(a, W, self._biases[n:n+1], rho=rho, copy=False)
+        try:
+            yield reg
+        finally:
+            reg.release()
+
+    def __setstate__(self, state):
+        # Pickling copies the views, so re-establish the shared storage.
+        # Sparse models only bind their regressions while in use.
+        self.__dict__.update(state)
+        if not self.sparse:
+            self._bind_regressions()
+
+    # Expose the autoregressive weights and adjacency matrix.
+    # These are copies, so they can be collected as samples.
+    # For sparse models they are NxNxB and NxN dense arrays,
+    # see 'connectivity' for the sparse form.
     @property
     def weights(self):
-        return np.array([r.W for r in self.regressions])
+        if self.sparse:
+            A = self._adjacency.tocoo()
+            W = np.zeros((self.N, self.N, self.B))
+            W[A.row, A.col] = self._weights
+            return W
+        return self._weights.copy()
 
     @property
     def adjacency(self):
-        return np.array([r.a for r in self.regressions])
+        if self.sparse:
+            return self._adjacency.toarray()
+        return self._adjacency.copy()
+
+    @property
+    def connectivity(self):
+        """
+        A copy of the adjacency matrix in CSR form and an nnz x B array
+        of the weights of its entries, as accepted by the networks.
+        """
+        if self.sparse:
+            return self._adjacency.copy(), self._weights.copy()
+        return sparse_connectivity(self._adjacency, self._weights)
 
     @property
     def biases(self):
-        return np.array([r.b for r in self.regressions]).ravel()
+        return self._biases.copy()
 
-    def add_data(self, data, X=None):
+    @property
+    def inv_temperature(self):
+        """
+        Power to which the likelihood is raised when resampling.
+        Values below one give the tempered replicas of pyglm.tempering.
+        """
+        return self.regressions[0].inv_temperature
+
+    @inv_temperature.setter
+    def inv_temperature(self, value):
+        assert 0 < value <= 1
+        for reg in self.regressions:
+            reg.inv_temperature = value
+
+    def add_data(self, data, X=None, cache=None, convolved=False):
+        """
+        :param data:       TxN array of spike counts, a ChunkedDataset
+                           whose (possibly memory-mapped) data is streamed,
+                           or a ShardedDataset held by worker processes
+        :param X:          Optional TxNxB array of precomputed regressors
+        :param cache:      Optional ConvolutionCache. If given, the regressors
+                           are looked up on (or written to) disk and memory-mapped.
+        :param convolved:  Whether the given X is the basis convolution of
+                           the counts, so that Gram statistics of the
+                           counts can stand in for it
+        """
         N, B = self.N, self.B
+        self._gram_stats = None
+        if isinstance(data, (ChunkedDataset, ShardedDataset)):
+            assert data.N == N and data.B == B
+            if self.sparse and isinstance(data, ShardedDataset):
+                raise NotImplementedError("Sharded datasets need the dense parameter store")
+            self.data_list.append(data)
+            self._convolved.append(False)
+            return
+
         assert isinstance(data, np.ndarray) \
                and data.ndim == 2 \
                and data.shape[1] == self.N
         T = data.shape[0]
 
+        # Store the counts column-major so that each regression's
+        # outputs, data[:,n], are contiguous
+        data = np.asfortranarray(data)
+
         # Convolve the data with the basis to get regressors
-        if X is None:
+        self._convolved.append(X is None or convolved)
+        if X is None and cache is not None:
+            X = cache.convolve(data, self.basis)
+        elif X is None:
             X = convolve_with_basis(data, self.basis)
         else:
             assert X.shape == (T, N, B)
@@ -79,19 +260,57 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
         # Add the covariates and observations
         self.data_list.append((X, data))
 
+    def add_sharded_data(self, data, n_shards=None, addresses=None, authkey=None, spawn=True):
+        """
+        Split a dataset into blocks of time held by worker processes.
+        See ShardedDataset. Call 'close' on the result when done.
+
+        :param data:  TxN array of spike counts
+        """
+        if self.sparse:
+            raise NotImplementedError("Sharded datasets need the dense parameter store")
+        assert data.ndim == 2 and data.shape[1] == self.N
+        sharded = ShardedDataset(data, self.basis, self.regressions,
+                                 n_shards=n_shards, addresses=addresses,
+                                 authkey=authkey, spawn=spawn)
+        self.add_data(sharded)
+        return sharded
+
+    def add_spike_times(self, spike_times, dt, duration, directory=None, chunk_size=10000):
+        """
+        Add a dataset given as lists of spike times rather than a dense
+        count matrix. See ChunkedDataset.from_spike_times.
+
+        :param spike_times: List of N arrays of spike times, one per neuron
+        :param dt:          Bin size, in the same units as the spike times
+        :param duration:    Length of the recording
+        :param directory:   If given, memory-map the regressors there
+        """
+        assert len(spike_times) == self.N
+        self.add_data(ChunkedDataset.from_spike_times(
+            spike_times, self.basis, dt, duration,
+            directory=directory, chunk_size=chunk_size))
+
     def log_likelihood(self, datas=None):
         if datas is None:
             datas = self.data_list
 
         ll = 0
         for data in datas:
-            if isinstance(data, tuple):
-                X, Y = data
+            if isinstance(data, ShardedDataset):
+                ll += data.log_likelihood(self.regressions)
+                continue
+            elif isinstance(data, ChunkedDataset):
+                chunks = data.chunks()
+            elif isinstance(data, tuple):
+                chunks = [data]
             else:
-                X, Y = convolve_with_basis(data, self.basis), data
+                chunks = [(convolve_with_basis(data, self.basis), data)]
 
-            for n, reg in enumerate(self.regressions):
-                ll += reg.log_likelihood((X, Y[:,n])).sum()
+            for X, Y in chunks:
+                for n in range(self.N):
+                    with self._regression(n) as reg:
+                        ll += reg.log_likelihood((X, Y[:,n])).sum()
 
         return ll
 
@@ -122,14 +341,19 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
         assert not np.allclose(basis, self.basis)
 
         # Precompute the weights and biases
-        W = self.weights.reshape((N, N*B))  # N x NB (post x (pre x B))
-        b = self.biases                     # N (post)
+        W = self._weight_matrix()            # N x NB (post x (pre x B))
+        b = self._biases                     # N (post)
 
         # Initialize output matrix of spike counts
         Y = np.zeros((T+L, N))
         X = np.zeros((T+L, N, B))
         Psi = np.zeros((T+L, N))
 
+        # Recursive bases update the regressors in O(NB) per bin
+        stepper = None
+        if recursive_form(self.basis) is not None:
+            stepper = self.basis.stepper(N)
+
         # Iterate forward in time
         for t in range(L,T+L):
             if verbose:
@@ -137,7 +361,10 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
                     print("Generate t={}".format(t))
             # 1. Project previous activity window onto the basis
             #    previous activity is L x N, basis is L x B,
-            X[t] = Y[t-L:t].T.dot(basis)
+            if stepper is not None:
+                X[t] = stepper.push(Y[t-1]).T
+            else:
+                X[t] = Y[t-L:t].T.dot(basis)
 
             # 2. Compute the activation, W.dot(X[t]) + b
             Psi[t] = W.dot(X[t].reshape((N*B,))) + b
@@ -146,29 +373,113 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
             Y[t] = self.regressions[0].rvs(psi=Psi[t])
 
         if keep:
-            self.add_data(Y[L:], X=X[L:])
+            # X is the basis convolution of Y, since Y is zero before t=L
+            self.add_data(Y[L:], X=X[L:], convolved=True)
 
         return X[L:], Y[L:]
 
+    def _weight_matrix(self):
+        """
+        The weights as an N x NB matrix (post x (pre x B)),
+        in CSR form for sparse models.
+        """
+        N, B = self.N, self.B
+        if not self.sparse:
+            return self._weights.reshape((N, N*B))
+
+        A = self._adjacency
+        cols = (A.indices[:, None] * B + np.arange(B)).ravel()
+        return sp.csr_matrix((self._weights.ravel(), cols, A.indptr * B), shape=(N, N*B))
+
     @property
     def means(self):
         """
         Compute the mean observation for each dataset
         """
         mus = []
-        for (X,Y) in self.data_list:
-            mus.append(np.column_stack(
-                [r.mean(X) for r in self.regressions]))
+        for data in self.data_list:
+            if isinstance(data, ShardedDataset):
+                # The regressors only exist in the workers
+                raise NotImplementedError("The means of a ShardedDataset are not available")
+            chunks = data.chunks() if isinstance(data, ChunkedDataset) else [data]
+            mus.append(np.vstack([
+                np.column_stack([self._mean(n, X) for n in range(self.N)])
+                for (X, Y) in chunks]))
 
         return mus
 
+    def _mean(self, n, X):
+        with self._regression(n) as reg:
+            return reg.mean(X)
+
     ### Gibbs sampling
     def resample_model(self):
         self.resample_regressions()
 
     def resample_regressions(self):
-        for n, reg in enumerate(self.regressions):
-            reg.resample([(X, Y[:,n]) for (X,Y) in self.data_list])
+        stats = None
+        if any(reg.uses_gram_statistics for reg in self.regressions):
+            stats = self._gram_statistics()
+
+        # Sparse models collect the new rows, since the regressions
+        # still to be resampled read theirs from the current store
+        rows = []
+        for n in range(self.N):
+            with self._regression(n) as reg:
+                if stats is not None and reg.uses_gram_statistics:
+                    reg.resample(self._regression_datas(n),
+                                 stats=neuron_statistics(stats, n))
+                else:
+                    reg.resample(self._regression_datas(n))
+                if self.sparse:
+                    rows.append(self._compress_row(reg))
+
+        if self.sparse:
+            self._set_rows(rows)
+
+    def _gram_statistics(self):
+        """
+        Gram statistics of the regressors, summed over datasets and
+        cached until more data is added. Sparse spike trains and short
+        bases get them from the cross-correlations of the counts (see
+        correlations_are_cheaper), other datasets from the regressors.
+        Returns None unless every dataset's regressors are the basis
+        convolution of its counts.
+        """
+        if self._gram_stats is not None:
+            return self._gram_stats
+
+        if len(self.data_list) == 0 or not all(self._convolved):
+            return None
+
+        total = None
+        for X, Y in self.data_list:
+            if correlations_are_cheaper(Y, self.basis):
+                stats = basis_gram_statistics(Y, self.basis)
+            else:
+                stats = gram_statistics(X, Y)
+            total = stats if total is None else \
+                dict((k, total[k] + v) for k, v in stats.items())
+        self._gram_stats = total
+        return self._gram_stats
+
+    def set_gram_statistics(self, stats):
+        """
+        Provide the Gram statistics (see basis_gram_statistics) of the
+        current datasets, e.g. when the regressors were passed in
+        explicitly but the statistics are known. They are discarded
+        when more data is added.
+        """
+        self._gram_stats = stats
+
+    def _regression_datas(self, n):
+        """
+        The data for the n-th regression. Chunked datasets are passed
+        as iterables of (X, y) chunks.
+        """
+        return [data.column(n) if isinstance(data, (ChunkedDataset, ShardedDataset))
+                else (data[0], data[1][:,n])
+                for data in self.data_list]
 
     ### Plotting
     def plot(self,
@@ -186,10 +497,13 @@ class NonlinearAutoregressiveModel(ModelGibbsSampling):
         :return:
         """
         from pyglm.plotting import plot_glm
+        data = self.data_list[data_index]
+        if isinstance(data, ShardedDataset):
+            raise NotImplementedError("A ShardedDataset cannot be plotted")
         return plot_glm(
-            self.data_list[data_index][1],
-            self.weights,
-            self.adjacency,
+            data.dense_Y(slice(0, pltslice.stop)) if isinstance(data, ChunkedDataset) else data[1],
+            self.weights if self.sparse else self._weights,
+            self.adjacency if self.sparse else self._adjacency,
             self.means[0],
             fig=fig,
             axs=axs,
@@ -209,7 +523,7 @@ class HierarchicalNonlinearAutoregressiveModel(NonlinearAutoregressiveModel):
     as a network, we refer to these as "network" AR models, or "network GLMs".
     """
 
-    def __init__(self, N, network, regressions, basis=None, B=10):
+    def __init__(self, N, network, regressions, basis=None, B=10, sparse=False):
         """
         The only difference here is that we also provide a 'network' object,
         which specifies a prior distribution on the regression weights.
@@ -217,7 +531,7 @@ class HierarchicalNonlinearAutoregressiveModel(NonlinearAutoregressiveModel):
         :param network:
         """
         super(HierarchicalNonlinearAutoregressiveModel, self). \
-            __init__(N, regressions, basis=basis, B=B)
+            __init__(N, regressions, basis=basis, B=B, sparse=sparse)
 
         self.network = network
 
@@ -225,15 +539,29 @@ class HierarchicalNonlinearAutoregressiveModel(NonlinearAutoregressiveModel):
         super(HierarchicalNonlinearAutoregressiveModel, self).resample_model()
         self.resample_network()
 
+    def _rho_row(self, n):
+        if self._rho_from_network:
+            return self.network.rho_row(n)
+        return super(HierarchicalNonlinearAutoregressiveModel, self)._rho_row(n)
+
     def resample_network(self):
         net = self.network
-        net.resample((self.adjacency, self.weights))
+        # Sparse models pass the network their CSR adjacency
+        # and the weights of its entries
+        net.resample((self._adjacency, self._weights))
 
-        # Update the regression hyperparameters
+        # Update the regression hyperparameters. The weight prior is
+        # passed in factored form to avoid building NxNxBxB arrays.
+        mu, sigma, mu_self, sigma_self = net.weight_prior
         for n, reg in enumerate(self.regressions):
-            reg.S_w = net.sigma_W[n]
-            reg.mu_w = net.mu_W[n]
-            reg.rho = net.rho[n]
+            reg.set_weight_prior(mu, sigma, self_index=n,
+                                 mu_self=mu_self, S_self=sigma_self)
+
+        # Sparse models read the rows of rho from the network as needed
+        if self.sparse:
+            self._rho_from_network = True
+        else:
+            self._rho[...] = net.rho
 
 # Alias the "GLM" and its "Network" extension
 GLM = NonlinearAutoregressiveModel
@@ -247,7 +575,8 @@ class _DefaultMixin(object):
                  network=None,
                  network_kwargs=None,
                  regressions=None,
-                 regression_kwargs=None):
+                 regression_kwargs=None,
+                 sparse=False):
         """
         :param N:             Observation dimension.
         :param basis:         Basis onto which the preceding activity is projected.
@@ -255,6 +584,8 @@ class _DefaultMixin(object):
         :param B:             Basis dimensionality.
                               In the "identity" case, this is the number of lags.
         :param kwargs:        arguments to the corresponding regression constructor.
+        :param sparse:        Keep the connections in sparse form, see
+                              NonlinearAutoregressiveModel.
         """
         B = B if basis is None else basis.shape[1]
         if network is None:
@@ -263,8 +594,12 @@ class _DefaultMixin(object):
 
         if regressions is None:
             regression_kwargs = dict() if regression_kwargs is None else regression_kwargs
-            regressions = [self._regression_class(N, B, **regression_kwargs) for _ in range(N)]
-        super(_DefaultMixin, self).__init__(N, network, regressions, B=B, basis=basis)
+            # Sparse models compress each regression as it is built
+            regressions = (self._regression_class(N, B, **regression_kwargs) for _ in range(N))
+            if not sparse:
+                regressions = list(regressions)
+        super(_DefaultMixin, self).__init__(N, network, regressions, B=B, basis=basis,
+                                            sparse=sparse)
 
 
 class GaussianGLM(_DefaultMixin, NetworkGLM):
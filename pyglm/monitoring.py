@@ -0,0 +1,214 @@
+"""
+Live monitoring of a sampler without stalling it.
+
+Calling plot_glm after every iteration makes the sampler wait for
+matplotlib, and redrawing NxN images and long rate traces dominates the
+run time for large networks. A LiveMonitor instead takes a small snapshot
+of the model -- the weights and adjacency block-averaged down to at most
+'max_neurons' rows and columns, and the rates of a few neurons over a
+decimated window of time -- at most 'fps' times per second, and hands it
+to a renderer in a separate process. The hand-off goes through a queue
+that only ever holds the latest snapshot, so a slow renderer drops frames
+rather than blocking the sampler.
+"""
+import time
+import multiprocessing as mp
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.utils.data import ChunkedDataset
+
+try:
+    from queue import Full, Empty
+except ImportError:
+    from Queue import Full, Empty
+
+
+def decimate_matrix(A, max_size):
+    """
+    Block-average a square matrix (along its first two axes) so that it
+    has at most max_size rows and columns. Always returns a copy, so
+    the result can be handed to another process while A changes.
+    A may also be a scipy.sparse matrix, whose entries are summed
+    into the blocks without densifying it.
+    """
+    N = A.shape[0]
+    k = int(np.ceil(N / float(max_size)))
+    if k <= 1:
+        return A.toarray().astype(float) if sp.issparse(A) else np.array(A, dtype=float)
+
+    # Pad to a multiple of the block size, and average over the valid entries
+    M = int(np.ceil(N / float(k)))
+    counts = np.zeros((M * k, M * k))
+    counts[:N, :N] = 1
+    if sp.issparse(A):
+        A = A.tocoo()
+        Ap = np.zeros((M, M))
+        np.add.at(Ap, (A.row // k, A.col // k), A.data)
+    else:
+        shape = (M * k, M * k) + A.shape[2:]
+        Ap = np.zeros(shape)
+        Ap[:N, :N] = A
+        Ap = Ap.reshape((M, k, M, k) + A.shape[2:]).sum(axis=(1, 3))
+
+    counts = counts.reshape((M, k, M, k)).sum(axis=(1, 3))
+    return Ap / counts.reshape(counts.shape + (1,) * (A.ndim - 2))
+
+
+def _render_loop(queue, filename, plot_kwargs):
+    import matplotlib
+    if filename is not None:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from pyglm.plotting import plot_glm
+
+    if filename is None:
+        plt.ion()
+
+    handles = None
+    fig = None
+    while True:
+        snapshot = queue.get()
+        if snapshot is None:
+            break
+
+        W, A, Y, rates, pltslice, title = snapshot
+        fig, _, handles = plot_glm(Y, W, A, rates, fig=fig, handles=handles,
+                                   title=title, pltslice=pltslice,
+                                   N_to_plot=Y.shape[1], **plot_kwargs)
+        if filename is not None:
+            fig.savefig(filename)
+        else:
+            plt.pause(0.001)
+
+    if filename is None and fig is not None:
+        plt.ioff()
+        plt.show()
+
+
+class LiveMonitor(object):
+    """
+    Rate-limited, non-blocking plots of a NonlinearAutoregressiveModel.
+    """
+    def __init__(self, fps=5.0,
+                 max_neurons=50,
+                 max_points=1000,
+                 N_to_plot=2,
+                 pltslice=slice(0, 500),
+                 data_index=0,
+                 filename=None,
+                 **plot_kwargs):
+        """
+        :param fps:          Maximum number of snapshots per second
+        :param max_neurons:  Block-average the weight and adjacency matrices
+                             down to at most this many rows and columns
+        :param max_points:   Plot at most this many time bins of the rates
+        :param N_to_plot:    Number of neurons whose rates are plotted
+        :param pltslice:     Window of time bins to plot
+        :param data_index:   Which dataset to plot
+        :param filename:     If given, render off-screen to this image file
+                             instead of to an interactive window
+        :param plot_kwargs:  Passed on to plot_glm (e.g. W_lim, figsize)
+        """
+        self.min_interval = 1.0 / fps
+        self.max_neurons = max_neurons
+        self.max_points = max_points
+        self.N_to_plot = N_to_plot
+        self.pltslice = pltslice
+        self.data_index = data_index
+        self._last = -np.inf
+        self.frames_sent = 0
+        self.frames_skipped = 0
+
+        self._queue = mp.Queue(maxsize=1)
+        self._process = mp.Process(target=_render_loop,
+                                   args=(self._queue, filename, plot_kwargs))
+        self._process.daemon = True
+        self._process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def snapshot(self, model):
+        """
+        A small copy of the parts of the model state that are plotted.
+        """
+        data = model.data_list[self.data_index]
+        slc = self.pltslice
+        if isinstance(data, ChunkedDataset):
+            X, Y = data.X[slc], data.dense_Y(slc)
+        else:
+            X, Y = data[0][slc], data[1][slc]
+
+        # Decimate the window of time
+        step = max(1, int(np.ceil(X.shape[0] / float(self.max_points))))
+        X, Y = X[::step], Y[::step]
+
+        # Only compute the rates of the neurons that are plotted
+        n_plot = min(self.N_to_plot, model.N)
+        rates = np.column_stack([model._mean(n, X) for n in range(n_plot)])
+        Y = np.asarray(Y[:, :n_plot])
+
+        if model.sparse:
+            A = model._adjacency
+            W = sp.csr_matrix((model._weights[:, 0], A.indices, A.indptr), shape=A.shape)
+            W = decimate_matrix(W, self.max_neurons)[:, :, None]
+            A = decimate_matrix(A.astype(float), self.max_neurons)
+        else:
+            W = decimate_matrix(model._weights[:, :, :1], self.max_neurons)
+            A = decimate_matrix(model._adjacency.astype(float), self.max_neurons)
+        return W, A, Y, rates, slice(0, Y.shape[0])
+
+    def update(self, model, title=None):
+        """
+        Send a snapshot to the renderer, unless one was sent less than
+        1/fps seconds ago. Never waits for the renderer.
+
+        :return:  Whether a snapshot was sent
+        """
+        now = time.time()
+        if now - self._last < self.min_interval:
+            self.frames_skipped += 1
+            return False
+        self._last = now
+
+        snapshot = self.snapshot(model) + (title,)
+
+        # Replace the pending snapshot, if the renderer hasn't taken it yet
+        try:
+            self._queue.put_nowait(snapshot)
+        except Full:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                pass
+            try:
+                self._queue.put_nowait(snapshot)
+            except Full:
+                pass
+        self.frames_sent += 1
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stop the renderer. With an interactive window, the renderer keeps
+        the last frame open until it is closed; pass a timeout to not wait.
+        """
+        # Drop the pending snapshot, if any, to make room for the sentinel
+        # without blocking on a renderer that is busy drawing
+        try:
+            self._queue.get_nowait()
+        except Empty:
+            pass
+        try:
+            self._queue.put(None, timeout=timeout)
+        except Full:
+            pass
+        self._process.join(timeout)
+
+        # Don't let exiting wait on a renderer that is still running
+        if self._process.is_alive():
+            self._queue.cancel_join_thread()
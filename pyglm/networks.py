@@ -4,6 +4,7 @@ weights of a set of regression objects.
 """
 import abc
 import numpy as np
+import scipy.sparse as sp
 
 from pybasicbayes.abstractions import GibbsSampling
 from pybasicbayes.distributions import Gaussian
@@ -32,27 +33,75 @@ class _NetworkModel(GibbsSampling):
             A, W = data
             A in [0,1]^{N x N} where rows are incoming and columns are outgoing nodes
             W in [0,1]^{N x N x B} where rows are incoming and columns are outgoing nodes
+            For large, sparse networks, A may instead be a scipy.sparse
+            matrix and W an nnz x B array of the weights of its stored
+            entries, in the order A stores them (see
+            pyglm.utils.utils.sparse_connectivity).
         """
         assert isinstance(data, tuple)
         A, W = data
         N, B = self.N, self.B
         assert A.shape == (N, N)
-        assert A.dtype == bool
-        assert W.shape == (N, N, B)
+        if sp.issparse(A):
+            assert W.shape == (A.nnz, B)
+        else:
+            assert A.dtype == bool
+            assert W.shape == (N, N, B)
+
+    def _nonzero_weights(self, data):
+        """
+        The pre and post indices of the connections and their weights,
+        from either a dense or a sparse (A, W) pair.
+
+        :return:  rows (post), cols (pre), and an nnz x B array of weights
+        """
+        A, W = data
+        if sp.issparse(A):
+            A = A.tocoo()
+            present = A.data != 0
+            return A.row[present], A.col[present], W[present]
+
+        rows, cols = np.nonzero(A)
+        return rows, cols, W[rows, cols]
 
     @abc.abstractproperty
-    def mu_W(self):
+    def weight_prior(self):
         """
-        NxNxB array of mean weights
+        Factored prior on the weights, (mu, sigma, mu_self, sigma_self).
+        All connections share the B-dimensional mean 'mu' and the BxB
+        covariance 'sigma', except for the self connections, which use
+        'mu_self' and 'sigma_self' if they are not None.
         """
         raise NotImplementedError
 
-    @abc.abstractproperty
+    @property
+    def mu_W(self):
+        """
+        NxNxB array of mean weights. When the self connections share the
+        prior this is a read-only view of the shared mean.
+        """
+        N, B = self.N, self.B
+        mu, _, mu_self, _ = self.weight_prior
+        mu_W = np.broadcast_to(mu, (N, N, B))
+        if mu_self is not None:
+            mu_W = mu_W.copy()
+            mu_W[np.arange(N), np.arange(N)] = mu_self
+        return mu_W
+
+    @property
     def sigma_W(self):
         """
-        NxNxBxB array with conditional covariances of each weight
+        NxNxBxB array with conditional covariances of each weight. When the
+        self connections share the prior this is a read-only view of the
+        shared covariance.
         """
-        raise NotImplementedError
+        N, B = self.N, self.B
+        _, sigma, _, sigma_self = self.weight_prior
+        sigma_W = np.broadcast_to(sigma, (N, N, B, B))
+        if sigma_self is not None:
+            sigma_W = sigma_W.copy()
+            sigma_W[np.arange(N), np.arange(N)] = sigma_self
+        return sigma_W
 
     @abc.abstractproperty
     def rho(self):
@@ -62,6 +111,13 @@ class _NetworkModel(GibbsSampling):
         """
         pass
 
+    def rho_row(self, n):
+        """
+        Connection probabilities of the inputs to node n.
+        :return: N array with values in [0,1]
+        """
+        return self.rho[n]
+
     ## TODO: Add properties for info form weight parameters
 
     def log_likelihood(self, x):
@@ -82,7 +138,7 @@ class _IndependentGaussianMixin(_NetworkModel):
                  mu_0=0.0, sigma_0=1.0, kappa_0=1.0, nu_0=3.0,
                  is_diagonal_weight_special=True,
                  **kwargs):
-        super(_IndependentGaussianMixin, self).__init__(N, B)
+        super(_IndependentGaussianMixin, self).__init__(N, B, **kwargs)
 
         mu_0 = expand_scalar(mu_0, (B,))
         sigma_0 = expand_cov(sigma_0, (B,B))
@@ -91,83 +147,48 @@ class _IndependentGaussianMixin(_NetworkModel):
         self.is_diagonal_weight_special = is_diagonal_weight_special
         if is_diagonal_weight_special:
             self._self_gaussian = \
-                Gaussian(mu_0=mu_0, sigma_0=sigma_0, kappa_0=kappa_0, nu_0=nu_0)
+                Gaussian(mu_0=mu_0, sigma_0=sigma_0, kappa_0=kappa_0, nu_0=max(nu_0, B+2.))
 
     @property
-    def mu_W(self):
-        N, B = self.N, self.B
-        mu = np.zeros((N, N, B))
+    def weight_prior(self):
         if self.is_diagonal_weight_special:
-            # Set off-diagonal weights
-            mask = np.ones((N, N), dtype=bool)
-            mask[np.diag_indices(N)] = False
-            mu[mask] = self._gaussian.mu
-
-            # set diagonal weights
-            mask = np.eye(N).astype(bool)
-            mu[mask] = self._self_gaussian.mu
-
-        else:
-            mu = np.tile(self._gaussian.mu[None,None,:], (N, N, 1))
-        return mu
-
-    @property
-    def sigma_W(self):
-        N, B = self.N, self.B
-        if self.is_diagonal_weight_special:
-            sigma = np.zeros((N, N, B, B))
-            # Set off-diagonal weights
-            mask = np.ones((N, N), dtype=bool)
-            mask[np.diag_indices(N)] = False
-            sigma[mask] = self._gaussian.sigma
-
-            # set diagonal weights
-            mask = np.eye(N).astype(bool)
-            sigma[mask] = self._self_gaussian.sigma
-
+            return self._gaussian.mu, self._gaussian.sigma, \
+                   self._self_gaussian.mu, self._self_gaussian.sigma
         else:
-            sigma = np.tile(self._gaussian.mu[None, None, :, :], (N, N, 1, 1))
-        return sigma
+            return self._gaussian.mu, self._gaussian.sigma, None, None
 
     def resample(self, data=[]):
         super(_IndependentGaussianMixin, self).resample(data)
-        A, W = data
-        N, B = self.N, self.B
+        rows, cols, W = self._nonzero_weights(data)
         if self.is_diagonal_weight_special:
             # Resample prior for off-diagonal weights
-            mask = np.ones((N, N), dtype=bool)
-            mask[np.diag_indices(N)] = False
-            mask = mask & A
-            self._gaussian.resample(W[mask])
+            diag = rows == cols
+            self._gaussian.resample(W[~diag])
 
             # Resample prior for diagonal weights
-            mask = np.eye(N).astype(bool) & A
-            self._self_gaussian.resample(W[mask])
+            self._self_gaussian.resample(W[diag])
 
         else:
             # Resample prior for all weights
-            self._gaussian.resample(W[A])
+            self._gaussian.resample(W)
 
 class _FixedWeightsMixin(_NetworkModel):
     def __init__(self, N, B,
                  mu=0.0, sigma=1.0,
                  mu_self=None, sigma_self=None,
                  **kwargs):
-        super(_FixedWeightsMixin, self).__init__(N, B)
-        self._mu = expand_scalar(mu, (N, N, B))
-        self._sigma = expand_cov(mu, (N, N, B, B))
+        super(_FixedWeightsMixin, self).__init__(N, B, **kwargs)
+        self._mu = expand_scalar(mu, (B,))
+        self._sigma = expand_cov(sigma, (B, B))
 
+        self._mu_self = self._sigma_self = None
         if (mu_self is not None) and (sigma_self is not None):
-            self._mu[np.arange(N), np.arange(N), :] = expand_scalar(mu_self, (N, B))
-            self._sigma[np.arange(N), np.arange(N), :] = expand_cov(sigma_self, (N, B, B))
-
-    @property
-    def mu_W(self):
-        return self._mu
+            self._mu_self = expand_scalar(mu_self, (B,))
+            self._sigma_self = expand_cov(sigma_self, (B, B))
 
     @property
-    def sigma_W(self):
-        return self._sigma
+    def weight_prior(self):
+        return self._mu, self._sigma, self._mu_self, self._sigma_self
 
     def resample(self,data=[]):
         super(_FixedWeightsMixin, self).resample(data)
@@ -177,14 +198,31 @@ class _FixedWeightsMixin(_NetworkModel):
 ### Adjacency models
 class _FixedAdjacencyMixin(_NetworkModel):
     def __init__(self, N, B, rho=0.5, rho_self=None, **kwargs):
-        super(_FixedAdjacencyMixin, self).__init__(N, B)
-        self._rho = expand_scalar(rho, (N, N))
-        if rho_self is not None:
-            self._rho[np.diag_indices(N)] = rho_self
+        super(_FixedAdjacencyMixin, self).__init__(N, B, **kwargs)
+        # A scalar rho is kept as is, so that large networks
+        # never need an NxN array of it
+        self._rho = rho if np.isscalar(rho) else expand_scalar(rho, (N, N))
+        self._rho_self = rho_self
 
     @property
     def rho(self):
-        return self._rho
+        """
+        When rho is a scalar shared by the self connections,
+        this is a read-only view of it.
+        """
+        N = self.N
+        rho = np.broadcast_to(self._rho, (N, N))
+        if self._rho_self is not None:
+            rho = rho.copy()
+            rho[np.diag_indices(N)] = self._rho_self
+        return rho
+
+    def rho_row(self, n):
+        rho = np.broadcast_to(self._rho if np.isscalar(self._rho) else self._rho[n], (self.N,))
+        if self._rho_self is not None:
+            rho = rho.copy()
+            rho[n] = self._rho_self
+        return rho
 
     def resample(self,data=[]):
         super(_FixedAdjacencyMixin, self).resample(data)
@@ -193,12 +231,15 @@ class _FixedAdjacencyMixin(_NetworkModel):
 
 class _DenseAdjacencyMixin(_NetworkModel):
     def __init__(self, N, B, **kwargs):
-        super(_DenseAdjacencyMixin, self).__init__(N, B)
-        self._rho = np.ones((N,N))
+        super(_DenseAdjacencyMixin, self).__init__(N, B, **kwargs)
 
     @property
     def rho(self):
-        return self._rho
+        # A read-only view, rather than an NxN array of ones
+        return np.broadcast_to(1.0, (self.N, self.N))
+
+    def rho_row(self, n):
+        return np.ones(self.N)
 
     def resample(self,data=[]):
         super(_DenseAdjacencyMixin, self).resample(data)
@@ -210,7 +251,7 @@ class _IndependentBernoulliMixin(_NetworkModel):
                  a_0=1.0, b_0=1.0,
                  is_diagonal_conn_special=True,
                  **kwargs):
-        super(_IndependentBernoulliMixin, self).__init__(N, B)
+        super(_IndependentBernoulliMixin, self).__init__(N, B, **kwargs)
         raise NotImplementedError("TODO: Implement the BetaBernoulli class")
 
         assert np.isscalar(a_0)
@@ -0,0 +1,187 @@
+"""
+Inference-free predictors for closed-loop use.
+
+A fitted model (or a posterior mean) is frozen into a predictor that
+keeps the filtered spike history up to date bin by bin and returns the
+firing rates of all neurons. Only presynaptic neurons with at least one
+active connection are filtered, and all buffers are allocated up front
+so that 'update' does not allocate. When few of the connections between
+those neurons are present, the activations only visit the present ones.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.regression import SparseBernoulliRegression, SparseGaussianRegression
+from pyglm.utils.basis import recursive_form
+
+
+class FrozenPredictor(object):
+    """
+    Online rate predictor for a fixed set of GLM parameters.
+    """
+    links = ("logistic", "identity")
+
+    # Above this fraction of connections present among the filtered
+    # neurons, a dense product beats visiting the connections one by one
+    dense_fraction = 0.2
+
+    def __init__(self, basis, weights, adjacency, biases, link="logistic"):
+        """
+        :param basis:     LxB basis, as passed to the model.
+        :param weights:   NxNxB weights (post x pre x basis), or an nnz x B
+                          array of the weights of a sparse adjacency's entries.
+        :param adjacency: NxN adjacency (post x pre). May be fractional,
+                          e.g. a posterior mean, in which case it scales
+                          the weights. May be a scipy.sparse matrix.
+        :param biases:    N biases.
+        :param link:      "logistic" for Bernoulli models, "identity" for
+                          Gaussian models.
+        """
+        N = adjacency.shape[0]
+        L, B = basis.shape
+        assert adjacency.shape == (N, N)
+        assert biases.shape == (N,)
+        assert link in self.links
+        self.N, self.B, self.L = N, B, L
+        self.link = link
+
+        # The present connections and their effective weights
+        if sp.issparse(adjacency):
+            A = adjacency.tocoo()
+            assert weights.shape == (A.nnz, B)
+            present = A.data != 0
+            rows, cols = A.row[present], A.col[present]
+            W = A.data[present, None] * weights[present]
+        else:
+            assert weights.shape == (N, N, B)
+            rows, cols = np.nonzero(adjacency)
+            W = adjacency[rows, cols, None] * weights[rows, cols]
+
+        # Only presynaptic neurons with an active connection enter the computation
+        self.pre = np.unique(cols)
+        K = self.pre.size
+
+        # Effective weights arranged to match the B x K layout of the regressors
+        k = np.searchsorted(self.pre, cols)
+        W = sp.csr_matrix((W.T.ravel(), (np.tile(rows, B), (np.arange(B)[:, None] * K + k).ravel())),
+                          shape=(N, B*K))
+        self._b = np.array(biases, dtype=float)
+        self._sparse = rows.size <= self.dense_fraction * N * K
+        if self._sparse:
+            # Visit the entries of the rows with connections, summing the
+            # products of each row with reduceat
+            self._post = np.where(np.diff(W.indptr) > 0)[0]
+            self._starts = W.indptr[self._post]
+            self._W_indices, self._W_data = W.indices, W.data
+            self._products = np.zeros(W.nnz)
+            self._psi_post = np.zeros(self._post.size)
+            self._b_post = self._b[self._post]
+        else:
+            self._W = W.toarray()
+
+        # The first row of the basis multiplies the previous time bin, so flip it
+        # to line up with a history window ordered from oldest to newest.
+        self._basis = np.ascontiguousarray(np.flipud(basis).T)
+
+        # The history is a doubled ring buffer so that the last L bins are
+        # always available as a contiguous view.
+        self._history = np.zeros((2*L, K))
+        self._pos = 0
+        self._y = np.zeros(K)
+        self._X = np.zeros((B, K))
+        self._x = self._X.reshape((B*K,))
+        self._rates = np.zeros(N)
+
+        # Recursive bases are stepped instead of projecting the window
+        self._stepper = None
+        if recursive_form(basis) is not None:
+            self._stepper = basis.stepper(K)
+
+        self.reset()
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Freeze the current sample of a NonlinearAutoregressiveModel.
+        """
+        reg = model.regressions[0]
+        if isinstance(reg, SparseBernoulliRegression):
+            link = "logistic"
+        elif isinstance(reg, SparseGaussianRegression):
+            link = "identity"
+        else:
+            raise Exception("Unsupported regression class: {}".format(type(reg)))
+
+        # Sparse models hand over their CSR connectivity
+        if model.sparse:
+            A, W = model.connectivity
+            return cls(model.basis, W, A.astype(float), model.biases, link=link)
+        return cls(model.basis, model.weights, model.adjacency.astype(float),
+                   model.biases, link=link)
+
+    def reset(self, history=None):
+        """
+        Clear the spike history, optionally priming it with past activity.
+
+        :param history:  TxN array of the most recent spike counts
+        :return:         Firing rates for the next time bin
+        """
+        self._history[:] = 0
+        self._pos = 0
+        if self._stepper is not None:
+            self._stepper.reset()
+            self._X[:] = 0
+        if history is not None:
+            assert history.ndim == 2 and history.shape[1] == self.N
+            for y in history[-self.L:]:
+                self._push(y)
+        return self._compute_rates()
+
+    def update(self, y):
+        """
+        Add the spike counts of the latest time bin and predict the next one.
+
+        :param y:  length N array of spike counts
+        :return:   length N array of firing rates for the next time bin.
+                   This buffer is overwritten by the next call.
+        """
+        self._push(y)
+        return self._compute_rates()
+
+    def _push(self, y):
+        L, pos = self.L, self._pos
+        np.take(y, self.pre, out=self._y, mode='clip')
+        if self._stepper is not None:
+            self._X[:] = self._stepper.push(self._y)
+            return
+        self._history[pos] = self._y
+        self._history[pos + L] = self._y
+        self._pos = (pos + 1) % L
+
+    def _compute_rates(self):
+        L, pos = self.L, self._pos
+
+        # Project the last L bins onto the basis
+        if self._stepper is None:
+            np.dot(self._basis, self._history[pos:pos+L], out=self._X)
+
+        # Compute the activation and pass it through the link
+        psi = self._rates
+        if self._sparse:
+            psi[:] = self._b
+            if self._post.size > 0:
+                products = self._products
+                np.take(self._x, self._W_indices, out=products)
+                products *= self._W_data
+                np.add.reduceat(products, self._starts, out=self._psi_post)
+                self._psi_post += self._b_post
+                np.put(psi, self._post, self._psi_post)
+        else:
+            np.dot(self._W, self._x, out=psi)
+            psi += self._b
+        if self.link == "logistic":
+            np.negative(psi, out=psi)
+            np.exp(psi, out=psi)
+            psi += 1
+            np.reciprocal(psi, out=psi)
+        return psi
@@ -26,16 +26,55 @@ inference.
 This module implements these sparse regressions.
 """
 import abc
+import threading
 import numpy as np
 import numpy.random as npr
 
-from scipy.linalg import block_diag
+from scipy.linalg import block_diag, solve_triangular
 from scipy.linalg.lapack import dpotrs
+from scipy.linalg.blas import dsyrk
 
 from pybasicbayes.abstractions import GibbsSampling
 from pybasicbayes.util.stats import sample_gaussian, sample_discrete_from_log, sample_invgamma
 
-from pyglm.utils.utils import logistic, expand_scalar, expand_cov
+from pyglm.utils.utils import logistic, expand_scalar, expand_cov, pcg, Workspace, sample_pg_normal
+
+# One workspace per thread, borrowed by every regression in that thread
+_shared_workspace = threading.local()
+
+# Rows of the inputs visited at a time by the products below. Inputs kept
+# in single precision are upcast one block at a time, never all at once.
+ROW_BLOCK = 8192
+
+
+def _row_blocks(T):
+    for start in range(0, T, ROW_BLOCK):
+        yield slice(start, min(start + ROW_BLOCK, T))
+
+
+def _matvec(X, w):
+    """
+    X.dot(w), without a double precision copy of a single precision X.
+    """
+    if X.dtype == w.dtype:
+        return X.dot(w)
+    out = np.empty(X.shape[0])
+    for rows in _row_blocks(X.shape[0]):
+        out[rows] = X[rows].dot(w)
+    return out
+
+
+def _rmatvec(v, X):
+    """
+    v.dot(X), without a double precision copy of a single precision X.
+    """
+    if X.dtype == v.dtype:
+        return v.dot(X)
+    out = np.zeros(X.shape[1])
+    for rows in _row_blocks(X.shape[0]):
+        out += v[rows].dot(X[rows])
+    return out
+
 
 class _SparseScalarRegressionBase(GibbsSampling):
     """
@@ -67,16 +106,36 @@ class _SparseScalarRegressionBase(GibbsSampling):
     mu_b in R          mean of the bias vector
     S_b in R_+         covariance of the bias vector
 
+    By default, the indicators a_n are resampled with the weights
+    integrated out ("collapsed"), which mixes well but costs a
+    factorization over the whole active set for every flip. With
+    collapsed=False, we instead resample each (a_n, w_n) pair jointly
+    given the residual of the other groups, at O(TB + B^3) per group.
+
+    The weights are then drawn from their joint conditional by factoring
+    its precision (W_sampler="cholesky"). With W_sampler="cg" we instead
+    draw them by perturbing the potentials and solving for the mode with
+    preconditioned conjugate gradients, which only needs products with
+    the inputs and never forms the (NB+1)x(NB+1) posterior precision.
+    Since the collapsed updates of a need that precision, this mode
+    resamples a with the uncollapsed sweep.
     """
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, N, B,
                  rho=0.5,
                  mu_w=0.0, S_w=1.0,
-                 mu_b=0.0, S_b=1.0):
+                 mu_b=0.0, S_b=1.0,
+                 collapsed=True,
+                 W_sampler="cholesky", cg_tol=1e-8):
         self.N, self.B = N, B
+        self.collapsed = collapsed
+        assert W_sampler in ("cholesky", "cg")
+        self.W_sampler = W_sampler
+        self.cg_tol = cg_tol
 
         # Initialize the hyperparameters
+        self._self_prior = None
         self.rho = rho
         self.mu_w = mu_w
         self.mu_b = mu_b
@@ -92,22 +151,113 @@ class _SparseScalarRegressionBase(GibbsSampling):
         self.b = npr.multivariate_normal(self.mu_b, self.S_b)
 
     # Properties
+    def _assign(self, name, value, shape, dtype=float):
+        """
+        Copy a value into the storage of a parameter. The storage is
+        allocated on first assignment, and may later be replaced by a
+        view into a model's parameter store (see 'bind').
+        """
+        current = getattr(self, name, None)
+        if current is None:
+            setattr(self, name, np.array(np.broadcast_to(value, shape), dtype=dtype))
+        else:
+            current[...] = value
+
+    def bind(self, a, W, b, rho=None, copy=True):
+        """
+        Keep the parameters in the given arrays, e.g. rows of the
+        contiguous arrays owned by a NonlinearAutoregressiveModel,
+        instead of arrays of our own. The current values are copied over.
+
+        :param a:    N boolean array for the indicators
+        :param W:    NxB array for the weights
+        :param b:    length 1 array for the bias
+        :param rho:  Optional N array for the connection probabilities
+        :param copy: If False, the arrays already hold the parameters,
+                     e.g. after 'release'.
+        """
+        assert a.shape == (self.N,) and W.shape == (self.N, self.B) and b.shape == (1,)
+        if copy:
+            a[...], W[...], b[...] = self.a, self.W, self.b
+        self._a, self._W, self._b = a, W, b
+        if rho is not None:
+            assert rho.shape == (self.N,)
+            if copy:
+                rho[...] = self.rho
+            self._rho = rho
+
+    def release(self):
+        """
+        Drop the storage of the parameters, e.g. when a model keeps them
+        in sparse form and only binds them while the regression is in use.
+        """
+        self._a = self._W = self._b = self._rho = None
+        self._active_cache = (None, None)
+
+    @property
+    def workspace(self):
+        """
+        Scratch buffers reused by the sufficient statistics across
+        iterations. Regressions are resampled one at a time, so all the
+        regressions of a thread share one workspace rather than each
+        keeping a (time bins x NB) buffer alive.
+        """
+        ws = getattr(_shared_workspace, "workspace", None)
+        if ws is None:
+            ws = _shared_workspace.workspace = Workspace()
+        return ws
+
+    @property
+    def a(self):
+        return self._a
+
+    @a.setter
+    def a(self, value):
+        self._assign("_a", value, (self.N,), dtype=bool)
+
+    @property
+    def W(self):
+        return self._W
+
+    @W.setter
+    def W(self, value):
+        self._assign("_W", value, (self.N, self.B))
+
+    @property
+    def b(self):
+        return self._b
+
+    @b.setter
+    def b(self, value):
+        self._assign("_b", value, (1,))
+
     @property
     def rho(self):
         return self._rho
 
     @rho.setter
     def rho(self, value):
-        self._rho = expand_scalar(value, (self.N,))
+        self._assign("_rho", expand_scalar(value, (self.N,)), (self.N,))
 
     @property
     def mu_w(self):
-        return self._mu_w
+        if self._self_prior is None:
+            return self._mu_w
+
+        n, mu_self, _ = self._self_prior
+        mu_w = self._mu_w.copy()
+        mu_w[n] = mu_self
+        return mu_w
 
     @mu_w.setter
     def mu_w(self, value):
         N, B = self.N, self.B
-        self._mu_w = expand_scalar(value, (N, B))
+        if np.isscalar(value) or np.shape(value) == (B,):
+            # Shared by all groups; store a read-only view
+            self._mu_w = np.broadcast_to(expand_scalar(value, (B,)), (N, B))
+        else:
+            self._mu_w = expand_scalar(value, (N, B))
+        self._self_prior = None
 
     @property
     def mu_b(self):
@@ -119,12 +269,37 @@ class _SparseScalarRegressionBase(GibbsSampling):
 
     @property
     def S_w(self):
-        return self._S_w
+        if self._self_prior is None:
+            return self._S_w
+
+        n, _, S_self = self._self_prior
+        S_w = self._S_w.copy()
+        S_w[n] = S_self
+        return S_w
 
     @S_w.setter
     def S_w(self, value):
         N, B = self.N, self.B
-        self._S_w = expand_cov(value, (N, B, B))
+        if np.isscalar(value) or np.shape(value) == (B, B):
+            # Shared by all groups; store a read-only view
+            self._S_w = np.broadcast_to(expand_cov(value, (B, B)), (N, B, B))
+        else:
+            self._S_w = expand_cov(value, (N, B, B))
+        self._self_prior = None
+
+    def set_weight_prior(self, mu_w, S_w, self_index=None, mu_self=None, S_self=None):
+        """
+        Set a factored prior on the weights without materializing
+        N copies of it. All groups share the mean mu_w (B) and the
+        covariance S_w (BxB), except for group 'self_index', which
+        uses mu_self and S_self if they are given.
+        """
+        self.mu_w = mu_w
+        self.S_w = S_w
+        if self_index is not None and mu_self is not None:
+            self._self_prior = (self_index,
+                                expand_scalar(mu_self, (self.B,)),
+                                expand_cov(S_self, (self.B, self.B)))
 
     @property
     def S_b(self):
@@ -139,21 +314,51 @@ class _SparseScalarRegressionBase(GibbsSampling):
     def natural_params(self):
         # Compute information form parameters
         N, B = self.N, self.B
-        J_w = np.zeros((N, B, B))
-        h_w = np.zeros((N, B))
-        for n in range(N):
-            J_w[n] = np.linalg.inv(self.S_w[n])
-            h_w[n] = J_w[n].dot(self.mu_w[n])
+        if self._mu_w.strides[0] == 0 and self._S_w.strides[0] == 0:
+            # The groups share their prior, so we only need one inverse
+            J = np.linalg.inv(self._S_w[0])
+            J_w = np.broadcast_to(J, (N, B, B))
+            h_w = np.broadcast_to(J.dot(self._mu_w[0]), (N, B))
+        else:
+            J_w = np.zeros((N, B, B))
+            h_w = np.zeros((N, B))
+            for n in range(N):
+                J_w[n] = np.linalg.inv(self._S_w[n])
+                h_w[n] = J_w[n].dot(self._mu_w[n])
+
+        if self._self_prior is not None:
+            n, mu_self, S_self = self._self_prior
+            J_w, h_w = J_w.copy(), h_w.copy()
+            J_w[n] = np.linalg.inv(S_self)
+            h_w[n] = J_w[n].dot(mu_self)
 
         J_b = np.linalg.inv(self.S_b)
         h_b = J_b.dot(self.mu_b)
 
         return J_w, h_w, J_b, h_b
 
+    @property
+    def parameters(self):
+        """
+        A copy of the current sample of the model parameters.
+        """
+        return dict(a=self.a.copy(), W=self.W.copy(), b=self.b.copy())
+
+    @parameters.setter
+    def parameters(self, value):
+        self.a[:] = value["a"]
+        self.W[:] = value["W"]
+        self.b[:] = value["b"]
+
     @property
     def deterministic_sparsity(self):
         return np.all((self.rho < 1e-6) | (self.rho > 1-1e-6))
 
+    # The likelihood is raised to this power when resampling, which
+    # flattens the posterior for tempered replicas (see pyglm.tempering).
+    # The log likelihood itself is never tempered.
+    inv_temperature = 1.0
+
     @abc.abstractmethod
     def omega(self, X, y):
         """
@@ -192,13 +397,39 @@ class _SparseScalarRegressionBase(GibbsSampling):
         X = self._flatten_X(X)
         return X, y
 
+    # Above this fraction of active inputs, it is cheaper to contract
+    # all of X with BLAS than to visit the active columns one by one.
+    dense_activation_fraction = 0.2
+
+    def _active_columns(self):
+        """
+        Indices of the columns of the flattened X that belong to active
+        groups. These are cached and only recomputed when 'a' changes.
+        """
+        a_prev, cols = getattr(self, "_active_cache", (None, None))
+        if a_prev is None or not np.array_equal(a_prev, self.a):
+            B = self.B
+            act = np.where(self.a)[0]
+            cols = (act[:, None] * B + np.arange(B)).ravel()
+            self._active_cache = (self.a.copy(), cols)
+        return cols
+
     def activation(self, X):
         N, B = self.N, self.B
         X = self._flatten_X(X)
-
-        W = np.reshape((self.a[:, None] * self.W), (N * B,))
         b = self.b[0]
-        return X.dot(W) + b
+
+        cols = self._active_columns()
+        if cols.size > self.dense_activation_fraction * N * B:
+            W = np.reshape((self.a[:, None] * self.W), (N * B,))
+            return _matvec(X, W) + b
+
+        # Only visit the inputs of the active groups
+        psi = np.empty(X.shape[0])
+        psi.fill(b)
+        for c, w in zip(cols, np.take(self.W.ravel(), cols)):
+            psi += w * X[:, c]
+        return psi
 
     @abc.abstractmethod
     def mean(self, X):
@@ -222,21 +453,78 @@ class _SparseScalarRegressionBase(GibbsSampling):
         assert h_prior.shape == (N*B+1,)
         return J_prior, h_prior
 
-    def _lkhd_sufficient_statistics(self, datas):
+    def _lkhd_sufficient_statistics(self, datas, potentials=None):
         """
         Compute the likelihood statistics (information form Gaussian
         potentials) for each dataset.  Polya-gamma regressions will
         have to override this class.
+
+        :param potentials: Optional output of _lkhd_potentials(datas),
+                           if the auxiliary variables are already drawn.
+        :return:           J_lkhd and h_lkhd. J_lkhd is a workspace buffer,
+                           overwritten by the next call in this thread,
+                           so copy it to keep it.
         """
         N, B = self.N, self.B
+        D = N*B
+        ws = self.workspace
+
+        J_lkhd = ws.get("J_lkhd", (D+1, D+1), zero=True)
+        h_lkhd = np.zeros(D+1)
+
+        if potentials is None:
+            potentials = self._lkhd_potentials(datas)
+
+        # The Gram matrix of the sqrt(omega) weighted inputs is accumulated
+        # in a reusable Fortran-ordered buffer that syrk updates in place.
+        # Only its upper triangle is computed.
+        G = ws.get("G", (D, D), order='F')
+        beta = 0.0
+        # The rows are visited in blocks, so the buffer of weighted
+        # inputs is at most ROW_BLOCK x D.
+        for X, omega, kappa in potentials:
+            for rows in _row_blocks(X.shape[0]):
+                sw = np.sqrt(omega[rows])
+                XO = ws.get("XO", (sw.size, D))
+                np.multiply(X[rows], sw[:,None], out=XO)
+                G = dsyrk(1.0, XO.T, beta=beta, c=G, trans=0, lower=0, overwrite_c=1)
+                beta = 1.0
+
+                # The last row and column correspond to the affine term
+                Xsum = ws.get("Xsum", (D,))
+                np.dot(XO.T, sw, out=Xsum)
+                J_lkhd[:D,-1] += Xsum
 
-        J_lkhd = np.zeros((N*B+1, N*B+1))
-        h_lkhd = np.zeros(N*B+1)
+            J_lkhd[-1,-1] += omega.sum()
 
-        # Compute the posterior sufficient statistics
-        for data in datas:
-            assert isinstance(data, tuple)
-            X, y = self.extract_data(data)
+            # Add the sufficient statisticcs to h_lkhd
+            h_lkhd[:D] += _rmatvec(kappa, X)
+            h_lkhd[-1] += kappa.sum()
+
+        if beta > 0:
+            # Symmetrize in place, one row of the upper triangle at a time
+            J_lkhd[:D,:D] = G
+            for i in range(1, D):
+                J_lkhd[i,:i] = J_lkhd[:i,i]
+            J_lkhd[-1,:D] = J_lkhd[:D,-1]
+
+        return J_lkhd, h_lkhd
+
+    @staticmethod
+    def _chunks(data):
+        """
+        A dataset is either an (X, y) tuple or an iterable of (X, y)
+        chunks, e.g. a column of a pyglm.utils.data.ChunkedDataset.
+        """
+        return [data] if isinstance(data, tuple) else data
+
+    def _lkhd_potentials(self, datas):
+        """
+        Yield the flattened inputs along with the precision and
+        the normalized observations of each dataset (or chunk thereof).
+        """
+        for chunk in (c for data in datas for c in self._chunks(data)):
+            X, y = self.extract_data(chunk)
             T = X.shape[0]
 
             # Get the precision and the normalized observations
@@ -245,47 +533,92 @@ class _SparseScalarRegressionBase(GibbsSampling):
             kappa = self.kappa(X,y)
             assert kappa.shape == (T,)
 
-            # Add the sufficient statistics to J_lkhd
-            # The last row and column correspond to the
-            # affine term
-            XO = X * omega[:,None]
-            J_lkhd[:N*B, :N*B] += XO.T.dot(X)
-            Xsum = XO.sum(0)
-            J_lkhd[:N*B,-1] += Xsum
-            J_lkhd[-1,:N*B] += Xsum
-            J_lkhd[-1,-1] += omega.sum()
+            yield X, omega, kappa
 
-            # Add the sufficient statisticcs to h_lkhd
-            h_lkhd[:N*B] += kappa.T.dot(X)
-            h_lkhd[-1] += kappa.sum()
+    ### Gibbs sampling
+    @property
+    def uses_gram_statistics(self):
+        """
+        Whether 'resample' can use precomputed Gram statistics of the
+        inputs (see pyglm.utils.basis.basis_gram_statistics) in place
+        of the data. Only possible when the precision omega is fixed.
+        """
+        return False
 
-        return J_lkhd, h_lkhd
+    def _gram_sufficient_statistics(self, stats):
+        raise NotImplementedError
+
+    @staticmethod
+    def _is_remote(data):
+        """
+        Datasets held elsewhere, e.g. a column of a
+        pyglm.sharded.ShardedDataset, compute their own likelihood
+        potentials and residuals for this regression.
+        """
+        return hasattr(data, "sufficient_statistics")
+
+    def resample(self, datas, stats=None):
+        """
+        :param stats:  Optional Gram statistics of the data,
+                       if uses_gram_statistics is True.
+        """
+        remote = [data for data in datas if self._is_remote(data)]
+        if remote:
+            assert self.W_sampler == "cholesky" and \
+                   (self.collapsed or self.deterministic_sparsity), \
+                "Remote datasets need the collapsed Cholesky sampler"
+            datas = [data for data in datas if not self._is_remote(data)]
+
+        if self.W_sampler == "cg":
+            self._matrix_free_resample(datas)
+            return
+
+        if not self.collapsed and not self.deterministic_sparsity:
+            self._uncollapsed_resample(list(self._lkhd_potentials(datas)))
+            return
 
-    ### Gibbs sampling
-    def resample(self, datas):
         # Compute the prior and posterior sufficient statistics of W
         J_prior, h_prior = self._prior_sufficient_statistics()
-        J_lkhd, h_lkhd = self._lkhd_sufficient_statistics(datas)
+        if stats is not None:
+            potentials = None
+            J_lkhd, h_lkhd = self._gram_sufficient_statistics(stats)
+        else:
+            # Reduce the potentials of the remote datasets first, since
+            # workers in this thread share our workspace
+            remote_stats = [data.sufficient_statistics(self) for data in remote]
+
+            potentials = list(self._lkhd_potentials(datas))
+            J_lkhd, h_lkhd = self._lkhd_sufficient_statistics(datas, potentials=potentials)
+            for J, h in remote_stats:
+                J_lkhd += J
+                h_lkhd += h
 
         J_post = J_prior + J_lkhd
         h_post = h_prior + h_lkhd
 
+        # With fewer observations than weights, keep the observations
+        # around so we can work in the dual (observation) space
+        obs = None
+        T = 0 if potentials is None else sum(X.shape[0] for X, _, _ in potentials)
+        if not remote and 0 < T < self.N * self.B + 1:
+            obs = self._dual_observations(potentials)
+
         # Resample a
         if self.deterministic_sparsity:
             self.a = np.round(self.rho).astype(bool)
         else:
-            self._collapsed_resample_a(J_prior, h_prior, J_post, h_post)
+            self._collapsed_resample_a(J_prior, h_prior, J_post, h_post, obs=obs)
 
         # Resample weights
-        self._resample_W(J_post, h_post)
+        self._resample_W(J_post, h_post, obs=obs)
 
-    def _collapsed_resample_a(self, J_prior, h_prior, J_post, h_post):
+    def _collapsed_resample_a(self, J_prior, h_prior, J_post, h_post, obs=None):
         """
         """
         N, B, rho = self.N, self.B, self.rho
         perm = npr.permutation(self.N)
 
-        ml_prev = self._marginal_likelihood(J_prior, h_prior, J_post, h_post)
+        ml_prev = self._marginal_likelihood(J_prior, h_prior, J_post, h_post, obs=obs)
         for n in perm:
             # TODO: Check if rho is deterministic
 
@@ -301,7 +634,7 @@ class _SparseScalarRegressionBase(GibbsSampling):
             v_new = 1 - v_prev
             self.a[n] = v_new
 
-            ml_new = self._marginal_likelihood(J_prior, h_prior, J_post, h_post)
+            ml_new = self._marginal_likelihood(J_prior, h_prior, J_post, h_post, obs=obs)
 
             lps[v_new] += ml_new
             lps[v_new] += v_new * np.log(rho[n]) + (1-v_new) * np.log(1-rho[n])
@@ -320,11 +653,141 @@ class _SparseScalarRegressionBase(GibbsSampling):
                 ml_prev = ml_new
 
 
-    def _resample_W(self, J_post, h_post):
+    def _matrix_free_resample(self, datas):
+        potentials = list(self._lkhd_potentials(datas))
+
+        # Resample a
+        if self.deterministic_sparsity:
+            self.a = np.round(self.rho).astype(bool)
+        else:
+            self._uncollapsed_resample(potentials)
+
+        # Resample weights
+        self._cg_resample_W(potentials)
+
+    def _uncollapsed_resample(self, potentials):
+        """
+        Resample each (a_n, w_n) pair jointly, holding the other groups
+        fixed, and then the bias. We keep the residual of each dataset
+        up to date as the weights change, so each group only touches
+        its own B columns of the inputs.
+        """
+        N, B, rho = self.N, self.B, self.rho
+        J_w, h_w, J_b, h_b = self.natural_params
+
+        # Compute the residual of the normalized observations, kappa / omega,
+        # which have precision omega under the augmented model.
+        resids = []
+        for X, omega, kappa in potentials:
+            resids.append((X, omega, kappa / omega - self.activation(X)))
+
+        for n in npr.permutation(N):
+            cols = slice(n*B, (n+1)*B)
+
+            # Compute the conditional posterior of w_n without its own contribution
+            J, h = J_w[n].copy(), h_w[n].copy()
+            for X, omega, r in resids:
+                Xn = X[:, cols]
+                if self.a[n]:
+                    r += Xn.dot(self.W[n])
+                XO = Xn * omega[:, None]
+                J += XO.T.dot(Xn)
+                h += XO.T.dot(r)
+
+            # Sample a_n with w_n integrated out
+            L0 = np.linalg.cholesky(J_w[n])
+            Lp = np.linalg.cholesky(J)
+            ml = 0
+            ml -= np.sum(np.log(np.diag(Lp)))
+            ml += np.sum(np.log(np.diag(L0)))
+            ml += 0.5*h.T.dot(dpotrs(Lp, h, lower=True)[0])
+            ml -= 0.5*h_w[n].T.dot(dpotrs(L0, h_w[n], lower=True)[0])
+
+            lps = np.array([np.log(1-rho[n]), np.log(rho[n]) + ml])
+            self.a[n] = sample_discrete_from_log(lps)
+
+            # Sample w_n and put its contribution back into the residual
+            self.W[n] = sample_gaussian(J=J, h=h) if self.a[n] else 0
+            if self.a[n]:
+                for X, omega, r in resids:
+                    r -= X[:, cols].dot(self.W[n])
+
+        # Resample the bias
+        J, h = J_b.copy(), h_b.copy()
+        for X, omega, r in resids:
+            r += self.b[0]
+            J += omega.sum()
+            h += omega.dot(r)
+        self.b = sample_gaussian(J=J, h=h)
+
+    def _cg_resample_W(self, potentials):
+        """
+        Resample the active weights and the bias by perturb-and-solve.
+        If u ~ N(h, J) then J^{-1} u is a draw from the Gaussian with
+        precision J and potential h. We perturb the prior and each
+        observation separately and solve with conjugate gradients,
+        preconditioned by the B x B diagonal blocks of J.
+        """
+        N, B = self.N, self.B
+        J_w, h_w, J_b, h_b = self.natural_params
+        act = np.where(self.a)[0]
+        K = act.size
+        J_w = np.array(J_w[act])
+
+        # Perturb the prior potentials and compute the diagonal blocks
+        u_w = h_w[act] + np.einsum('kij,kj->ki', np.linalg.cholesky(J_w), npr.randn(K, B))
+        u_b = h_b[0] + np.sqrt(J_b[0,0]) * npr.randn()
+        J_diag = J_w.copy()
+        J_bb = J_b[0,0]
+
+        # Perturb the likelihood potentials
+        for X, omega, kappa in potentials:
+            T = X.shape[0]
+            X3 = X.reshape((T, N, B))
+            e = kappa + np.sqrt(omega) * npr.randn(T)
+            u_w += _rmatvec(e, X).reshape((N, B))[act]
+            u_b += e.sum()
+            for rows in _row_blocks(T):
+                J_diag += np.einsum('tnb,tnc,t->nbc', X3[rows], X3[rows], omega[rows])[act]
+            J_bb += omega.sum()
+
+        def J_dot(v):
+            V = np.zeros((N, B))
+            V[act] = v[:-1].reshape((K, B))
+            out = np.zeros(K*B+1)
+            out[:-1] = np.einsum('kij,kj->ki', J_w, V[act]).ravel()
+            out[-1] = J_b[0,0] * v[-1]
+            for X, omega, kappa in potentials:
+                p = omega * (_matvec(X, V.ravel()) + v[-1])
+                out[:-1] += _rmatvec(p, X).reshape((N, B))[act].ravel()
+                out[-1] += p.sum()
+            return out
+
+        J_diag_inv = np.linalg.inv(J_diag)
+        def M_dot(v):
+            out = np.empty_like(v)
+            out[:-1] = np.einsum('kij,kj->ki', J_diag_inv, v[:-1].reshape((K, B))).ravel()
+            out[-1] = v[-1] / J_bb
+            return out
+
+        # Solve, warm starting from the current sample
+        u = np.concatenate((u_w.ravel(), [u_b]))
+        x0 = np.concatenate((self.W[act].ravel(), self.b))
+        W = pcg(J_dot, u, M=M_dot, x0=x0, tol=self.cg_tol)
+
+        # Set bias and weights
+        self.W *= 0
+        self.W[act, :] = W[:-1].reshape((K, B))
+        self.b = np.reshape(W[-1], (1,))
+
+    def _resample_W(self, J_post, h_post, obs=None):
         """
         Resample the weight of a connection (synapse)
         """
         N, B = self.N, self.B
+        if self._use_dual(obs):
+            self._dual_resample_W(obs)
+            return
 
         a = np.concatenate((np.repeat(self.a, self.B), [1])).astype(np.bool)
         Jp = J_post[np.ix_(a, a)]
@@ -340,10 +803,13 @@ class _SparseScalarRegressionBase(GibbsSampling):
         self.b = np.reshape(W[-1], (1,))
 
 
-    def _marginal_likelihood(self, J_prior, h_prior, J_post, h_post):
+    def _marginal_likelihood(self, J_prior, h_prior, J_post, h_post, obs=None):
         """
         Compute the marginal likelihood as the ratio of log normalizers
         """
+        if self._use_dual(obs):
+            return self._dual_marginal_likelihood(obs)
+
         a = np.concatenate((np.repeat(self.a, self.B), [1])).astype(np.bool)
 
         # Extract the entries for which A=1
@@ -377,6 +843,83 @@ class _SparseScalarRegressionBase(GibbsSampling):
 
         return ml
 
+    ### Dual (Woodbury) computations
+    # When there are fewer observations T than active weights D=|a|B+1, we
+    # can marginalize the weights in the TxT observation space instead:
+    # the pseudo-observations z = kappa / omega have marginal covariance
+    # C = Omega^{-1} + X S_0 X^T, which costs O(T^2 D + T^3) instead of O(D^3).
+    def _dual_observations(self, potentials):
+        X = np.vstack([X for X, _, _ in potentials])
+        omega = np.concatenate([omega for _, omega, _ in potentials])
+        kappa = np.concatenate([kappa for _, _, kappa in potentials])
+        return X, omega, kappa, self.mu_w, self.S_w
+
+    def _use_dual(self, obs):
+        return obs is not None and obs[0].shape[0] < self.a.sum() * self.B + 1
+
+    def _dual_covariance(self, obs):
+        """
+        Compute the marginal covariance of the pseudo-observations and
+        their residual under the prior mean.
+        """
+        N, B = self.N, self.B
+        X, omega, kappa, mu_w, S_w = obs
+        T = X.shape[0]
+        act = np.where(self.a)[0]
+
+        Xa = X.reshape((T, N, B))[:, act, :]
+        XS = np.einsum('tkb,kbc->tkc', Xa, S_w[act])
+        C = XS.reshape((T, -1)).dot(Xa.reshape((T, -1)).T)
+        C += self.S_b[0,0]
+        C[np.diag_indices(T)] += 1. / omega
+
+        resid = kappa / omega - Xa.reshape((T, -1)).dot(mu_w[act].ravel()) - self.mu_b[0]
+        return C, resid, Xa, XS
+
+    def _dual_marginal_likelihood(self, obs):
+        """
+        Compute the marginal likelihood with the matrix determinant lemma.
+        The result equals the primal ratio of log normalizers, so the two
+        can be compared directly.
+        """
+        X, omega, kappa, _, _ = obs
+        C, resid, _, _ = self._dual_covariance(obs)
+        L = np.linalg.cholesky(C)
+        x = solve_triangular(L, resid, lower=True)
+
+        ml = 0
+        ml -= np.sum(np.log(np.diag(L)))
+        ml -= 0.5 * x.dot(x)
+
+        # Remove the terms of log N(z | X mu, C) that the primal form drops
+        ml -= 0.5 * np.sum(np.log(omega))
+        ml += 0.5 * np.sum(kappa**2 / omega)
+        return ml
+
+    def _dual_resample_W(self, obs):
+        """
+        Sample the weights by drawing from the prior and correcting
+        with a TxT solve (Matheron's rule).
+        """
+        B = self.B
+        X, omega, kappa, mu_w, S_w = obs
+        T = X.shape[0]
+        act = np.where(self.a)[0]
+        C, _, Xa, XS = self._dual_covariance(obs)
+
+        # Draw from the prior and simulate pseudo-observations
+        u_w = mu_w[act] + np.einsum('kij,kj->ki', np.linalg.cholesky(S_w[act]), npr.randn(act.size, B))
+        u_b = self.mu_b[0] + np.sqrt(self.S_b[0,0]) * npr.randn()
+        v = Xa.reshape((T, -1)).dot(u_w.ravel()) + u_b + npr.randn(T) / np.sqrt(omega)
+
+        # Condition on the actual pseudo-observations
+        w = dpotrs(np.linalg.cholesky(C), kappa / omega - v, lower=True)[0]
+
+        # Set bias and weights
+        self.W *= 0
+        self.W[act, :] = u_w + np.einsum('tkc,t->kc', XS, w)
+        self.b = np.reshape(u_b + self.S_b[0,0] * w.sum(), (1,))
+
 class SparseGaussianRegression(_SparseScalarRegressionBase):
     """
     The standard case of a sparse regression with Gaussian observations.
@@ -397,11 +940,27 @@ class SparseGaussianRegression(_SparseScalarRegressionBase):
             # Sample eta from its inverse gamma prior
             self.eta = sample_invgamma(self.a_0, self.b_0)
 
-    def log_likelihood(self, x):
-        N, B, eta = self.N, self.B, self.eta
+    @property
+    def parameters(self):
+        params = super(SparseGaussianRegression, self).parameters
+        params["eta"] = self.eta
+        return params
+
+    @parameters.setter
+    def parameters(self, value):
+        _SparseScalarRegressionBase.parameters.fset(self, value)
+        self.eta = value["eta"]
 
+    def log_likelihood(self, x, psi=None, eta=None):
+        """
+        :param psi: Optional precomputed activation. May have extra leading
+                    dimensions (e.g. one row per particle or sample).
+        :param eta: Optional noise variance, broadcast against psi.
+        """
         X, y = self.extract_data(x)
-        return -0.5 * np.log(2*np.pi*eta) -0.5 * (y-self.mean(X))**2 / eta
+        psi = self.mean(X) if psi is None else psi
+        eta = self.eta if eta is None else eta
+        return -0.5 * np.log(2*np.pi*eta) -0.5 * (y-psi)**2 / eta
 
     def rvs(self,size=[], X=None, psi=None):
         N, B = self.N, self.B
@@ -418,29 +977,67 @@ class SparseGaussianRegression(_SparseScalarRegressionBase):
 
     def omega(self, X, y):
         T = X.shape[0]
-        return 1./self.eta * np.ones(T)
+        return self.inv_temperature / self.eta * np.ones(T)
 
     def kappa(self, X, y):
-        return y / self.eta
+        return self.inv_temperature * y / self.eta
+
+    @property
+    def uses_gram_statistics(self):
+        return self.W_sampler == "cholesky" and \
+               (self.collapsed or self.deterministic_sparsity)
 
-    def resample(self, datas):
-        super(SparseGaussianRegression, self).resample(datas)
-        self._resample_eta(datas)
+    def _gram_sufficient_statistics(self, stats):
+        """
+        Likelihood potentials from the Gram statistics of the data:
+        a dict with the NBxNB Gram matrix XX, the NB input sums X1,
+        the NB products with the outputs Xy, the number of
+        observations T, and the sums ysum and yty of y and y**2.
+        """
+        D = self.N * self.B
+        J_lkhd = np.empty((D+1, D+1))
+        J_lkhd[:D, :D] = stats["XX"]
+        J_lkhd[:D, -1] = J_lkhd[-1, :D] = stats["X1"]
+        J_lkhd[-1, -1] = stats["T"]
+        J_lkhd *= self.inv_temperature / self.eta
+
+        h_lkhd = np.concatenate((stats["Xy"], [stats["ysum"]])) * (self.inv_temperature / self.eta)
+        return J_lkhd, h_lkhd
+
+    def resample(self, datas, stats=None):
+        super(SparseGaussianRegression, self).resample(datas, stats=stats)
+        self._resample_eta(datas, stats=stats)
 
     def mean(self, X):
         return self.activation(X)
 
-    def _resample_eta(self, datas):
+    def _resample_eta(self, datas, stats=None):
         N, B = self.N, self.B
 
         alpha = self.a_0
         beta = self.b_0
+        if stats is not None:
+            # Expand the residual sum of squares in terms of the statistics
+            w = np.concatenate(((self.a[:, None] * self.W).ravel(), self.b))
+            J, h = self._gram_sufficient_statistics(stats)
+            alpha += self.inv_temperature * stats["T"] / 2.0
+            beta += self.inv_temperature * stats["yty"] + self.eta * (w.dot(J).dot(w) - 2 * w.dot(h))
+            self.eta = sample_invgamma(alpha, beta)
+            return
+
         for data in datas:
-            X, y = self.extract_data(data)
+            if self._is_remote(data):
+                T, ssq = data.residual_statistics(self)
+                alpha += self.inv_temperature * T / 2.0
+                beta += self.inv_temperature * ssq
+
+        local = [data for data in datas if not self._is_remote(data)]
+        for chunk in (c for data in local for c in self._chunks(data)):
+            X, y = self.extract_data(chunk)
             T = X.shape[0]
 
-            alpha += T / 2.0
-            beta += np.sum((y-self.mean(X))**2)
+            alpha += self.inv_temperature * T / 2.0
+            beta += self.inv_temperature * np.sum((y-self.mean(X))**2)
 
         self.eta = sample_invgamma(alpha, beta)
 
@@ -464,13 +1061,45 @@ class _SparsePGRegressionBase(_SparseScalarRegressionBase):
     - SparseBernoulliRegression
     - SparseBinomialRegression
     - SparseNegativeBinomialRegression
+
+    The Polya-gamma variables are drawn exactly by default. Since
+    PG(b, c) is a sum of b independent PG(1, c) variables, it tends to a
+    normal as b grows, and for large shape parameters (e.g. aggregated
+    counts) a moment-matched normal draw is much cheaper. With
+    pg_method="normal" every draw is approximate; with pg_method="auto"
+    a bin is drawn approximately when the skewness of its PG variable,
+    which is at most 1.96 / sqrt(b), is below pg_tol. The number of
+    exact and approximate draws is tallied in 'pg_counts'.
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, N, B, **kwargs):
+    # Skewness of PG(1, 0), which bounds the skewness of PG(1, c)
+    _pg_skewness = 1.96
+
+    def __init__(self, N, B, pg_method="exact", pg_tol=0.1, **kwargs):
+        """
+        :param pg_method:  "exact", "normal" or "auto"
+        :param pg_tol:     Largest skewness of a PG variable that the
+                           "auto" method approximates with a normal
+        """
         super(_SparsePGRegressionBase, self).__init__(N, B, **kwargs)
+        assert pg_method in ("exact", "normal", "auto")
+        self.pg_method = pg_method
+        self.pg_tol = pg_tol
+        self.pg_counts = dict(exact=0, normal=0)
 
         # Initialize Polya-gamma samplers
+        self.ppgs = None
+        if pg_method != "normal":
+            self._init_ppgs()
+
+    def __getstate__(self):
+        # The samplers are reseeded lazily after unpickling
+        state = self.__dict__.copy()
+        state["ppgs"] = None
+        return state
+
+    def _init_ppgs(self):
         import pypolyagamma as ppg
         num_threads = ppg.get_omp_num_threads()
         seeds = npr.randint(2 ** 16, size=num_threads)
@@ -488,9 +1117,14 @@ class _SparsePGRegressionBase(_SparseScalarRegressionBase):
     def c_func(self, y):
         raise NotImplementedError
 
-    def log_likelihood(self, x):
+    def log_likelihood(self, x, psi=None):
+        """
+        :param psi: Optional precomputed activation. May have extra leading
+                    dimensions (e.g. one row per particle or sample).
+        """
         X, y = self.extract_data(x)
-        psi = self.activation(X)
+        if psi is None:
+            psi = self.activation(X)
         return np.log(self.c_func(y)) + self.a_func(y) * psi - self.b_func(y) * np.log1p(np.exp(psi))
 
     def omega(self, X, y):
@@ -498,20 +1132,84 @@ class _SparsePGRegressionBase(_SparseScalarRegressionBase):
         In the Polya-gamma augmentation, the precision is
         given by an auxiliary variable that we must sample
         """
-        import pypolyagamma as ppg
-        psi = self.activation(X)
-        omega = np.zeros(y.size)
-        ppg.pgdrawvpar(self.ppgs,
-                       self.b_func(y).ravel(),
-                       psi.ravel(),
-                       omega)
+        psi = self.activation(X).ravel()
+        b = self.inv_temperature * np.broadcast_to(self.b_func(y), y.shape).ravel()
+        omega = self.draw_pg(b, psi)
         return omega.reshape(y.shape)
 
     def kappa(self, X, y):
-        return self.a_func(y) - self.b_func(y) / 2.0
+        return self.inv_temperature * (self.a_func(y) - self.b_func(y) / 2.0)
+
+    def draw_pg(self, b, psi):
+        """
+        Draw omega ~ PG(b, psi) elementwise with this regression's
+        pg_method, for flat arrays of shapes and activations.
+        """
+        size = psi.size
+        omega = np.zeros(size)
+
+        if self.pg_method == "normal":
+            approx = np.ones(size, dtype=bool)
+        elif self.pg_method == "auto":
+            approx = self._pg_skewness / np.sqrt(b) < self.pg_tol
+        else:
+            approx = np.zeros(size, dtype=bool)
+
+        n_approx = approx.sum()
+        if n_approx > 0:
+            omega[approx] = sample_pg_normal(b[approx], psi[approx])
+
+        if n_approx < size:
+            import pypolyagamma as ppg
+            if self.ppgs is None:
+                self._init_ppgs()
+
+            if n_approx == 0:
+                ppg.pgdrawvpar(self.ppgs, np.ascontiguousarray(b, dtype=float),
+                               np.ascontiguousarray(psi, dtype=float), omega)
+            else:
+                exact = ~approx
+                omega_exact = np.zeros(size - n_approx)
+                ppg.pgdrawvpar(self.ppgs, b[exact].astype(float), psi[exact], omega_exact)
+                omega[exact] = omega_exact
+
+        self.pg_counts["normal"] += n_approx
+        self.pg_counts["exact"] += size - n_approx
+        return omega
 
 
 class SparseBernoulliRegression(_SparsePGRegressionBase):
+    """
+    Sparse logistic regression for binary spike trains.
+
+    Most time bins of a spike train are silent, yet each costs a Polya-
+    gamma draw and a row of the Gram matrix. With case_control=f, every
+    sweep keeps the bins with a spike and a fresh random fraction f of
+    the silent bins, and corrects the likelihood of the subsample with
+    either
+
+    - "offset": the exact likelihood of the subsample given that a bin
+      was kept, which is logistic with the activation shifted by -log f.
+      The auxiliary variables are drawn at the shifted activation, and
+      the shift is folded into the normalized observations, or
+    - "weight": the likelihood of each kept silent bin raised to the
+      power 1/f, an unbiased estimate of the full log likelihood.
+      The auxiliary variables are PG(1/f, psi) for those bins.
+
+    See case_control_variance for the cost in precision.
+    """
+    def __init__(self, N, B, case_control=None, case_control_correction="offset", **kwargs):
+        """
+        :param case_control:             Fraction of the silent bins to keep
+                                         in each sweep, or None to keep all
+        :param case_control_correction:  "offset" or "weight"
+        """
+        super(SparseBernoulliRegression, self).__init__(N, B, **kwargs)
+        assert case_control is None or 0 < case_control <= 1
+        assert case_control_correction in ("offset", "weight")
+        self.case_control = case_control
+        self.case_control_correction = case_control_correction
+
     def a_func(self, data):
         return data
 
@@ -540,6 +1238,89 @@ class SparseBernoulliRegression(_SparsePGRegressionBase):
 
         return y
 
+    def _lkhd_potentials(self, datas):
+        if self.case_control is None or self.case_control == 1:
+            for potential in super(SparseBernoulliRegression, self)._lkhd_potentials(datas):
+                yield potential
+            return
+
+        f = self.case_control
+        for chunk in (c for data in datas for c in self._chunks(data)):
+            X, y = self.extract_data(chunk)
+            y = np.ravel(y)
+            keep = (y > 0) | (npr.rand(y.size) < f)
+            X, y = X[keep], y[keep]
+
+            psi = self.activation(X)
+            if self.case_control_correction == "offset":
+                offset = -np.log(f)
+                b = self.inv_temperature * np.ones(y.size)
+                omega = self.draw_pg(b, psi + offset)
+                kappa = self.inv_temperature * (y - 0.5) - omega * offset
+            else:
+                w = np.where(y > 0, 1.0, 1.0 / f)
+                omega = self.draw_pg(self.inv_temperature * w, psi)
+                kappa = self.inv_temperature * w * (y - 0.5)
+
+            yield X, omega, kappa
+
+    def case_control_variance(self, datas, case_control=None, correction=None):
+        """
+        The cost of case-control subsampling at the current parameters.
+        Compares the asymptotic (sandwich) variances of the active weights
+        and the bias when fitting every bin and when fitting a subsample,
+        in expectation over the subsamples.
+
+        :param datas:         The regression's data, as for 'resample'
+        :param case_control:  Fraction of silent bins to keep.
+                              Defaults to self.case_control.
+        :param correction:    "offset" or "weight". Defaults to
+                              self.case_control_correction.
+        :return:              dict with the expected fraction of bins
+                              kept, and the ratio of the subsampled to the
+                              full variance of each active weight (in the
+                              order of the active inputs) and of the bias
+        """
+        f = self.case_control if case_control is None else case_control
+        correction = self.case_control_correction if correction is None else correction
+        assert f is not None and correction in ("offset", "weight")
+
+        cols = self._active_columns()
+        D = cols.size + 1
+        H, V, H_cc, V_cc = [np.zeros((D, D)) for _ in range(4)]
+        kept, T = 0.0, 0
+        for chunk in (c for data in datas for c in self._chunks(data)):
+            X, y = self.extract_data(chunk)
+            y = np.ravel(y).astype(float)
+            psi = self.activation(X)
+            Z = np.column_stack((X[:, cols], np.ones(y.size)))
+
+            # Probability that each bin is kept
+            pi = np.where(y > 0, 1.0, f)
+            kept += pi.sum()
+            T += y.size
+
+            p = logistic(psi)
+            H += (Z * (p * (1 - p))[:, None]).T.dot(Z)
+            V += (Z * ((y - p)**2)[:, None]).T.dot(Z)
+            if correction == "offset":
+                q = logistic(psi - np.log(f))
+                H_cc += (Z * (pi * q * (1 - q))[:, None]).T.dot(Z)
+                V_cc += (Z * (pi * (y - q)**2)[:, None]).T.dot(Z)
+            else:
+                w = 1.0 / pi
+                H_cc += (Z * (p * (1 - p))[:, None]).T.dot(Z)
+                V_cc += (Z * (w * (y - p)**2)[:, None]).T.dot(Z)
+
+        def sandwich(H, V):
+            Hinv = np.linalg.inv(H)
+            return np.diag(Hinv.dot(V).dot(Hinv))
+
+        ratio = sandwich(H_cc, V_cc) / sandwich(H, V)
+        return dict(kept_fraction=kept / T,
+                    weight_variance_ratio=ratio[:-1],
+                    bias_variance_ratio=ratio[-1])
+
 
 class BernoulliRegression(SparseBernoulliRegression):
     """
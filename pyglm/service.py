@@ -0,0 +1,338 @@
+"""
+A long-running local service that fits GLMs on request.
+
+Starting Python, importing the libraries and convolving the data again
+for every fit is a large part of the cost of many small fits. A
+FitService keeps a pool of worker processes that have already imported
+pyglm and share a ConvolutionCache on disk, so a dataset is convolved
+with a basis once, whichever client asks for it.
+
+Clients connect to a Unix socket, which only its owner may use, and
+speak JSON lines. A request is
+
+    {"id": "job1", "op": "fit",
+     "model": "SparseBernoulliGLM",
+     "model_kwargs": {"regression_kwargs": {"S_w": 1.0}},
+     "basis": {"B": 3, "L": 50},
+     "data": ["/path/to/Y.npy"],
+     "N_samples": 100, "burnin": 50,
+     "stream": "summary", "every": 10}
+
+where "basis" holds the arguments of cosine_basis (or is an LxB nested
+list) and "data" lists .npy files of TxN spike counts. While the fit
+runs, the service sends {"id", "event": "progress", "iteration",
+"log_likelihood"} every "every" iterations, or with "stream": "samples"
+each sample of the weights, adjacency and biases, and finally
+{"id", "event": "done", "summary": ...} with the posterior means (None
+if burnin leaves no samples), or
+{"id", "event": "error", "message": ...}. The log likelihood costs a
+pass over the data, so it is only computed for the iterations that
+send an event; the summary lists those in "log_likelihoods", at the
+iterations given by "log_likelihood_iterations". Requests on one connection
+run concurrently; the events of each are tagged with its id.
+
+The same fits can be run from asyncio code in-process with
+FitService.submit, and 'fit' is a small synchronous client.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import tempfile
+import threading
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import pyglm.models
+from pyglm.utils.basis import cosine_basis
+from pyglm.utils.cache import ConvolutionCache
+
+# Set in each worker process by _init_worker
+_cache = None
+_events = None
+
+_FAILED = object()
+
+
+def _init_worker(cache_dir, events):
+    global _cache, _events
+    _cache = ConvolutionCache(cache_dir)
+    _events = events
+
+
+def _make_basis(spec):
+    if isinstance(spec, dict):
+        return cosine_basis(**spec)
+    return np.array(spec, dtype=float)
+
+
+def _run_fit(job_id, request):
+    """
+    Fit a model in a worker process, posting events as it goes.
+    """
+    try:
+        return _fit(job_id, request)
+    finally:
+        # Marks the end of this job's events
+        _events.put((job_id, None))
+
+
+def _fit(job_id, request):
+    model_class = getattr(pyglm.models, request["model"])
+    basis = _make_basis(request.get("basis", dict(B=1, L=100)))
+    N_samples = int(request.get("N_samples", 100))
+    burnin = int(request.get("burnin", N_samples // 2))
+    stream = request.get("stream", "summary")
+    every = int(request.get("every", 10))
+    if "seed" in request:
+        np.random.seed(request["seed"])
+
+    datas = [np.load(path, mmap_mode='r') for path in request["data"]]
+    N = datas[0].shape[1]
+    model = model_class(N, basis=basis, **request.get("model_kwargs", {}))
+    for Y in datas:
+        model.add_data(np.asarray(Y), cache=_cache)
+
+    tic = time.time()
+    lls, ll_itrs = [], []
+    sums = dict(weights=0, adjacency=0, biases=0)
+    streamed = stream == "samples"
+    for itr in range(N_samples):
+        model.resample_model()
+
+        # Only evaluate the likelihood and copy out the sample
+        # for the iterations that use them
+        if not streamed and (itr + 1) % every != 0 and itr < burnin:
+            continue
+        sample = dict(weights=model.weights, adjacency=model.adjacency, biases=model.biases)
+        if itr >= burnin:
+            for k in sums:
+                sums[k] = sums[k] + sample[k]
+
+        if streamed or (itr + 1) % every == 0:
+            lls.append(model.log_likelihood())
+            ll_itrs.append(itr)
+
+        if streamed:
+            event = dict((k, v.tolist()) for k, v in sample.items())
+            event.update(event="sample", iteration=itr, log_likelihood=lls[-1])
+            _events.put((job_id, event))
+        elif (itr + 1) % every == 0:
+            _events.put((job_id, dict(event="progress", iteration=itr,
+                                      log_likelihood=lls[-1])))
+
+    # With burnin >= N_samples no samples are kept, and there are no means
+    n_kept = N_samples - burnin
+    means = dict(("mean_" + k, (v / float(n_kept)).tolist() if n_kept > 0 else None)
+                 for k, v in sums.items())
+    return dict(log_likelihoods=lls,
+                log_likelihood_iterations=ll_itrs,
+                fit_time=time.time() - tic,
+                N=N, B=model.B, **means)
+
+
+class FitService(object):
+    """
+    Fit GLMs on a pool of worker processes that share a convolution cache.
+    """
+    def __init__(self, socket_path=None, processes=None, cache_dir=None):
+        """
+        :param socket_path:  Where to listen for clients (see 'serve')
+        :param processes:    Number of worker processes. Defaults to the
+                             number of CPUs.
+        :param cache_dir:    Directory of the shared ConvolutionCache.
+                             A temporary directory by default.
+        """
+        self.socket_path = socket_path
+        self.processes = processes or mp.cpu_count()
+        self.cache_dir = cache_dir or tempfile.mkdtemp(prefix="pyglm_cache_")
+
+        self._pool = None
+        self._events = None
+        self._listeners = {}
+        self._n_jobs = 0
+        self._server = None
+
+    def start(self):
+        """
+        Start the worker pool and the thread that relays their events.
+        Must be called from within the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._events = mp.Queue()
+        self._pool = ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                         initargs=(self.cache_dir, self._events))
+
+        def relay():
+            while True:
+                item = self._events.get()
+                if item is None:
+                    break
+                loop.call_soon_threadsafe(self._dispatch, *item)
+
+        self._relay = threading.Thread(target=relay)
+        self._relay.daemon = True
+        self._relay.start()
+
+    def _dispatch(self, job_id, event):
+        queue = self._listeners.get(job_id)
+        if queue is not None:
+            queue.put_nowait(event)
+
+    async def submit(self, request):
+        """
+        Run a fit and yield its events, ending with "done" or "error".
+        The request is a dict in the format of the socket protocol.
+        """
+        if self._pool is None:
+            self.start()
+
+        self._n_jobs += 1
+        job_id = self._n_jobs
+        queue = asyncio.Queue()
+        self._listeners[job_id] = queue
+
+        future = asyncio.ensure_future(
+            self._loop.run_in_executor(self._pool, _run_fit, job_id, request))
+        # The worker ends the job's events with None. If the worker
+        # died instead, the failed future ends them.
+        future.add_done_callback(
+            lambda f: queue.put_nowait(_FAILED) if f.cancelled() or f.exception() else None)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None or event is _FAILED:
+                    break
+                yield event
+
+            try:
+                summary = await future
+            except Exception:
+                summary = None
+                message = traceback.format_exc()
+            if summary is not None:
+                yield dict(event="done", summary=summary)
+            else:
+                yield dict(event="error", message=message)
+        finally:
+            del self._listeners[job_id]
+
+    async def _handle_request(self, request, writer, lock):
+        async def send(message):
+            async with lock:
+                writer.write((json.dumps(message) + "\n").encode())
+                await writer.drain()
+
+        request_id = request.get("id")
+        op = request.get("op", "fit")
+        if op == "ping":
+            await send(dict(id=request_id, event="pong"))
+        elif op == "status":
+            await send(dict(id=request_id, event="status", processes=self.processes,
+                            running=len(self._listeners), cache_dir=self.cache_dir,
+                            cache_entries=len(ConvolutionCache(self.cache_dir).entries())))
+        elif op == "fit":
+            async for event in self.submit(request):
+                event["id"] = request_id
+                await send(event)
+        else:
+            await send(dict(id=request_id, event="error",
+                            message="Unknown op: {}".format(op)))
+
+    async def _handle_client(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                except ValueError as e:
+                    writer.write((json.dumps(dict(event="error", message=str(e))) + "\n").encode())
+                    continue
+                tasks.append(asyncio.ensure_future(self._handle_request(request, writer, lock)))
+
+            # The client is done sending; finish its requests
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, asyncio.CancelledError):
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+        Listen on the Unix socket until cancelled.
+        """
+        if self._pool is None:
+            self.start()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        # Clients can make the service read any file it can, so only the
+        # owner may connect. The umask closes the window before the chmod.
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        try:
+            await self._server.serve_forever()
+        finally:
+            self._server.close()
+            self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._events.put(None)
+            self._relay.join()
+            self._pool = None
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def run(self):
+        """
+        Serve until interrupted.
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+
+def fit(socket_path, request):
+    """
+    Send one fit request to a running FitService and yield its events.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall((json.dumps(request) + "\n").encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("r") as f:
+            for line in f:
+                event = json.loads(line)
+                yield event
+                if event["event"] in ("done", "error"):
+                    break
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve GLM fits over a Unix socket")
+    parser.add_argument("socket_path")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    args = parser.parse_args()
+    FitService(args.socket_path, processes=args.processes, cache_dir=args.cache_dir).run()
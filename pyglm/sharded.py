@@ -0,0 +1,196 @@
+"""
+Datasets split into time shards that live in worker processes.
+
+Parallelizing over neurons does not help when there are few neurons
+and very many time bins. A ShardedDataset instead splits the recording
+into contiguous blocks of time, each owned by a long-lived worker (see
+pyglm.utils.parallel) that convolves its block once and keeps the
+regressors. When a regression is resampled, the workers draw the
+auxiliary variables of their own bins and return the partial likelihood
+potentials, (NB+1)x(NB+1) and (NB+1), and for Gaussian regressions the
+partial residual sums of squares. Only these and the current parameters
+cross the connection; the regressors never do.
+
+The workers are reached through multiprocessing.connection, over Unix
+sockets by default. Given (host, port) addresses of servers started with
+pyglm.utils.parallel.serve, the shards can live on other hosts; since the
+messages are pickles, such servers must be given an authkey.
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import numpy.random as npr
+
+from pyglm.utils.basis import convolve_with_basis
+from pyglm.utils.parallel import RemoteWorker, start_server, call_all
+
+
+class _Shard(object):
+    """
+    The regressors and counts of one block of time, along with copies
+    of the model's regressions to evaluate them with.
+    """
+    def __init__(self, regressions, Y, basis, pad, seed):
+        npr.seed(seed)
+        self.regressions = regressions
+
+        # The block comes with the 'pad' bins that precede it, so the
+        # regressors of its first bins see their true history
+        Y = np.asarray(Y, dtype=float)
+        self.X = convolve_with_basis(Y, basis)[pad:]
+        self.Y = np.asfortranarray(Y[pad:])
+
+    @property
+    def T(self):
+        return self.Y.shape[0]
+
+    def _regression(self, n, parameters, inv_temperature=1.0):
+        reg = self.regressions[n]
+        reg.parameters = parameters
+        reg.inv_temperature = inv_temperature
+        return reg
+
+    def sufficient_statistics(self, n, parameters, inv_temperature):
+        reg = self._regression(n, parameters, inv_temperature)
+        datas = [(self.X, self.Y[:, n])]
+        potentials = list(reg._lkhd_potentials(datas))
+        J, h = reg._lkhd_sufficient_statistics(datas, potentials=potentials)
+        # J is a workspace buffer, which a LocalWorker would share
+        return J.copy(), h
+
+    def residual_statistics(self, n, parameters):
+        reg = self._regression(n, parameters)
+        X, y = reg.extract_data((self.X, self.Y[:, n]))
+        return self.T, np.sum((y - reg.mean(X))**2)
+
+    def log_likelihood(self, parameters):
+        ll = 0
+        for n, params in enumerate(parameters):
+            reg = self._regression(n, params)
+            ll += reg.log_likelihood((self.X, self.Y[:, n])).sum()
+        return ll
+
+
+class ShardedDataset(object):
+    """
+    Spike counts split into blocks of time held by worker processes.
+    """
+    def __init__(self, Y, basis, regressions,
+                 n_shards=None,
+                 addresses=None,
+                 authkey=None,
+                 spawn=True):
+        """
+        :param Y:            TxN array of spike counts
+        :param basis:        LxB basis
+        :param regressions:  The model's regressions, copied into each worker
+        :param n_shards:     Number of blocks. Defaults to the number of
+                             addresses, or of CPUs.
+        :param addresses:    Optional list of one address per shard: a Unix
+                             socket path or a (host, port) pair. Defaults to
+                             Unix sockets in a temporary directory.
+        :param authkey:      Key to authenticate the connections. Required
+                             with (host, port) addresses of running
+                             servers; a random key is used for the
+                             servers spawned here if none is given.
+        :param spawn:        Start the servers locally. If False, connect
+                             to servers already listening on 'addresses'.
+        """
+        T, N = Y.shape
+        L, B = basis.shape
+        assert len(regressions) == N
+        if n_shards is None:
+            n_shards = len(addresses) if addresses is not None else mp.cpu_count()
+        n_shards = min(n_shards, T)
+
+        self._tmpdir = None
+        if addresses is None:
+            assert spawn, "Give the addresses of the running servers"
+            self._tmpdir = tempfile.mkdtemp(prefix="pyglm_shards_")
+            addresses = [os.path.join(self._tmpdir, "shard{}".format(i))
+                         for i in range(n_shards)]
+        assert len(addresses) == n_shards
+        if spawn and not authkey:
+            authkey = os.urandom(32)
+
+        self.N, self.B = N, B
+        self.edges = np.linspace(0, T, n_shards + 1).astype(int)
+        seeds = npr.randint(2**31, size=n_shards)
+
+        self.workers = []
+        try:
+            for i, address in enumerate(addresses):
+                process = start_server(address, authkey) if spawn else None
+                self.workers.append(RemoteWorker(address, authkey=authkey, process=process))
+
+            # Build the shards concurrently
+            for i, worker in enumerate(self.workers):
+                start, stop = self.edges[i], self.edges[i+1]
+                pad = min(start, L)
+                worker.build(_Shard, regressions, Y[start-pad:stop], basis, pad, seeds[i])
+            for worker in self.workers:
+                worker.result()
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def T(self):
+        return self.edges[-1]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def column(self, n):
+        """
+        The data for the regression of neuron n.
+        """
+        return _ShardedColumn(self, n)
+
+    def sufficient_statistics(self, n, reg):
+        """
+        The likelihood potentials (J, h) of regression n at its current
+        parameters, summed over shards.
+        """
+        args = [(n, reg.parameters, reg.inv_temperature)] * len(self.workers)
+        results = call_all(self.workers, "sufficient_statistics", args)
+        J = sum(J for J, _ in results)
+        h = sum(h for _, h in results)
+        return J, h
+
+    def residual_statistics(self, n, reg):
+        """
+        The number of bins and the residual sum of squares of
+        regression n at its current parameters.
+        """
+        args = [(n, reg.parameters)] * len(self.workers)
+        results = call_all(self.workers, "residual_statistics", args)
+        return sum(T for T, _ in results), sum(ssq for _, ssq in results)
+
+    def log_likelihood(self, regressions):
+        args = [([reg.parameters for reg in regressions],)] * len(self.workers)
+        return sum(call_all(self.workers, "log_likelihood", args))
+
+
+class _ShardedColumn(object):
+    def __init__(self, dataset, n):
+        self.dataset, self.n = dataset, n
+
+    def sufficient_statistics(self, reg):
+        return self.dataset.sufficient_statistics(self.n, reg)
+
+    def residual_statistics(self, reg):
+        return self.dataset.residual_statistics(self.n, reg)
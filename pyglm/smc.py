@@ -0,0 +1,253 @@
+"""
+Sequential Monte Carlo for streaming inference in the
+nonlinear autoregressive models.
+
+Rather than refitting the model with 'resample_model' every time a new
+chunk of spikes arrives, we maintain a population of particles over the
+regression parameters (adjacency, weights, biases and, for Gaussian
+regressions, the noise variance). Each new chunk reweights the particles
+by its likelihood, which we compute for all particles at once from a
+batched activation. When the effective sample size drops we resample the
+particles and rejuvenate them with the model's own Gibbs kernels.
+
+The moves must leave the posterior given all of the data seen so far
+invariant. Regressions that can be resampled from Gram statistics (the
+Gaussian ones, see uses_gram_statistics) get them accumulated over every
+chunk, so their moves are exact at a cost that does not grow with the
+length of the recording.
+
+Other regressions, e.g. the Polya-gamma ones, have no such statistics
+and are moved with the data itself, so they need a 'window': they are
+moved with only the most recent time bins. This is windowed (forgetting)
+SMC: the cost of a chunk is bounded, but the rejuvenated particles
+target the posterior given the window rather than the full history,
+which suits slowly drifting parameters more than a stationary model.
+Pass window=np.inf to move with all of the data seen so far, at a cost
+per chunk that grows with the length of the recording.
+"""
+import numpy as np
+import numpy.random as npr
+from scipy.special import logsumexp
+
+from pyglm.utils.basis import convolve_with_basis, gram_statistics, neuron_statistics
+
+
+def systematic_resample(weights):
+    """
+    Systematic resampling of particle indices.
+
+    :param weights: normalized particle weights
+    :return:        indices of the resampled particles
+    """
+    P = weights.size
+    u = (npr.rand() + np.arange(P)) / P
+    inds = np.searchsorted(np.cumsum(weights), u)
+    return np.minimum(inds, P-1)
+
+
+class SMCSampler(object):
+    """
+    Resample-move particle filter over the parameters of a
+    NonlinearAutoregressiveModel.
+
+    The model's regressions are used as a scratch space: each particle is
+    loaded into them for the Gibbs move and then read back out. After a
+    call to 'update' the model holds the state of the last moved particle.
+    """
+
+    def __init__(self, model,
+                 N_particles=100,
+                 window=None,
+                 N_moves=1,
+                 ess_threshold=0.5):
+        """
+        :param model:         NonlinearAutoregressiveModel whose regressions
+                              define the prior and the Gibbs kernels.
+        :param N_particles:   Number of particles.
+        :param window:        Number of recent time bins the moves of
+                              regressions without Gram statistics see,
+                              which makes this windowed SMC (see above).
+                              Required for such regressions.
+        :param N_moves:       Gibbs sweeps per particle after each resampling.
+        :param ess_threshold: Resample when the effective sample size drops
+                              below this fraction of the number of particles.
+        """
+        if model.sparse:
+            raise NotImplementedError("The particles hold dense parameters")
+        self._uses_gram = all(reg.uses_gram_statistics for reg in model.regressions)
+        if window is None and not self._uses_gram:
+            raise ValueError("Regressions without Gram statistics are moved with "
+                             "the data; give a window of recent time bins")
+
+        self.model = model
+        self.N, self.B = model.N, model.B
+        self.N_particles = N_particles
+        self.window = window
+        self.N_moves = N_moves
+        self.ess_threshold = ess_threshold
+
+        # Draw the initial particles from the prior
+        params = []
+        for _ in range(N_particles):
+            for reg in model.regressions:
+                reg.resample([])
+            params.append([reg.parameters for reg in model.regressions])
+
+        self.particles = dict(
+            (key, np.array([[p[key] for p in ps] for ps in params]))
+            for key in params[0][0])
+        self.log_weights = np.zeros(N_particles)
+
+        # Keep the last L bins of spikes to filter across chunk boundaries,
+        # and the Gram statistics or the data for the move step.
+        L = model.basis.shape[0]
+        self._history = np.zeros((L, self.N))
+        self._stats = None
+        self._window_data = []
+        self.T = 0
+
+    # Expose the particle states
+    @property
+    def adjacency(self):
+        return self.particles["a"]
+
+    @property
+    def weights(self):
+        return self.particles["W"]
+
+    @property
+    def biases(self):
+        return self.particles["b"][:, :, 0]
+
+    @property
+    def normalized_weights(self):
+        return np.exp(self.log_weights - logsumexp(self.log_weights))
+
+    @property
+    def ess(self):
+        w = self.normalized_weights
+        return 1.0 / np.sum(w**2)
+
+    def posterior_mean(self):
+        """
+        Particle estimates of the posterior mean adjacency, weights and biases.
+        """
+        w = self.normalized_weights
+        return np.tensordot(w, self.adjacency, axes=1), \
+               np.tensordot(w, self.weights, axes=1), \
+               np.tensordot(w, self.biases, axes=1)
+
+    def activations(self, X):
+        """
+        Compute the activation of every neuron under every particle.
+
+        :param X:  TxNxB regressors
+        :return:   PxTxN activations
+        """
+        P, N, B = self.N_particles, self.N, self.B
+        X = np.reshape(X, (-1, N*B))
+        W = self.adjacency[:, :, :, None] * self.weights
+        W = np.reshape(W, (P, N, N*B))
+        return np.einsum('tk,pnk->ptn', X, W) + self.biases[:, None, :]
+
+    def chunk_log_likelihood(self, X, Y):
+        """
+        Log likelihood of a chunk of data under each particle.
+        """
+        Psi = self.activations(X)
+        ll = np.zeros(self.N_particles)
+        for n, reg in enumerate(self.model.regressions):
+            kwargs = dict(psi=Psi[:, :, n])
+            if "eta" in self.particles:
+                kwargs["eta"] = self.particles["eta"][:, n, None]
+            ll += reg.log_likelihood((X, Y[:, n]), **kwargs).sum(axis=1)
+        return ll
+
+    def update(self, Y):
+        """
+        Incorporate a new chunk of spike counts.
+
+        :param Y:   TxN array of counts for the next T time bins
+        :return:    The effective sample size after the update
+        """
+        assert isinstance(Y, np.ndarray) and Y.ndim == 2 and Y.shape[1] == self.N
+        T, L = Y.shape[0], self._history.shape[0]
+        if T == 0:
+            return self.ess
+
+        # Filter the new chunk, using the tail of the previous one
+        S = np.vstack((self._history, Y))
+        X = convolve_with_basis(S, self.model.basis)[L:]
+        self._history = S[-L:]
+        self.T += T
+
+        # Reweight the particles
+        self.log_weights += self.chunk_log_likelihood(X, Y)
+        self.log_weights -= logsumexp(self.log_weights)
+
+        # Update the statistics or the window of data for the move step
+        if self._uses_gram:
+            self._accumulate_statistics(X, Y)
+        else:
+            self._window_data.append((X, Y))
+            self._trim_window()
+
+        # Resample and move if the weights have degenerated
+        if self.ess < self.ess_threshold * self.N_particles:
+            inds = systematic_resample(self.normalized_weights)
+            for key in self.particles:
+                self.particles[key] = self.particles[key][inds]
+            self.log_weights = np.zeros(self.N_particles)
+            self._move()
+
+        return self.ess
+
+    def _accumulate_statistics(self, X, Y):
+        """
+        Add a chunk to the Gram statistics of all the data seen so far,
+        (see pyglm.utils.basis.gram_statistics).
+        """
+        stats = gram_statistics(X, Y)
+        if self._stats is None:
+            self._stats = stats
+        else:
+            for k, v in stats.items():
+                self._stats[k] = self._stats[k] + v
+
+    def _trim_window(self):
+        if self.window is None:
+            return
+
+        Tw = sum(X.shape[0] for X, _ in self._window_data)
+        while Tw > self.window:
+            X, Y = self._window_data[0]
+            excess = Tw - self.window
+            if excess >= X.shape[0]:
+                self._window_data.pop(0)
+                Tw -= X.shape[0]
+            else:
+                self._window_data[0] = (X[excess:], Y[excess:])
+                Tw -= excess
+
+    def _move(self):
+        """
+        Rejuvenate each particle with the regressions' Gibbs kernels,
+        given the Gram statistics of all the data seen so far if the
+        regressions use them, and otherwise given the window of data.
+        """
+        regressions = self.model.regressions
+        stats = self._stats
+        for p in range(self.N_particles):
+            for n, reg in enumerate(regressions):
+                reg.parameters = dict((key, val[p, n]) for key, val in self.particles.items())
+                if stats is not None:
+                    reg_stats = neuron_statistics(stats, n)
+                    for _ in range(self.N_moves):
+                        reg.resample([], stats=reg_stats)
+                else:
+                    datas = [(X, Y[:, n]) for (X, Y) in self._window_data]
+                    for _ in range(self.N_moves):
+                        reg.resample(datas)
+
+                for key, val in reg.parameters.items():
+                    self.particles[key][p, n] = val
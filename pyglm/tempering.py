@@ -0,0 +1,147 @@
+"""
+Replica exchange (parallel tempering) for the network GLMs.
+
+The collapsed updates of the adjacency matrix flip one connection at a
+time, so when the inputs are strongly correlated the chain can stay stuck
+in one explanation of the data for a long time. Parallel tempering runs
+several copies of the model whose likelihoods are raised to powers
+1 = beta_0 > beta_1 > ... > beta_K-1 > 0. The flatter, tempered copies
+move between modes easily, and neighbouring copies periodically propose
+to exchange temperatures, accepting with probability
+
+    min(1, exp((beta_k - beta_k+1) * (ll_j - ll_i)))
+
+where ll_i is the (untempered) log likelihood of the replica at beta_k.
+Samples are collected from whichever replica currently has beta = 1.
+
+Each replica lives in its own long-lived process (see
+pyglm.utils.parallel), so the sweeps run concurrently and exchanging
+temperatures only sends a few numbers between processes.
+"""
+import time
+import numpy as np
+import numpy.random as npr
+
+from pyglm.utils.parallel import Worker, LocalWorker, call_all
+from pyglm.utils.utils import effective_sample_size
+
+
+def _build_replica(model_class, model_args, model_kwargs, datas, inv_temperature, seed):
+    npr.seed(seed)
+    model = model_class(*model_args, **model_kwargs)
+    for data in datas:
+        model.add_data(data)
+    model.inv_temperature = inv_temperature
+    return model
+
+
+class ParallelTempering(object):
+    """
+    Replica exchange sampler over a network GLM, e.g. SparseBernoulliGLM.
+    """
+    def __init__(self, model_class, model_args, datas,
+                 model_kwargs=None,
+                 inv_temperatures=None,
+                 N_replicas=4,
+                 min_inv_temperature=0.25,
+                 processes=True):
+        """
+        :param model_class:          Model class, e.g. SparseBernoulliGLM
+        :param model_args:           Tuple of positional arguments for the model
+        :param datas:                List of TxN spike count arrays
+        :param model_kwargs:         Keyword arguments for the model
+        :param inv_temperatures:     Decreasing inverse temperatures, starting at 1.
+                                     Defaults to a geometric ladder of N_replicas
+                                     rungs down to min_inv_temperature.
+        :param processes:            Run each replica in its own process.
+        """
+        if inv_temperatures is None:
+            inv_temperatures = np.logspace(0, np.log10(min_inv_temperature), N_replicas) \
+                if N_replicas > 1 else np.ones(1)
+        self.inv_temperatures = np.asarray(inv_temperatures, dtype=float)
+        assert self.inv_temperatures[0] == 1.0
+        assert np.all(np.diff(self.inv_temperatures) < 0)
+        K = self.N_replicas = self.inv_temperatures.size
+
+        model_kwargs = dict() if model_kwargs is None else model_kwargs
+        worker_class = Worker if processes else LocalWorker
+        seeds = npr.randint(2**31, size=K)
+        self.workers = [worker_class(_build_replica, model_class, model_args, model_kwargs,
+                                     datas, beta, seed)
+                        for beta, seed in zip(self.inv_temperatures, seeds)]
+
+        # replica[k] is the index of the worker at the k-th temperature
+        self.replica = np.arange(K)
+        self.swaps_proposed = np.zeros(K-1, dtype=int)
+        self.swaps_accepted = np.zeros(K-1, dtype=int)
+        self._sweeps = 0
+
+        self.samples = []
+        self.sample_times = []
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    @property
+    def acceptance_rates(self):
+        return self.swaps_accepted / np.maximum(self.swaps_proposed, 1).astype(float)
+
+    def step(self):
+        """
+        Resample every replica once, then propose exchanges between
+        neighbouring temperatures.
+        """
+        call_all(self.workers, "resample_model")
+        lls = np.array(call_all(self.workers, "log_likelihood"))
+
+        # Alternate between the even and odd pairs of the ladder
+        betas, replica = self.inv_temperatures, self.replica
+        for k in range(self._sweeps % 2, self.N_replicas - 1, 2):
+            i, j = replica[k], replica[k+1]
+            self.swaps_proposed[k] += 1
+            if np.log(npr.rand()) < (betas[k] - betas[k+1]) * (lls[j] - lls[i]):
+                replica[k], replica[k+1] = j, i
+                self.swaps_accepted[k] += 1
+                self.workers[i].call("__setattr__", "inv_temperature", betas[k+1])
+                self.workers[j].call("__setattr__", "inv_temperature", betas[k])
+        self._sweeps += 1
+
+        return lls[replica[0]]
+
+    def run(self, N_samples, verbose=False):
+        """
+        Run N_samples sweeps and collect the adjacency matrix of the
+        replica at beta = 1 after each one.
+
+        :return:  Array of the collected adjacency samples
+        """
+        for itr in range(N_samples):
+            tic = time.time()
+            ll = self.step()
+            self.samples.append(self.workers[self.replica[0]].call("adjacency"))
+            self.elapsed += time.time() - tic
+            self.sample_times.append(self.elapsed)
+            if verbose:
+                print("Iteration {}. LL: {:.1f}. Swap rates: {}".format(
+                    itr, ll, np.round(self.acceptance_rates, 2)))
+
+        return np.array(self.samples)
+
+    def adjacency_ess(self, burnin=0):
+        """
+        Effective sample size of each entry of the adjacency matrix
+        over the collected samples, and the same per second of sampling.
+        Entries that never changed get nan.
+        """
+        samples = np.array(self.samples[burnin:], dtype=float)
+        ess = effective_sample_size(samples)
+        seconds = self.elapsed - (self.sample_times[burnin-1] if burnin > 0 else 0.0)
+        return ess, ess / seconds
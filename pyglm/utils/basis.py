@@ -14,6 +14,10 @@ def convolve_with_basis(S, basis):
     (T,N) = S.shape
     (R,B) = basis.shape
 
+    # Bases with a recursive form are filtered in O(T) per function
+    if recursive_form(basis) is not None:
+        return basis.convolve(S)
+
     # Concatenate basis with a layer of ones
     basis = np.vstack((np.zeros((1, B)), basis))
 
@@ -33,6 +37,193 @@ def convolve_with_basis(S, basis):
 
     return F
 
+def bin_spike_times(spike_times, dt, duration):
+    """
+    Bin lists of spike times into sparse counts.
+
+    :param spike_times: List of N arrays of spike times, one per neuron
+    :param dt:          Bin size, in the same units as the spike times
+    :param duration:    Length of the recording
+    :return:            T, and the (time bin, neuron, count) triplets of
+                        the nonzero entries, sorted by neuron and time bin
+    """
+    T = int(np.ceil(duration / dt))
+    ts, ns, cs = [], [], []
+    for n, st in enumerate(spike_times):
+        st = np.asarray(st)
+        bins = np.floor(st[(st >= 0) & (st < duration)] / dt).astype(int)
+        t, c = np.unique(np.minimum(bins, T-1), return_counts=True)
+        ts.append(t)
+        ns.append(n * np.ones(t.size, dtype=int))
+        cs.append(c)
+
+    return T, np.concatenate(ts), np.concatenate(ns), np.concatenate(cs)
+
+def convolve_spike_times(spike_times, basis, dt, duration, out=None, zeroed=False):
+    """
+    Build the regressors directly from spike times by scattering the
+    basis impulse responses after each spike. This matches
+    convolve_with_basis applied to the binned counts, but the cost
+    scales with the number of spikes rather than with T*N.
+
+    :param spike_times: List of N arrays of spike times, one per neuron
+    :param basis:       LxB basis
+    :param dt:          Bin size, in the same units as the spike times
+    :param duration:    Length of the recording
+    :param out:         Optional TxNxB array (e.g. a np.memmap) to fill
+    :param zeroed:      Whether 'out' is already all zeros, e.g. a newly
+                        created np.lib.format.open_memmap. Otherwise it
+                        has to be cleared first, at a cost of T*N*B.
+    :return:            TxNxB regressors and the TxN counts as a CSR matrix
+    """
+    from scipy.sparse import csr_matrix
+
+    N = len(spike_times)
+    L, B = basis.shape
+    T, t, n, c = bin_spike_times(spike_times, dt, duration)
+
+    # np.zeros gets its pages zeroed lazily by the OS, so
+    # only the bins that are written below are ever touched
+    if out is None:
+        out = np.zeros((T, N, B))
+    else:
+        assert out.shape == (T, N, B)
+        if not zeroed:
+            out[:] = 0
+
+    # A spike in bin t adds basis[l] to the regressors in bin t+1+l.
+    # The (t, n) pairs are unique, so each fancy-indexed add is safe.
+    for l in range(L):
+        valid = t + 1 + l < T
+        if not np.any(valid):
+            break
+        out[t[valid] + 1 + l, n[valid]] += c[valid, None] * basis[l]
+
+    Y = csr_matrix((c, (t, n)), shape=(T, N))
+    return out, Y
+
+def lagged_correlations(S, L, sparse_density=0.1):
+    """
+    Cross-correlations of the columns of S at lags 0..L,
+
+        C[d, m, n] = sum_s S[s, m] * S[s+d, n].
+
+    Sparse spike trains (or dense ones with few nonzeros) are
+    correlated with sparse products, whose cost scales with the
+    number of coincident spikes rather than with T.
+
+    :param S:  TxN counts, dense or scipy.sparse
+    :param L:  Maximum lag
+    :return:   (L+1)xNxN array of correlations
+    """
+    import scipy.sparse as sp
+
+    T, N = S.shape
+    if not sp.issparse(S) and np.count_nonzero(S) < sparse_density * S.size:
+        S = sp.csr_matrix(S)
+    if sp.issparse(S):
+        S = S.tocsr()
+
+    C = np.zeros((L+1, N, N))
+    for d in range(min(L, T-1) + 1):
+        Cd = S[:T-d].T.dot(S[d:])
+        C[d] = Cd.toarray() if sp.issparse(Cd) else Cd
+    return C
+
+def basis_gram_statistics(S, basis):
+    """
+    Sufficient statistics of the regressors X = convolve_with_basis(S, basis)
+    computed from the cross-correlations of S, without forming X.
+
+    Writing P for the basis, the Gram matrix is
+
+        X^T X [(m,b), (n,c)] = sum_{l,l'} P[l-1,b] P[l'-1,c] C_mn(l-l') - tail,
+
+    where the correlations only depend on the lag difference, so this is
+    a sum over 2L-1 lags of (basis overlap) x (correlation) products. The
+    correlation sums run over all lags of the zero-padded spike train;
+    'tail' removes the L time bins after the end of the recording, which
+    only depend on its last L bins. Since the outputs are S itself, X^T S
+    follows from the same correlations and is exact.
+
+    :param S:      TxN counts, dense or scipy.sparse
+    :param basis:  LxB basis
+    :return:       dict with
+                   XX:   NBxNB Gram matrix, X^T X
+                   X1:   NB sums of the regressors
+                   XY:   NBxN products with the outputs, X^T S
+                   T:    number of time bins
+                   ysum: N sums of the outputs
+                   yty:  N sums of the squared outputs
+    """
+    import scipy.sparse as sp
+
+    T, N = S.shape
+    L, B = basis.shape
+    S = S.astype(float) if sp.issparse(S) else np.asarray(S, dtype=float)
+    C = lagged_correlations(S, L)
+
+    # Products of the outputs with the regressors
+    XY = np.einsum('lmn,lb->mbn', C[1:], basis).reshape((N*B, N))
+
+    # Sum over lag differences d >= 0 of the basis overlaps times the
+    # correlations. Negative lags contribute the transposes.
+    G = np.zeros((N, B, N, B))
+    for d in range(L):
+        Phi = basis[d:].T.dot(basis[:L-d])
+        Gd = np.einsum('mn,bc->mbnc', C[d], Phi)
+        G += Gd
+        if d > 0:
+            G += Gd.transpose((2, 3, 0, 1))
+    G = G.reshape((N*B, N*B))
+
+    # Regressors in the L bins after the end of the recording
+    Stail = S[max(T-L, 0):]
+    Stail = Stail.toarray() if sp.issparse(Stail) else np.asarray(Stail, dtype=float)
+    Stail = np.vstack((np.zeros((L - Stail.shape[0], N)), Stail, np.zeros((L, N))))
+    Xtail = convolve_with_basis(Stail, basis)[L:].reshape((L, N*B))
+    G -= Xtail.T.dot(Xtail)
+
+    ysum = np.asarray(S.sum(0)).ravel().astype(float)
+    X1 = np.outer(ysum, basis.sum(0)).ravel() - Xtail.sum(0)
+
+    return dict(XX=G, X1=X1, XY=XY, T=T, ysum=ysum, yty=np.diag(C[0]).copy())
+
+def gram_statistics(X, Y):
+    """
+    The statistics of basis_gram_statistics computed directly from the
+    regressors, in O(T (NB)^2).
+
+    :param X:  TxNxB regressors
+    :param Y:  TxN outputs
+    """
+    T = X.shape[0]
+    X = np.reshape(X, (T, -1))
+    return dict(XX=X.T.dot(X), X1=X.sum(0), XY=X.T.dot(Y), T=T,
+                ysum=Y.sum(0).astype(float), yty=(Y**2).sum(0).astype(float))
+
+def neuron_statistics(stats, n):
+    """
+    The statistics of regression n, as taken by the 'stats' argument
+    of a regression's resample, from those of all N outputs.
+
+    :param stats:  Output of gram_statistics or basis_gram_statistics
+    """
+    return dict(XX=stats["XX"], X1=stats["X1"], T=stats["T"],
+                Xy=stats["XY"][:, n], ysum=stats["ysum"][n], yty=stats["yty"][n])
+
+def correlations_are_cheaper(S, basis, sparse_density=0.1):
+    """
+    Whether basis_gram_statistics, whose correlations cost O(L T N^2)
+    for dense counts, beats forming X^T X in O(T (NB)^2). The
+    correlations win for sparse spike trains and for short bases.
+    """
+    import scipy.sparse as sp
+    L, B = basis.shape
+    if sp.issparse(S) or np.count_nonzero(S) < sparse_density * S.size:
+        return True
+    return L + 1 <= B * B
+
 def interpolate_basis(basis, dt, dt_max,
                       norm=True, allow_instantaneous=False):
     # Interpolate basis at the resolution of the data
@@ -104,4 +295,234 @@ def cosine_basis(B,
         # Normalize such that \int_0^1 b(t) dt = 1
         basis = basis / np.tile(np.sum(basis,axis=0), [L,1]) / (1.0/L)
 
-    return basis
\ No newline at end of file
+    return basis
+
+
+class RecursiveBasis(np.ndarray):
+    """
+    An LxB basis whose functions are the impulse responses of recursive
+    (IIR) filters, truncated to L lags. Column j is the impulse response
+    of the filter with numerator num[j] and denominator den[j], i.e.
+    basis[k,j] is the weight of the spikes k+1 bins in the past.
+
+    It is an ordinary basis matrix wherever one is expected, but the
+    regressors can also be computed recursively, in O(T N B) rather than
+    O(T N L), and stepped one bin at a time (see 'stepper'). The lags
+    beyond L are removed by a second filter on the spikes L bins back,
+    so the results match the truncated matrix exactly.
+    """
+    def __new__(cls, num, den, L):
+        """
+        :param num:  B numerators (or a BxP array), one per function
+        :param den:  B denominators, with den[j][0] != 0
+        :param L:    Number of lags
+        """
+        B = len(num)
+        assert len(den) == B
+        P = max(max(len(n) for n in num), max(len(d) for d in den)) - 1
+        nums = np.zeros((B, P+1))
+        dens = np.zeros((B, P+1))
+        for j in range(B):
+            nums[j, :len(num[j])] = num[j]
+            dens[j, :len(den[j])] = den[j]
+        nums /= dens[:, :1]
+        dens /= dens[:, :1]
+
+        impulse = np.zeros(L + P + 1)
+        impulse[0] = 1
+        responses = np.array([sig.lfilter(nums[j], dens[j], impulse) for j in range(B)])
+
+        obj = np.asarray(responses[:, :L].T).view(cls)
+        obj.num, obj.den = nums, dens
+
+        # The filters of the truncated tails: for lags L, L+1, ..., the
+        # impulse response continues the recursion from its values there
+        obj.tail_num = np.array([np.convolve(dens[j], responses[j, L:])[:P+1]
+                                 for j in range(B)])
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.num = getattr(obj, "num", None)
+        self.den = getattr(obj, "den", None)
+        self.tail_num = getattr(obj, "tail_num", None)
+
+    def __reduce__(self):
+        reconstruct, args, state = super(RecursiveBasis, self).__reduce__()
+        return reconstruct, args, (state, self.num, self.den, self.tail_num)
+
+    def __setstate__(self, state):
+        state, self.num, self.den, self.tail_num = state
+        super(RecursiveBasis, self).__setstate__(state)
+
+    # Scaling the basis scales the filters
+    def _scaled(self, c):
+        out = np.asarray(self) * c
+        out = out.view(RecursiveBasis)
+        out.num, out.den, out.tail_num = self.num * c, self.den, self.tail_num * c
+        return out
+
+    def __mul__(self, other):
+        if np.isscalar(other):
+            return self._scaled(other)
+        return np.asarray(self) * other
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if np.isscalar(other):
+            return self._scaled(1.0 / other)
+        return np.asarray(self) / other
+
+    __div__ = __truediv__
+
+    def convolve(self, S):
+        """
+        The regressors X[t] = sum_l basis[l-1] S[t-l], by recursive filtering.
+
+        :param S:  TxN counts
+        :return:   TxNxB regressors
+        """
+        T, N = S.shape
+        L, B = self.shape
+
+        # Spikes one bin back feed the filters, and L+1 bins back the tails
+        S1 = np.zeros((T, N))
+        S1[1:] = S[:-1]
+        SL = np.zeros((T, N))
+        SL[L+1:] = S[:T-L-1]
+
+        F = np.empty((T, N, B))
+        for j in range(B):
+            F[:,:,j] = sig.lfilter(self.num[j], self.den[j], S1, axis=0)
+            F[:,:,j] -= sig.lfilter(self.tail_num[j], self.den[j], SL, axis=0)
+        return F
+
+    def stepper(self, N):
+        """
+        A filter that computes the regressors one time bin at a time.
+        """
+        return RecursiveStepper(self, N)
+
+
+class RecursiveStepper(object):
+    """
+    Steps the filters of a RecursiveBasis one time bin at a time. Each
+    step costs O(N B) (times the filter order), however long the basis.
+    """
+    def __init__(self, basis, N):
+        L, B = basis.shape
+        P = basis.num.shape[1] - 1
+        self.L, self.N, self.B, self.P = L, N, B, P
+        self.num = basis.num[:, :, None]
+        self.den = basis.den[:, :, None]
+        self.tail_num = basis.tail_num[:, :, None]
+
+        # Transposed direct form II states of the filters and their tails
+        self._z = np.zeros((P, B, N))
+        self._zt = np.zeros((P, B, N))
+
+        # The last L spike vectors, to feed the tails
+        self._history = np.zeros((L, N))
+        self._pos = 0
+
+        self.X = np.zeros((B, N))
+        self._tmp = np.zeros((B, N))
+        self._y_old = np.zeros(N)
+        self._scratch = np.zeros((B, N))
+
+    def reset(self):
+        self._z[:] = 0
+        self._zt[:] = 0
+        self._history[:] = 0
+        self._pos = 0
+        self.X[:] = 0
+
+    def _step(self, num, z, x, out):
+        # y = num[0] x + z[0]; z[i] = num[i+1] x - den[i+1] y + z[i+1]
+        np.multiply(num[:, 0], x, out=out)
+        if self.P > 0:
+            out += z[0]
+        for i in range(self.P):
+            np.multiply(self.den[:, i+1], out, out=self._scratch)
+            np.multiply(num[:, i+1], x, out=z[i])
+            z[i] -= self._scratch
+            if i + 1 < self.P:
+                z[i] += z[i+1]
+
+    def push(self, y):
+        """
+        Add the spike counts of the latest time bin.
+
+        :param y:  length N array of counts
+        :return:   BxN regressors of the next time bin. This buffer is
+                   overwritten by the next call.
+        """
+        # The counts that fall out of the window
+        y_old = self._y_old
+        y_old[:] = self._history[self._pos]
+        self._history[self._pos] = y
+        self._pos = (self._pos + 1) % self.L
+
+        self._step(self.num, self._z, y, self.X)
+        self._step(self.tail_num, self._zt, y_old, self._tmp)
+        self.X -= self._tmp
+        return self.X
+
+
+def recursive_form(basis):
+    """
+    The basis itself if it is a RecursiveBasis whose filters still
+    match its matrix (e.g. it was not sliced or flipped), else None.
+    """
+    if not isinstance(basis, RecursiveBasis) or basis.num is None or basis.ndim != 2:
+        return None
+    L, B = basis.shape
+    if basis.num.shape[0] != B:
+        return None
+
+    impulse = np.zeros(L)
+    impulse[0] = 1
+    for j in range(B):
+        h = sig.lfilter(basis.num[j], basis.den[j], impulse)
+        if not np.allclose(h, np.asarray(basis[:, j]), rtol=1e-8, atol=1e-12):
+            return None
+    return basis
+
+
+def exponential_basis(taus, L=100, norm=True):
+    """
+    A basis of exponentially decaying impulse responses, exp(-k/tau) at
+    lag k+1, with a recursive form.
+
+    :param taus:  Time constants, in time bins
+    :param norm:  Normalize like cosine_basis, so each function sums to L
+    """
+    rhos = np.exp(-1.0 / np.asarray(taus, dtype=float))
+    num = [[1.0] for _ in rhos]
+    den = [[1.0, -rho] for rho in rhos]
+    basis = RecursiveBasis(num, den, L)
+    return _normalize_recursive(basis) if norm else basis
+
+
+def alpha_basis(taus, L=100, norm=True):
+    """
+    A basis of alpha functions, (k/tau) exp(-k/tau) at lag k, which
+    peak at lag tau, with a recursive form.
+
+    :param taus:  Time constants (peak lags), in time bins
+    :param norm:  Normalize like cosine_basis, so each function sums to L
+    """
+    rhos = np.exp(-1.0 / np.asarray(taus, dtype=float))
+    num = [[rho / tau] for rho, tau in zip(rhos, taus)]
+    den = [[1.0, -2 * rho, rho**2] for rho in rhos]
+    basis = RecursiveBasis(num, den, L)
+    return _normalize_recursive(basis) if norm else basis
+
+
+def _normalize_recursive(basis):
+    L = basis.shape[0]
+    scale = L / np.asarray(basis).sum(axis=0)
+    basis.num *= scale[:, None]
+    basis.tail_num *= scale[:, None]
+    basis *= scale[None, :]
+    return basis
@@ -0,0 +1,169 @@
+"""
+A persistent, content-addressed cache for basis convolutions.
+
+Refitting the same recording with different priors or regression
+families recomputes the same TxNxB regressors every time. The cache keys
+the output of convolve_with_basis by a hash of the spike counts and the
+basis, stores it as a .npy file, and hands back a read-only memory map.
+When the cache grows beyond 'max_bytes' the least recently used entries
+are evicted.
+"""
+import os
+import errno
+import hashlib
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.utils.basis import convolve_with_basis
+
+
+def array_hash(*arrays, **kwargs):
+    """
+    Hash the shapes, dtypes and contents of a set of arrays.
+    Large arrays (including memmaps) are hashed a block of rows at a time.
+    """
+    block = kwargs.get("block", 2**16)
+    h = hashlib.sha1()
+    for arr in arrays:
+        if sp.issparse(arr):
+            arr = arr.tocsr()
+            h.update(b"sparse")
+            h.update(str(arr.shape).encode())
+            arrays_to_hash = (arr.data, arr.indices, arr.indptr)
+        else:
+            arrays_to_hash = (arr,)
+
+        for a in arrays_to_hash:
+            a = np.atleast_1d(a)
+            h.update(str((a.shape, a.dtype.str)).encode())
+            for start in range(0, a.shape[0], block):
+                h.update(np.ascontiguousarray(a[start:start+block]).tobytes())
+    return h.hexdigest()
+
+
+class ConvolutionCache(object):
+    """
+    Disk cache of the regressors for a given spike train and basis.
+    """
+    def __init__(self, directory, max_bytes=8 * 2**30):
+        """
+        :param directory:  Where to keep the cached .npy files
+        :param max_bytes:  Evict least recently used entries beyond this size
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, S, basis):
+        return array_hash(S, basis)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, S, basis):
+        """
+        Return the cached regressors as a read-only memmap, or None.
+        """
+        return self._load(self.path(self.key(S, basis)))
+
+    def convolve(self, S, basis, keep=()):
+        """
+        Convolve S with the basis, reusing a cached result if there is one.
+
+        :param S:      TxN spike counts
+        :param basis:  LxB basis
+        :param keep:   Paths of entries that must not be evicted to
+                       make room for this one, e.g. because other
+                       processes are about to load them
+        :return:       TxNxB read-only memmap of the regressors
+        """
+        key = self.key(S, basis)
+        path = self.path(key)
+        X = self._load(path)
+        if X is not None:
+            return X
+
+        S = S.toarray() if sp.issparse(S) else np.asarray(S)
+        F = convolve_with_basis(S, basis)
+
+        # Another process may evict the entry before we load it,
+        # in which case we write it again
+        while X is None:
+            # Write to a temporary file first so that concurrent readers
+            # never see a partially written entry
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, F)
+            os.rename(tmp, path)
+
+            self.evict(keep=[path] + list(keep))
+            X = self._load(path)
+        return X
+
+    @staticmethod
+    def _load(path):
+        """
+        Memory-map an entry and mark it as recently used, or return
+        None if it does not exist (e.g. another process evicted it).
+        """
+        try:
+            os.utime(path, None)
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    @staticmethod
+    def _remove(path):
+        # Other processes sharing the cache may have removed it already
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def entries(self):
+        """
+        Cached entries as (last use, size, path), least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        Entries that are still memory-mapped remain valid until unmapped.
+
+        :param keep:  A path, or a list of paths, never to remove
+        """
+        keep = [keep] if isinstance(keep, str) else (keep or [])
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self._remove(path)
@@ -0,0 +1,176 @@
+"""
+Datasets that do not have to fit in memory.
+
+A ChunkedDataset holds the spike counts Y (TxN) and the regressors
+X (TxNxB), typically as memory-mapped .npy files, and hands them out in
+chunks of at most 'chunk_size' time bins. The regressions accept either
+an (X, y) tuple or an iterable of such chunks, so everything downstream
+streams over the data instead of loading it all at once.
+
+The spike counts may also be a scipy.sparse matrix, as produced when the
+data is ingested from spike times, in which case each chunk is densified
+on the fly.
+"""
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.utils.basis import convolve_with_basis, convolve_spike_times
+
+
+class ChunkedDataset(object):
+    """
+    Spike counts and regressors, streamed in bounded chunks of time bins.
+    """
+    def __init__(self, X, Y, chunk_size=10000):
+        """
+        :param X:           TxNxB array of regressors. May be a np.memmap.
+        :param Y:           TxN array of spike counts. May be a np.memmap
+                            or a scipy.sparse matrix.
+        :param chunk_size:  Maximum number of time bins per chunk.
+        """
+        assert X.ndim == 3 and Y.ndim == 2
+        assert X.shape[:2] == Y.shape
+        self.X = X
+        self.Y = Y.tocsr() if sp.issparse(Y) else Y
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def load(cls, directory, chunk_size=10000, mmap_mode='r'):
+        """
+        Memory-map a dataset written by 'save', 'from_spikes' or
+        'from_spike_times'. The sparse counts written by the latter,
+        Y.npz, are loaded into memory.
+        """
+        X = np.load(os.path.join(directory, "X.npy"), mmap_mode=mmap_mode)
+        Y_path = os.path.join(directory, "Y.npy")
+        if os.path.exists(Y_path):
+            Y = np.load(Y_path, mmap_mode=mmap_mode)
+        else:
+            Y = sp.load_npz(os.path.join(directory, "Y.npz"))
+        return cls(X, Y, chunk_size=chunk_size)
+
+    @classmethod
+    def from_spikes(cls, Y, basis, directory, chunk_size=10000, dtype=float):
+        """
+        Convolve the spike counts with the basis, one chunk at a time,
+        and write the regressors to a memory-mapped file.
+
+        :param Y:         TxN array of spike counts. May be a np.memmap.
+        :param basis:     LxB basis
+        :param directory: Where to write X.npy and Y.npy
+        :param dtype:     Data type of the regressors on disk
+        """
+        T, N = Y.shape
+        L, B = basis.shape
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        X = np.lib.format.open_memmap(os.path.join(directory, "X.npy"),
+                                      mode='w+', dtype=dtype, shape=(T, N, B))
+        Ym = np.lib.format.open_memmap(os.path.join(directory, "Y.npy"),
+                                       mode='w+', dtype=Y.dtype, shape=(T, N))
+
+        # Filter each chunk along with the L bins that precede it
+        for start in range(0, T, chunk_size):
+            stop = min(start + chunk_size, T)
+            pad = min(start, L)
+            X[start:stop] = convolve_with_basis(Y[start-pad:stop], basis)[pad:]
+            Ym[start:stop] = Y[start:stop]
+
+        X.flush()
+        Ym.flush()
+        del X, Ym
+        return cls.load(directory, chunk_size=chunk_size)
+
+    @classmethod
+    def from_spike_times(cls, spike_times, basis, dt, duration,
+                         directory=None, chunk_size=10000):
+        """
+        Build a dataset directly from lists of spike times. The counts are
+        kept in a sparse matrix and the regressors are built by scattering
+        the basis after each spike, optionally into a memory-mapped file.
+
+        :param spike_times: List of N arrays of spike times, one per neuron
+        :param basis:       LxB basis
+        :param dt:          Bin size, in the same units as the spike times
+        :param duration:    Length of the recording
+        :param directory:   If given, where to write the regressors X.npy
+                            and the sparse counts Y.npz (see 'load')
+        """
+        N = len(spike_times)
+        T = int(np.ceil(duration / dt))
+        out = None
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            out = np.lib.format.open_memmap(os.path.join(directory, "X.npy"),
+                                            mode='w+', dtype=float,
+                                            shape=(T, N, basis.shape[1]))
+
+        # A new memory-mapped file is already zero filled
+        X, Y = convolve_spike_times(spike_times, basis, dt, duration,
+                                    out=out, zeroed=out is not None)
+        if directory is not None:
+            X.flush()
+            sp.save_npz(os.path.join(directory, "Y.npz"), Y)
+        return cls(X, Y, chunk_size=chunk_size)
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for name, arr, get in (("X.npy", self.X, lambda slc: self.X[slc]),
+                               ("Y.npy", self.Y, self.dense_Y)):
+            out = np.lib.format.open_memmap(os.path.join(directory, name),
+                                            mode='w+', dtype=arr.dtype, shape=arr.shape)
+            for slc in self.slices():
+                out[slc] = get(slc)
+            out.flush()
+
+    @property
+    def T(self):
+        return self.Y.shape[0]
+
+    @property
+    def N(self):
+        return self.Y.shape[1]
+
+    @property
+    def B(self):
+        return self.X.shape[2]
+
+    def slices(self):
+        for start in range(0, self.T, self.chunk_size):
+            yield slice(start, min(start + self.chunk_size, self.T))
+
+    def dense_Y(self, slc=slice(None)):
+        """
+        The spike counts in a range of time bins, as a dense array.
+        """
+        Y = self.Y[slc]
+        return Y.toarray() if sp.issparse(Y) else np.asarray(Y)
+
+    def chunks(self):
+        """
+        Yield (X, Y) chunks of at most chunk_size time bins.
+        """
+        for slc in self.slices():
+            yield self.X[slc], self.dense_Y(slc)
+
+    def __iter__(self):
+        return self.chunks()
+
+    def column(self, n):
+        """
+        The data for the regression of neuron n, as an iterable of (X, y) chunks.
+        """
+        return _ChunkedColumn(self, n)
+
+
+class _ChunkedColumn(object):
+    def __init__(self, dataset, n):
+        self.dataset, self.n = dataset, n
+
+    def __iter__(self):
+        for X, Y in self.dataset.chunks():
+            yield X, Y[:, self.n]
@@ -0,0 +1,229 @@
+"""
+Estimate the memory a fit will need before running it, and choose how
+to store the data so that it stays within a budget.
+
+The main consumers of memory are:
+
+- the regressors X (T x N x B per dataset), and the spike counts;
+- the Polya-gamma auxiliary variables and normalized observations,
+  which are kept for every time bin while one regression is resampled;
+- the workspace (see pyglm.utils.utils.Workspace) shared by the
+  regressions, which holds a buffer of weighted inputs for a block of
+  at most ROW_BLOCK time bins and an NB x NB Gram matrix, plus the
+  double precision copy of a block of single precision regressors;
+- the (NB+1) x (NB+1) prior and posterior potentials of the regression
+  being resampled;
+- the network's weight prior, a B x B covariance shared by the weights
+  (and one for the self-connections), and its N x N connection
+  probabilities;
+- the stored posterior samples.
+
+estimate_memory gives the peak bytes of each of these, and plan_memory
+picks the cheapest storage that fits: the regressors in memory in
+double precision, then in single precision, and finally memory-mapped
+on disk and streamed in chunks (see pyglm.utils.data.ChunkedDataset)
+with the largest chunk size that fits.
+"""
+import numpy as np
+
+from pyglm.regression import ROW_BLOCK
+from pyglm.utils.basis import convolve_with_basis
+from pyglm.utils.data import ChunkedDataset
+
+
+def estimate_memory(N, B, T,
+                    n_datasets=1,
+                    family="bernoulli",
+                    n_samples=0,
+                    sample_rates=False,
+                    dtype=float,
+                    backend="memory",
+                    chunk_size=None):
+    """
+    Peak memory of each component of a fit, in bytes. The estimates are
+    upper bounds on the arrays pyglm allocates; interpreter overhead
+    and temporaries of numpy itself are not included.
+
+    :param N:             Number of neurons
+    :param B:             Number of basis functions
+    :param T:             Number of time bins per dataset
+    :param n_datasets:    Number of datasets
+    :param family:        "bernoulli" (or another Polya-gamma family)
+                          or "gaussian"
+    :param n_samples:     Number of posterior samples that will be stored
+    :param sample_rates:  Whether the samples include the firing rates
+                          (TxN per dataset), as in the examples
+    :param dtype:         Data type of the regressors
+    :param backend:       "memory" or "memmap"
+    :param chunk_size:    Time bins per chunk for the "memmap" backend
+    :return:              dict of component name to bytes
+    """
+    assert backend in ("memory", "memmap")
+    itemsize = np.dtype(dtype).itemsize
+    f8 = 8
+    D = N * B
+    T_total = n_datasets * T
+
+    # Time bins that are resident at once
+    if backend == "memory":
+        T_res = T
+        counts = T_total * N * f8
+        regressors = T_total * D * itemsize
+    else:
+        assert chunk_size is not None and chunk_size > 0
+        T_res = min(chunk_size, T)
+        counts = T_res * N * f8
+        regressors = T_res * D * itemsize
+
+    # Gaussian regressions with in-memory, convolved data are resampled
+    # from the Gram statistics, without the per-bin potentials
+    uses_gram = family == "gaussian" and backend == "memory"
+    T_block = min(T_res, ROW_BLOCK)
+    upcast = T_block * D * f8 if itemsize < f8 else 0
+    if uses_gram:
+        auxiliary = T_res * f8
+        workspace = upcast
+        gram = (D * D + D + D * N + 2 * N) * f8
+    else:
+        auxiliary = 2 * T_total * f8 + T_res * f8
+        workspace = (T_block * D + D * D + D) * f8 + upcast
+        gram = 0
+
+    # Prior, likelihood and posterior potentials, plus the submatrices
+    # of the active inputs in the collapsed updates
+    posterior = 5 * (D + 1) ** 2 * f8
+
+    # The weight prior is kept in factored form (see set_weight_prior)
+    network = (2 * (B + B * B) + N * N) * f8
+    parameters = (N * N * B + N + N * N) * f8 + N * N
+
+    per_sample = (N * N * B + N) * f8 + N * N
+    if sample_rates:
+        per_sample += T_total * N * f8
+
+    return dict(counts=counts,
+                regressors=regressors,
+                auxiliary=auxiliary,
+                workspace=workspace,
+                gram_statistics=gram,
+                posterior=posterior,
+                network=network,
+                parameters=parameters,
+                samples=n_samples * per_sample)
+
+
+def format_bytes(n):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024.0
+    return "{:.1f} TiB".format(n)
+
+
+class MemoryPlan(object):
+    """
+    How to store the data of a fit, and the memory it is expected to need.
+    """
+    def __init__(self, backend, dtype, chunk_size, estimate, budget=None):
+        self.backend = backend
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.estimate = estimate
+        self.budget = budget
+
+    @property
+    def total(self):
+        return sum(self.estimate.values())
+
+    def __repr__(self):
+        return "MemoryPlan(backend={!r}, dtype={}, chunk_size={}, total={})".format(
+            self.backend, self.dtype, self.chunk_size, format_bytes(self.total))
+
+    def report(self):
+        """
+        A table of the expected peak memory of each component.
+        """
+        lines = ["{:<16s}{:>12s}".format(name, format_bytes(size))
+                 for name, size in sorted(self.estimate.items(), key=lambda kv: -kv[1])]
+        lines.append("{:<16s}{:>12s}".format("total", format_bytes(self.total)))
+        if self.budget is not None:
+            lines.append("{:<16s}{:>12s}".format("budget", format_bytes(self.budget)))
+        return "\n".join(lines)
+
+    def add_data(self, model, Y, directory=None):
+        """
+        Convolve the spike counts and add them to the model as planned.
+
+        :param model:      A NonlinearAutoregressiveModel
+        :param Y:          TxN array of spike counts
+        :param directory:  Where to write the regressors, for the
+                           "memmap" backend
+        """
+        if self.backend == "memmap":
+            assert directory is not None, "The memmap backend needs a directory"
+            model.add_data(ChunkedDataset.from_spikes(
+                Y, model.basis, directory,
+                chunk_size=self.chunk_size, dtype=self.dtype))
+            return
+
+        if self.dtype == np.float64:
+            model.add_data(Y)
+            return
+
+        # Convolve a chunk at a time, so the double precision
+        # regressors never exist all at once
+        T, N = Y.shape
+        L, B = model.basis.shape
+        X = np.empty((T, N, B), dtype=self.dtype)
+        step = self.chunk_size or 10000
+        for start in range(0, T, step):
+            stop = min(start + step, T)
+            pad = min(start, L)
+            X[start:stop] = convolve_with_basis(Y[start-pad:stop], model.basis)[pad:]
+        # X is the basis convolution of Y, so Gaussian regressions can
+        # still be resampled from the Gram statistics as estimated
+        model.add_data(Y, X=X, convolved=True)
+
+
+def plan_memory(N, B, T, budget,
+                n_datasets=1,
+                family="bernoulli",
+                n_samples=0,
+                sample_rates=False,
+                min_chunk_size=1000):
+    """
+    Choose the storage of the regressors so that the fit stays within
+    the budget. In order of preference: in memory in double precision,
+    in memory in single precision, and memory-mapped in double
+    precision with the largest chunks that fit.
+
+    :param budget:          Memory budget in bytes
+    :param min_chunk_size:  Smallest chunk size worth streaming
+    :return:                A MemoryPlan
+    """
+    kwargs = dict(n_datasets=n_datasets, family=family,
+                  n_samples=n_samples, sample_rates=sample_rates)
+
+    for dtype in (np.float64, np.float32):
+        estimate = estimate_memory(N, B, T, dtype=dtype, backend="memory", **kwargs)
+        if sum(estimate.values()) <= budget:
+            return MemoryPlan("memory", dtype, None, estimate, budget=budget)
+
+    # The memory-mapped footprint is affine in the chunk size
+    def total(chunk_size):
+        return sum(estimate_memory(N, B, T, dtype=np.float64, backend="memmap",
+                                   chunk_size=chunk_size, **kwargs).values())
+
+    base = total(1)
+    slope = total(2) - base
+    chunk_size = min(T, int((budget - base) // slope) + 1) if budget >= base else 0
+    if chunk_size < min(min_chunk_size, T):
+        raise MemoryError(
+            "A fit with N={}, B={} and T={} needs at least {} "
+            "(with chunks of {} bins), more than the budget of {}".format(
+                N, B, T, format_bytes(total(min(min_chunk_size, T))),
+                min(min_chunk_size, T), format_bytes(budget)))
+
+    estimate = estimate_memory(N, B, T, dtype=np.float64, backend="memmap",
+                               chunk_size=chunk_size, **kwargs)
+    return MemoryPlan("memmap", np.float64, chunk_size, estimate, budget=budget)
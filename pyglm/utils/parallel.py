@@ -0,0 +1,218 @@
+"""
+Long-lived worker processes that each own a single object.
+
+Gibbs samplers carry a lot of state (data, convolved regressors, the
+current sample), so rather than shipping it to a pool on every call we
+build the object once inside a dedicated process and then send it
+method calls over a pipe. Results come back pickled, so callers should
+ask for summaries rather than for the data.
+
+A RemoteWorker speaks the same protocol over a multiprocessing.connection
+socket (a Unix socket path or a (host, port) pair) instead of a pipe, so
+the object can live in a server started with 'serve' on another host.
+"""
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+
+def _worker_loop(conn, factory, args, kwargs):
+    try:
+        obj = factory(*args, **kwargs)
+        conn.send(("ok", None))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        name, args, kwargs = msg
+        try:
+            attr = getattr(obj, name)
+            result = attr(*args, **kwargs) if callable(attr) else attr
+            conn.send(("ok", result))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Worker(object):
+    """
+    A process that builds an object with factory(*args, **kwargs) and
+    then calls its methods (or reads its attributes) on request.
+    """
+    def __init__(self, factory, *args, **kwargs):
+        self._conn, child = mp.Pipe()
+        self._process = mp.Process(target=_worker_loop,
+                                   args=(child, factory, args, kwargs))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+        self._pending = True
+
+        # Wait for the object to be built
+        self.result()
+
+    def submit(self, name, *args, **kwargs):
+        """
+        Start calling obj.name(*args, **kwargs) without waiting for the result.
+        If 'name' is not callable, its value is returned instead.
+        """
+        assert not self._pending, "Collect the previous result first"
+        self._conn.send((name, args, kwargs))
+        self._pending = True
+
+    def result(self):
+        """
+        Wait for the result of the last submitted call.
+        """
+        assert self._pending
+        status, value = self._conn.recv()
+        self._pending = False
+        if status == "error":
+            raise WorkerError(value)
+        return value
+
+    def call(self, name, *args, **kwargs):
+        self.submit(name, *args, **kwargs)
+        return self.result()
+
+    def close(self):
+        if self._process.is_alive():
+            try:
+                self._conn.send(None)
+            except (IOError, OSError):
+                pass
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+
+
+class LocalWorker(object):
+    """
+    The same interface as Worker, but the object lives in this process.
+    Useful for debugging, or when there is only one core to spare.
+    """
+    def __init__(self, factory, *args, **kwargs):
+        self.obj = factory(*args, **kwargs)
+        self._result = None
+
+    def submit(self, name, *args, **kwargs):
+        attr = getattr(self.obj, name)
+        self._result = attr(*args, **kwargs) if callable(attr) else attr
+
+    def result(self):
+        result, self._result = self._result, None
+        return result
+
+    def call(self, name, *args, **kwargs):
+        self.submit(name, *args, **kwargs)
+        return self.result()
+
+    def close(self):
+        pass
+
+
+def _check_authkey(address, authkey):
+    # The connections carry pickles, and unpickling runs arbitrary code,
+    # so anything reachable over the network must authenticate its peer
+    if not isinstance(address, str) and not authkey:
+        raise ValueError("A non-empty authkey is required for the network "
+                         "address {!r}".format(address))
+
+
+def serve(address, authkey=None):
+    """
+    Listen on 'address' for a single client. The client's first message
+    is (factory, args, kwargs); the object is then served as by a Worker.
+
+    :param address:  A Unix socket path, or a (host, port) pair
+    :param authkey:  Key the client must present. Required for (host, port)
+                     addresses, since the messages are pickles.
+    """
+    _check_authkey(address, authkey)
+    listener = Listener(address, authkey=authkey)
+    try:
+        conn = listener.accept()
+        factory, args, kwargs = conn.recv()
+        _worker_loop(conn, factory, args, kwargs)
+        conn.close()
+    finally:
+        listener.close()
+
+
+def start_server(address, authkey=None):
+    """
+    Run 'serve' in a local daemon process.
+    """
+    _check_authkey(address, authkey)
+    process = mp.Process(target=serve, args=(address, authkey))
+    process.daemon = True
+    process.start()
+    return process
+
+
+class RemoteWorker(Worker):
+    """
+    A Worker whose object lives in a server (see serve) listening on
+    'address'. If the server was started locally, pass its process so
+    that closing the worker also stops it. As for 'serve', (host, port)
+    addresses need an authkey.
+    """
+    def __init__(self, address, authkey=None, process=None, timeout=30.0):
+        _check_authkey(address, authkey)
+        # The server may not be listening yet
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._conn = Client(address, authkey=authkey)
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+        self._process = process
+        self._pending = False
+
+    def build(self, factory, *args, **kwargs):
+        """
+        Start building the served object with factory(*args, **kwargs).
+        Call 'result' to wait for it.
+        """
+        assert not self._pending
+        self._conn.send((factory, args, kwargs))
+        self._pending = True
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+        if self._process is not None:
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+
+
+def call_all(workers, name, args=None):
+    """
+    Call the same method on every worker concurrently.
+
+    :param args:  Optional list with one tuple of arguments per worker
+    :return:      List of results, in the order of the workers
+    """
+    for i, worker in enumerate(workers):
+        worker.submit(name, *(args[i] if args is not None else ()))
+    return [worker.result() for worker in workers]
@@ -25,3 +25,145 @@ def expand_cov(c, shp):
         assert c.shape == shp
 
     return c
+
+def pcg(A, b, M=None, x0=None, tol=1e-8, maxiter=None):
+    """
+    Solve A x = b for a symmetric positive definite A with
+    preconditioned conjugate gradients.
+
+    :param A:       function computing the product A.dot(v)
+    :param b:       right hand side
+    :param M:       function approximating the product A^{-1}.dot(v)
+    :param x0:      initial guess
+    :param tol:     tolerance on the residual norm, relative to |b|
+    :param maxiter: maximum number of iterations (default 10 * b.size)
+    """
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=float)
+    maxiter = 10 * b.size if maxiter is None else maxiter
+    bnorm = np.linalg.norm(b)
+
+    r = b - A(x)
+    z = r if M is None else M(r)
+    p = z.copy()
+    rz = r.dot(z)
+    for _ in range(maxiter):
+        if np.linalg.norm(r) <= tol * bnorm:
+            break
+        Ap = A(p)
+        alpha = rz / p.dot(Ap)
+        x += alpha * p
+        r -= alpha * Ap
+        z = r if M is None else M(r)
+        rz_new = r.dot(z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+
+    return x
+
+class Workspace(object):
+    """
+    A pool of named scratch buffers that are reused across calls.
+    Each buffer grows to the largest size requested of it and is
+    handed out as a view of the requested shape, so repeated calls
+    with the same (or smaller) shapes do not allocate.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=float, order='C', zero=False):
+        """
+        :param name:   Key of the buffer
+        :param shape:  Shape of the view to return
+        :param order:  'C' or 'F' memory layout of the view
+        :param zero:   Whether to zero the view before returning it
+        :return:       An array of the given shape. Its contents are
+                       overwritten by the next request for this name.
+        """
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != np.dtype(dtype):
+            buf = self._buffers[name] = np.empty(size, dtype=dtype)
+
+        out = buf[:size].reshape(shape, order=order)
+        if zero:
+            out.fill(0)
+        return out
+
+    def clear(self):
+        self._buffers = {}
+
+def pg_moments(b, c):
+    """
+    Mean and variance of the Polya-gamma distribution PG(b, c).
+    For small |c| we use their Taylor expansions to avoid cancellation.
+    """
+    b = np.asarray(b, dtype=float)
+    c = np.abs(np.asarray(c, dtype=float))
+    small = c < 1e-3
+    cs = np.where(small, 1.0, c)
+
+    mean = np.where(small,
+                    b / 4.0 * (1 - c**2 / 12.0),
+                    b / (2 * cs) * np.tanh(cs / 2))
+    var = np.where(small,
+                   b / 24.0 * (1 - c**2 / 5.0),
+                   b / (4 * cs**3) * (np.sinh(cs) - cs) / np.cosh(cs / 2)**2)
+    return mean, var
+
+def sample_pg_normal(b, c, min_omega=1e-12):
+    """
+    Approximate draws from PG(b, c) with a moment-matched normal. PG(b, c)
+    is a sum of b independent PG(1, c) variables, so this is accurate
+    for large b. The draws are truncated at min_omega to keep them positive.
+    """
+    mean, var = pg_moments(b, c)
+    omega = mean + np.sqrt(var) * np.random.randn(*mean.shape)
+    return np.maximum(omega, min_omega)
+
+def effective_sample_size(samples):
+    """
+    Effective sample size of each dimension of a chain of samples,
+    estimated from its autocorrelations with Geyer's initial positive
+    sequence: we sum pairs of consecutive autocorrelations until the
+    first pair whose sum is negative.
+
+    :param samples:  S x ... array of samples, one row per iteration
+    :return:         ESS of each dimension. Constant dimensions get nan.
+    """
+    samples = np.asarray(samples, dtype=float)
+    S = samples.shape[0]
+    x = samples.reshape((S, -1))
+    x = x - x.mean(0)
+
+    # Autocovariances of all dimensions via the FFT
+    n = 2 ** int(np.ceil(np.log2(2 * S)))
+    f = np.fft.rfft(x, n=n, axis=0)
+    acov = np.fft.irfft(f * np.conj(f), n=n, axis=0)[:S] / S
+
+    ess = np.empty(x.shape[1])
+    ess.fill(np.nan)
+    for d in np.where(acov[0] > 0)[0]:
+        rho = acov[:, d] / acov[0, d]
+        pairs = rho[:S - S % 2].reshape((-1, 2)).sum(1)
+        neg = np.where(pairs < 0)[0]
+        K = neg[0] if neg.size > 0 else pairs.size
+        tau = -1 + 2 * pairs[:K].sum()
+        ess[d] = S / max(tau, 1.0 / S)
+
+    return ess.reshape(samples.shape[1:]) if samples.ndim > 1 else ess[0]
+
+def sparse_connectivity(A, W):
+    """
+    Sparse form of an adjacency matrix and its weights, as accepted by
+    the network models.
+
+    :param A:  NxN boolean adjacency matrix (post x pre)
+    :param W:  NxNxB weights
+    :return:   The adjacency as a scipy.sparse CSR matrix, and an nnz x B
+               array of the weights of its entries, in CSR order
+    """
+    import scipy.sparse as sp
+    rows, cols = np.nonzero(A)
+    N = A.shape[0]
+    A_sp = sp.csr_matrix((np.ones(rows.size, dtype=bool), (rows, cols)), shape=(N, N))
+    return A_sp, W[rows, cols]
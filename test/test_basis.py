@@ -0,0 +1,69 @@
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.utils.basis import cosine_basis, convolve_with_basis, \
+    basis_gram_statistics, gram_statistics, exponential_basis, alpha_basis, \
+    recursive_form, bin_spike_times, convolve_spike_times
+
+
+def test_basis_gram_statistics():
+    # The statistics from the correlations should equal those of the
+    # regressors, for dense and sparse spike trains and for recordings
+    # shorter than the basis
+    np.random.seed(0)
+    N, B, L = 4, 3, 20
+    basis = cosine_basis(B, L=L) / L
+    for T, rate in [(500, 1.0), (500, 0.02), (10, 1.0)]:
+        S = np.random.poisson(rate, size=(T, N)).astype(float)
+        expected = gram_statistics(convolve_with_basis(S, basis), S)
+        for counts in (S, sp.csr_matrix(S)):
+            stats = basis_gram_statistics(counts, basis)
+            for k in expected:
+                assert np.allclose(stats[k], expected[k]), k
+
+
+def test_recursive_basis():
+    # Filtering recursively, in a batch or a bin at a time, should give
+    # the FIR convolution with the truncated basis
+    np.random.seed(0)
+    T, N, L = 500, 3, 100
+    S = np.random.poisson(0.2, size=(T, N)).astype(float)
+    for make_basis in (exponential_basis, alpha_basis):
+        basis = make_basis([3., 20.], L=L) / L
+        assert recursive_form(basis) is not None
+        expected = convolve_with_basis(S, np.asarray(basis))
+        assert np.allclose(convolve_with_basis(S, basis), expected)
+
+        # The regressors of bin t follow from the counts before it
+        stepper = basis.stepper(N)
+        for t in range(1, T):
+            assert np.allclose(stepper.push(S[t-1]).T, expected[t])
+
+
+def test_spike_times():
+    # Binning and convolving spike times should match the dense counts
+    np.random.seed(0)
+    N, B, L, dt, duration = 3, 2, 10, 0.01, 5.0
+    basis = cosine_basis(B, L=L) / L
+    spike_times = [np.sort(np.random.rand(np.random.poisson(100)) * duration) for _ in range(N)]
+
+    T = int(np.ceil(duration / dt))
+    Y = np.zeros((T, N))
+    for n, st in enumerate(spike_times):
+        np.add.at(Y[:, n], np.floor(st / dt).astype(int), 1)
+
+    T_bins, t, n, c = bin_spike_times(spike_times, dt, duration)
+    assert T_bins == T
+    Y_bins = np.zeros((T, N))
+    Y_bins[t, n] = c
+    assert np.array_equal(Y_bins, Y)
+
+    X, Y_sparse = convolve_spike_times(spike_times, basis, dt, duration)
+    assert np.array_equal(Y_sparse.toarray(), Y)
+    assert np.allclose(X, convolve_with_basis(Y, basis))
+
+
+if __name__ == "__main__":
+    test_basis_gram_statistics()
+    test_recursive_basis()
+    test_spike_times()
@@ -0,0 +1,78 @@
+import numpy as np
+
+from pyglm.models import SparseBernoulliGLM
+from pyglm.batched import BatchedGLMs, _masked_gaussian_log_normalizer, \
+    _batched_triangular_solve
+from pyglm.utils.basis import cosine_basis
+
+
+def test_batched_log_likelihood():
+    # The batch should reproduce each model's likelihood, including
+    # models whose recordings are shorter than the longest one
+    np.random.seed(0)
+    N, B, L = 4, 2, 5
+    basis = cosine_basis(B, L=L) / L
+    models = []
+    for T in (300, 200, 250):
+        model = SparseBernoulliGLM(N, basis=basis, regression_kwargs=dict(pg_method="normal"))
+        model.add_data((np.random.rand(T, N) < 0.2).astype(float))
+        models.append(model)
+
+    batch = BatchedGLMs(models)
+    for _ in range(2):
+        batch.resample_model()
+        assert np.allclose(batch.log_likelihoods(), [m.log_likelihood() for m in models])
+
+
+def test_batched_posterior():
+    # With the Polya-gamma variables fixed, the batched posterior of each
+    # regression should match the regression's own computations, for
+    # models with recordings of different lengths (padded in the batch)
+    np.random.seed(0)
+    N, B, L = 3, 2, 5
+    basis = cosine_basis(B, L=L) / L
+    models = []
+    for T in (120, 80):
+        model = SparseBernoulliGLM(N, basis=basis, regression_kwargs=dict(pg_method="normal"))
+        model.add_data((np.random.rand(T, N) < 0.3).astype(float))
+        models.append(model)
+    batch = BatchedGLMs(models)
+    R = len(models) * N
+
+    omega = np.random.gamma(1.0, 0.25, size=batch.Y.shape) * batch.mask[:, :, None]
+    kappa = (batch.Y - 0.5) * batch.mask[:, :, None]
+    J_post, h_post, c_w, c_b = batch._posterior_potentials(omega, kappa)
+
+    a = np.random.rand(R, N) < 0.5
+    a[0] = True
+    ml = batch._marginal_likelihoods(J_post, h_post, c_w, c_b, a)
+    mask = batch._mask(a)
+    _, Lf, v = _masked_gaussian_log_normalizer(J_post, h_post, mask, return_factors=True)
+    mean = _batched_triangular_solve(Lf, v, trans=True)
+
+    for m, model in enumerate(models):
+        (X, Y), = model.data_list
+        T = Y.shape[0]
+        for n, reg in enumerate(model.regressions):
+            r = m * N + n
+            potentials = [(X.reshape((T, -1)), omega[m, :T, n], kappa[m, :T, n])]
+            J_prior, h_prior = reg._prior_sufficient_statistics()
+            J_lkhd, h_lkhd = reg._lkhd_sufficient_statistics(None, potentials=potentials)
+            J, h = J_prior + J_lkhd, h_prior + h_lkhd
+            assert np.allclose(J_post[r], J) and np.allclose(h_post[r], h)
+
+            reg.a = a[r].copy()
+            assert np.isclose(ml[r], reg._marginal_likelihood(J_prior, h_prior, J, h))
+
+            # Posterior mean and covariance of the active weights and bias
+            act = mask[r]
+            cov = np.linalg.inv(J[np.ix_(act, act)])
+            assert np.allclose(mean[r, act], cov.dot(h[act]))
+            assert np.allclose(mean[r, ~act], 0)
+            L_act = Lf[r][np.ix_(act, act)]
+            assert np.allclose(np.linalg.inv(L_act.dot(L_act.T)), cov)
+
+
+if __name__ == "__main__":
+    test_batched_log_likelihood()
+    test_batched_posterior()
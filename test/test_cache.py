@@ -0,0 +1,40 @@
+import os
+import tempfile
+import numpy as np
+
+from pyglm.utils.basis import cosine_basis, convolve_with_basis
+from pyglm.utils.cache import ConvolutionCache
+
+
+def test_cache_concurrent_eviction():
+    np.random.seed(0)
+    basis = cosine_basis(2, L=5) / 5
+    S = np.random.poisson(0.5, size=(100, 3)).astype(float)
+    cache = ConvolutionCache(tempfile.mkdtemp())
+    X = cache.convolve(S, basis)
+    assert np.allclose(X, convolve_with_basis(S, basis))
+
+    # Another process evicts the entry: the cache should neither fail
+    # nor return it, and convolving writes it again
+    path = X.filename
+    os.remove(path)
+    cache._remove(path)
+    cache.evict()
+    assert cache.get(S, basis) is None
+    assert np.allclose(cache.convolve(S, basis), convolve_with_basis(S, basis))
+
+    # Entries removed while they are listed are skipped
+    stat = os.stat
+    def stat_removed(p):
+        os.remove(p)
+        return stat(p)
+    os.stat = stat_removed
+    try:
+        assert cache.entries() == []
+    finally:
+        os.stat = stat
+    cache.clear()
+
+
+if __name__ == "__main__":
+    test_cache_concurrent_eviction()
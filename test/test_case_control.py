@@ -0,0 +1,51 @@
+import numpy as np
+
+from pyglm.regression import SparseBernoulliRegression
+
+
+def _data(N, T):
+    X = np.random.randn(T, N)
+    y = (np.random.rand(T) < 0.1).astype(float)
+    return X, y
+
+
+def test_case_control_weight():
+    # Reweighting the kept silent bins by 1/f makes the likelihood
+    # potential unbiased for that of all the bins
+    np.random.seed(0)
+    N, T, f = 2, 2000, 0.2
+    X, y = _data(N, T)
+    Z = np.column_stack((X, np.ones(T)))
+    h_full = Z.T.dot(y - 0.5)
+
+    reg = SparseBernoulliRegression(N, 1, pg_method="normal",
+                                    case_control=f, case_control_correction="weight")
+    hs = []
+    for _ in range(1000):
+        (Xk, omega, kappa), = reg._lkhd_potentials([(X, y)])
+        hs.append(np.column_stack((Xk, np.ones(Xk.shape[0]))).T.dot(kappa))
+    hs = np.array(hs)
+    se = hs.std(0) / np.sqrt(len(hs))
+    assert np.all(np.abs(hs.mean(0) - h_full) < 4 * se)
+
+
+def test_case_control_offset():
+    # The offset correction keeps every spike, and its potentials are
+    # those of the logistic likelihood with activation psi - log(f)
+    np.random.seed(0)
+    N, T, f = 2, 2000, 0.2
+    X, y = _data(N, T)
+    reg = SparseBernoulliRegression(N, 1, pg_method="normal",
+                                    case_control=f, case_control_correction="offset")
+    (Xk, omega, kappa), = reg._lkhd_potentials([(X, y)])
+    keep = np.array([np.any(np.all(Xk == x, axis=1)) for x in X])
+    assert np.all(keep[y > 0])
+    assert np.allclose(kappa + omega * -np.log(f), y[keep] - 0.5)
+
+    stats = reg.case_control_variance([(X, y)])
+    assert np.isclose(stats["kept_fraction"], np.mean(np.where(y > 0, 1, f)))
+
+
+if __name__ == "__main__":
+    test_case_control_weight()
+    test_case_control_offset()
@@ -0,0 +1,55 @@
+import tempfile
+import numpy as np
+
+from pyglm.models import SparseGaussianGLM
+from pyglm.utils.basis import cosine_basis, convolve_with_basis
+from pyglm.utils.data import ChunkedDataset
+
+
+def test_chunked_statistics():
+    # Streaming the data from disk in chunks should give the same
+    # likelihood potentials and log likelihood as holding it in memory
+    np.random.seed(0)
+    N, B, L, T = 3, 2, 10, 500
+    basis = cosine_basis(B, L=L) / L
+    Y = np.random.randn(T, N)
+
+    model = SparseGaussianGLM(N, basis=basis)
+    model.add_data(Y)
+    chunked = ChunkedDataset.from_spikes(Y, basis, tempfile.mkdtemp(), chunk_size=37)
+    assert isinstance(chunked.X, np.memmap)
+    assert np.allclose(chunked.X, model.data_list[0][0])
+
+    for n, reg in enumerate(model.regressions):
+        J, h = reg._lkhd_sufficient_statistics([(model.data_list[0][0], Y[:, n])])
+        J = J.copy()
+        J_chunked, h_chunked = reg._lkhd_sufficient_statistics([chunked.column(n)])
+        assert np.allclose(J, J_chunked) and np.allclose(h, h_chunked)
+
+    assert np.isclose(model.log_likelihood(), model.log_likelihood([chunked]))
+
+
+def test_spike_times_round_trip():
+    # Datasets built from spike times on disk should load back with
+    # their sparse counts, and match the convolution of the counts
+    np.random.seed(0)
+    N, B, L, dt, duration = 3, 2, 10, 0.01, 5.0
+    basis = cosine_basis(B, L=L) / L
+    spike_times = [np.sort(np.random.rand(np.random.poisson(50)) * duration) for _ in range(N)]
+
+    directory = tempfile.mkdtemp()
+    written = ChunkedDataset.from_spike_times(spike_times, basis, dt, duration,
+                                              directory=directory, chunk_size=37)
+    loaded = ChunkedDataset.load(directory, chunk_size=37)
+    assert isinstance(loaded.X, np.memmap)
+
+    Y = written.dense_Y()
+    assert Y.sum() > 0
+    assert np.array_equal(loaded.dense_Y(), Y)
+    assert np.allclose(loaded.X, convolve_with_basis(Y, basis))
+    assert np.allclose(loaded.X, written.X)
+
+
+if __name__ == "__main__":
+    test_chunked_statistics()
+    test_spike_times_round_trip()
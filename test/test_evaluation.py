@@ -0,0 +1,78 @@
+import numpy as np
+
+from scipy.special import logsumexp
+
+from pyglm.models import SparseBernoulliGLM, SparseGaussianGLM
+from pyglm.evaluation import PosteriorPredictive
+from pyglm.utils.basis import cosine_basis, exponential_basis
+
+
+def _check_log_likelihoods(model, Y_train, Y_test, N_samples=5):
+    # The stacked likelihoods of the samples should match loading each
+    # one back into the model
+    model.add_data(Y_train)
+    samples = dict(weights=[], adjacency=[], biases=[], eta=[])
+    lls = []
+    for _ in range(N_samples):
+        model.resample_model()
+        samples["weights"].append(model.weights)
+        samples["adjacency"].append(model.adjacency)
+        samples["biases"].append(model.biases)
+        if isinstance(model, SparseGaussianGLM):
+            samples["eta"].append([reg.eta for reg in model.regressions])
+        lls.append(model.log_likelihood([Y_test]))
+    samples = dict((k, np.array(v)) for k, v in samples.items() if len(v) > 0)
+
+    predictive = PosteriorPredictive.from_samples(model, samples)
+    ll = predictive.log_likelihoods(Y_test, chunk_size=37)
+    assert ll.shape == (N_samples, model.N)
+    assert np.allclose(ll.sum(1), lls)
+    assert np.isclose(predictive.log_predictive_density(Y_test),
+                      logsumexp(lls) - np.log(N_samples))
+
+
+def test_bernoulli_log_likelihoods():
+    np.random.seed(0)
+    N, B, L = 3, 2, 10
+    basis = cosine_basis(B, L=L) / L
+    model = SparseBernoulliGLM(N, basis=basis, regression_kwargs=dict(pg_method="normal"))
+    Y_train = (np.random.rand(300, N) < 0.2).astype(float)
+    Y_test = (np.random.rand(100, N) < 0.2).astype(float)
+    _check_log_likelihoods(model, Y_train, Y_test)
+
+
+def test_gaussian_log_likelihoods():
+    np.random.seed(0)
+    N, B, L = 3, 2, 10
+    basis = cosine_basis(B, L=L) / L
+    model = SparseGaussianGLM(N, basis=basis)
+    _check_log_likelihoods(model, np.random.randn(300, N), np.random.randn(100, N))
+
+
+def test_simulate_recursive_basis():
+    # Stepping a recursive basis should simulate the same trajectories
+    # as convolving its matrix, also from a history shorter than L
+    np.random.seed(0)
+    S, N, L = 4, 3, 20
+    basis = exponential_basis([2., 5.], L=L)
+    B = basis.shape[1]
+    params = dict(weights=0.3 * np.random.randn(S, N, N, B),
+                  adjacency=np.random.rand(S, N, N) < 0.5,
+                  biases=np.random.randn(S, N), eta=0.1 * np.ones((S, N)),
+                  family="gaussian")
+    recursive = PosteriorPredictive(basis, **params)
+    fir = PosteriorPredictive(np.array(basis), **params)
+
+    for history in (None, np.random.randn(S, 5, N), np.random.randn(L + 3, N)):
+        np.random.seed(1)
+        Y_recursive = recursive.simulate(30, history=history)
+        np.random.seed(1)
+        Y_fir = fir.simulate(30, history=history)
+        assert Y_fir.shape == (S, 30, N)
+        assert np.allclose(Y_recursive, Y_fir)
+
+
+if __name__ == "__main__":
+    test_bernoulli_log_likelihoods()
+    test_gaussian_log_likelihoods()
+    test_simulate_recursive_basis()
@@ -0,0 +1,38 @@
+import numpy as np
+
+from pyglm.utils.memory import estimate_memory, plan_memory
+
+
+def _total(N, B, T, **kwargs):
+    return sum(estimate_memory(N, B, T, **kwargs).values())
+
+
+def test_plan_memory():
+    N, B, T = 10, 3, 20000
+    f64 = _total(N, B, T, dtype=np.float64)
+    f32 = _total(N, B, T, dtype=np.float32)
+    assert f32 < f64
+
+    # The cheapest storage that fits the budget is chosen
+    plan = plan_memory(N, B, T, f64)
+    assert plan.backend == "memory" and plan.dtype == np.float64
+
+    plan = plan_memory(N, B, T, f64 - 1)
+    assert plan.backend == "memory" and plan.dtype == np.float32
+
+    # The memory-mapped plan takes the largest chunks that fit
+    budget = f32 // 2
+    plan = plan_memory(N, B, T, budget)
+    assert plan.backend == "memmap"
+    assert plan.total <= budget
+    assert _total(N, B, T, backend="memmap", chunk_size=plan.chunk_size + 1) > budget
+
+    try:
+        plan_memory(N, B, T, 1000)
+        assert False, "The budget should be too small"
+    except MemoryError:
+        pass
+
+
+if __name__ == "__main__":
+    test_plan_memory()
@@ -0,0 +1,59 @@
+import tempfile
+import numpy as np
+
+from pyglm.models import SparseGaussianGLM
+from pyglm.model_selection import ModelSelection, expand_grid
+from pyglm.utils.basis import cosine_basis, convolve_with_basis, gram_statistics, \
+    correlations_are_cheaper
+
+
+def test_expand_grid():
+    configs = expand_grid({"regression_kwargs__S_w": [0.1, 1.0],
+                           "regression_kwargs__mu_b": [0.0],
+                           "p": [0.1, 0.5]})
+    assert len(configs) == 4
+    assert configs[0] == dict(p=0.1, regression_kwargs=dict(S_w=0.1, mu_b=0.0))
+    assert set((c["p"], c["regression_kwargs"]["S_w"]) for c in configs) == \
+        set([(0.1, 0.1), (0.1, 1.0), (0.5, 0.1), (0.5, 1.0)])
+
+
+def test_fold_statistics():
+    # The folds should partition every recording, and the statistics of
+    # the full recordings minus the held-out blocks should equal the
+    # statistics of the training blocks
+    np.random.seed(0)
+    N, L = 3, 10
+    datas = [np.random.poisson(1.0, size=(T, N)).astype(float) for T in (203, 150)]
+    bases = [cosine_basis(2, L=L) / L, cosine_basis(4, L=L) / L]
+    # The second basis gets its statistics from the cross-correlations
+    assert [correlations_are_cheaper(datas[0], basis) for basis in bases] == [False, True]
+    ms = ModelSelection(SparseGaussianGLM, datas, bases, [{}], n_folds=4,
+                        cache=tempfile.mkdtemp())
+
+    folds = list(ms.folds())
+    assert len(folds) == 4
+    for train, test in folds:
+        for d, Y in enumerate(datas):
+            covered = np.zeros(Y.shape[0], dtype=int)
+            for dd, slc in train + test:
+                if dd == d:
+                    covered[slc] += 1
+            assert np.all(covered == 1)
+
+    for basis, jobs in zip(bases, ms.jobs()):
+        Xs = [convolve_with_basis(Y, basis) for Y in datas]
+        for job in jobs:
+            stats = dict(job["stats"])
+            for d, slc in job["test"]:
+                for k, v in gram_statistics(Xs[d][slc], datas[d][slc]).items():
+                    stats[k] = stats[k] - v
+
+            X = np.concatenate([Xs[d][slc] for d, slc in job["train"]])
+            Y = np.concatenate([datas[d][slc] for d, slc in job["train"]])
+            for k, v in gram_statistics(X, Y).items():
+                assert np.allclose(stats[k], v)
+
+
+if __name__ == "__main__":
+    test_expand_grid()
+    test_fold_statistics()
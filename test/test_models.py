@@ -0,0 +1,47 @@
+import pickle
+import numpy as np
+
+from pyglm.models import SparseGaussianGLM
+
+
+def test_parameter_views():
+    # Each regression's parameters are views of one row of the model's
+    # arrays, and stay so after a pickle round trip
+    np.random.seed(0)
+    N, B = 4, 2
+    model = SparseGaussianGLM(N, B=B)
+
+    def check(model):
+        for n, reg in enumerate(model.regressions):
+            reg.a[:] = np.arange(N) % 2 == n % 2
+            reg.W[:] = n + np.arange(N*B).reshape((N, B))
+            reg.b[:] = -n
+            assert np.shares_memory(reg.a, model._adjacency)
+            assert np.shares_memory(reg.W, model._weights)
+            assert np.shares_memory(reg.b, model._biases)
+            assert np.shares_memory(reg.rho, model._rho)
+        for n in range(N):
+            assert np.array_equal(model._adjacency[n], np.arange(N) % 2 == n % 2)
+            assert np.array_equal(model._weights[n], n + np.arange(N*B).reshape((N, B)))
+            assert model._biases[n] == -n
+
+        # The copies handed out are not views
+        W = model.weights
+        W[:] = 0
+        assert not np.all(model._weights == 0)
+
+    check(model)
+    copy = pickle.loads(pickle.dumps(model))
+    assert np.array_equal(copy.weights, model.weights)
+    for n, reg in enumerate(copy.regressions):
+        assert np.array_equal(reg.W, model.regressions[n].W)
+    check(copy)
+
+    # Writing through the copy leaves the original alone
+    copy.regressions[0].W[:] = 100
+    assert np.all(copy._weights[0] == 100)
+    assert not np.any(model._weights[0] == 100)
+
+
+if __name__ == "__main__":
+    test_parameter_views()
@@ -0,0 +1,66 @@
+import os
+import time
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.models import SparseGaussianGLM
+from pyglm.monitoring import LiveMonitor, decimate_matrix
+
+
+def test_decimate_matrix():
+    np.random.seed(0)
+    N = 7
+    A = np.random.randn(N, N, 2)
+
+    # Small matrices are copied as they are
+    D = decimate_matrix(A, 10)
+    assert np.array_equal(D, A) and not np.shares_memory(D, A)
+
+    # Otherwise average over blocks of 3, the last of which is partial
+    D = decimate_matrix(A, 3)
+    assert D.shape == (3, 3, 2)
+    blocks = [slice(0, 3), slice(3, 6), slice(6, 7)]
+    for i, rows in enumerate(blocks):
+        for j, cols in enumerate(blocks):
+            assert np.allclose(D[i, j], A[rows, cols].mean(axis=(0, 1)))
+
+    # Sparse matrices are summed into the blocks without densifying
+    S = sp.random(N, N, density=0.3, format="csr", random_state=0)
+    assert np.allclose(decimate_matrix(S, 3), decimate_matrix(S.toarray(), 3))
+    assert np.allclose(decimate_matrix(S, 10), S.toarray())
+
+
+def test_live_monitor_does_not_block():
+    np.random.seed(0)
+    N, T = 3, 200
+    model = SparseGaussianGLM(N, B=2)
+    model.add_data(np.random.randn(T, N))
+
+    filename = os.path.join(tempfile.mkdtemp(), "monitor.png")
+    monitor = LiveMonitor(fps=np.inf, filename=filename, pltslice=slice(0, 100))
+
+    # The renderer takes far longer to draw a frame than an update
+    # takes, so the queue fills up. Updates replace the pending
+    # snapshot rather than waiting for the renderer.
+    start = time.time()
+    for _ in range(50):
+        assert monitor.update(model)
+    assert time.time() - start < 5.0
+    assert monitor.frames_sent == 50
+
+    # Updates within 1/fps of the last snapshot are skipped
+    monitor.min_interval = 60.0
+    assert not monitor.update(model)
+    assert monitor.frames_skipped == 1
+
+    start = time.time()
+    monitor.close(timeout=30)
+    assert time.time() - start < 30.0
+    assert not monitor._process.is_alive()
+    assert os.path.exists(filename)
+
+
+if __name__ == "__main__":
+    test_decimate_matrix()
+    test_live_monitor_does_not_block()
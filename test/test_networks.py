@@ -0,0 +1,90 @@
+import numpy as np
+import scipy.sparse as sp
+
+from pyglm.models import SparseBernoulliGLM, SparseGaussianGLM
+from pyglm.networks import NIWSparseNetwork
+from pyglm.utils.utils import sparse_connectivity
+
+
+def _resample(data, seed):
+    N, B = 6, 2
+    np.random.seed(seed)
+    net = NIWSparseNetwork(N, B)
+    net.resample(data)
+    return net.weight_prior
+
+
+def test_sparse_network_resample():
+    # Resampling from the sparse connectivity should give the same
+    # weight prior as from the equivalent dense arrays
+    np.random.seed(0)
+    N, B = 6, 2
+    A = np.random.rand(N, N) < 0.4
+    A[0, 0] = A[1, 1] = True
+    W = np.random.randn(N, N, B) * A[:, :, None]
+
+    A_sp, W_sp = sparse_connectivity(A, W)
+    assert A_sp.nnz == A.sum()
+    for dense, sparse in zip(_resample((A, W), 1), _resample((A_sp, W_sp), 1)):
+        assert np.allclose(dense, sparse)
+
+    # Stored zeros of the sparse adjacency are absent connections
+    A_sp = A_sp.astype(float)
+    A_sp.data[0] = 0
+    A[np.nonzero(A)[0][0], np.nonzero(A)[1][0]] = False
+    for dense, sparse in zip(_resample((A, W), 2), _resample((A_sp, W_sp), 2)):
+        assert np.allclose(dense, sparse)
+
+
+def _sample(sparse, Y, N_iter=3):
+    np.random.seed(0)
+    N = Y.shape[1]
+    model = SparseGaussianGLM(N, B=2, sparse=sparse,
+                              network_kwargs=dict(rho=0.3, rho_self=0.8))
+    model.add_data(Y)
+    for _ in range(N_iter):
+        model.resample_model()
+    return model
+
+
+def test_sparse_model_matches_dense():
+    # Keeping the connections in CSR form should give the same chain
+    np.random.seed(1)
+    Y = np.random.randn(200, 8)
+    dense, sparse = _sample(False, Y), _sample(True, Y)
+    assert sp.issparse(sparse._adjacency)
+    assert sparse._weights.shape == (sparse._adjacency.nnz, 2)
+    assert sparse.regressions[0].a is None
+
+    assert np.array_equal(dense.adjacency, sparse.adjacency)
+    assert np.allclose(dense.weights, sparse.weights)
+    assert np.allclose(dense.biases, sparse.biases)
+    assert np.isclose(dense.log_likelihood(), sparse.log_likelihood())
+    assert np.allclose(dense.means[0], sparse.means[0])
+    for n in range(8):
+        assert np.allclose(dense.network.rho_row(n), dense._rho[n])
+
+    A_sp, W_sp = dense.connectivity
+    assert np.array_equal(A_sp.indptr, sparse._adjacency.indptr)
+    assert np.array_equal(A_sp.indices, sparse._adjacency.indices)
+    assert np.allclose(W_sp, sparse._weights)
+
+    # The sparse model simulates with its CSR weights
+    np.random.seed(2)
+    X, Y_dense = dense.generate(T=50, keep=False)
+    np.random.seed(2)
+    X, Y_sparse = sparse.generate(T=50, keep=False)
+    assert np.allclose(Y_dense, Y_sparse)
+
+
+def test_network_glm_with_three_basis_functions():
+    # The weight priors need nu_0 > B+1, whatever nu_0 is passed
+    model = SparseBernoulliGLM(4, B=3, regression_kwargs=dict(pg_method="normal"))
+    mu, sigma, mu_self, sigma_self = model.network.weight_prior
+    assert np.all(np.isfinite(sigma)) and np.all(np.isfinite(sigma_self))
+
+
+if __name__ == "__main__":
+    test_sparse_network_resample()
+    test_sparse_model_matches_dense()
+    test_network_glm_with_three_basis_functions()
@@ -0,0 +1,60 @@
+import numpy as np
+
+from pyglm.regression import SparseGaussianRegression
+from pyglm.models import NonlinearAutoregressiveModel, SparseGaussianGLM
+from pyglm.predictor import FrozenPredictor
+from pyglm.utils.basis import cosine_basis
+
+def test_frozen_predictor():
+    N = 4   # Number of neurons
+    B = 3   # Number of basis functions
+    L = 10  # Length of basis functions
+
+    basis = cosine_basis(B, L=L) / L
+    regressions = [SparseGaussianRegression(N, B, S_w=0.05, eta=0.1) for n in range(N)]
+    model = NonlinearAutoregressiveModel(N, regressions, basis=basis)
+    X, Y = model.generate(T=200, keep=True)
+    means = model.means[0]
+
+    # The predictor should reproduce the model's means one bin ahead
+    predictor = FrozenPredictor.from_model(model)
+    assert np.allclose(predictor.reset(), means[0])
+    for t in range(Y.shape[0]-1):
+        assert np.allclose(predictor.update(Y[t]), means[t+1])
+
+    # Priming the history should be equivalent to feeding it bin by bin
+    assert np.allclose(predictor.reset(history=Y[:50]), means[50])
+
+
+def test_sparse_frozen_predictor():
+    # Visiting only the present connections, given either the dense
+    # or the CSR connectivity, should give the dense product's rates
+    np.random.seed(0)
+    N, B, L = 6, 2, 10
+    basis = cosine_basis(B, L=L) / L
+    Y = np.random.randn(100, N)
+    for sparse in (False, True):
+        np.random.seed(1)
+        model = SparseGaussianGLM(N, basis=basis, sparse=sparse,
+                                  network_kwargs=dict(rho=0.2, rho_self=0.5))
+        model.add_data(Y)
+        model.resample_model()
+        means = model.means[0]
+        assert 0 < model.adjacency.sum() < N * N
+
+        default = FrozenPredictor.dense_fraction
+        for dense_fraction in (0.0, 1.0):
+            FrozenPredictor.dense_fraction = dense_fraction
+            try:
+                predictor = FrozenPredictor.from_model(model)
+            finally:
+                FrozenPredictor.dense_fraction = default
+            assert predictor._sparse == (dense_fraction == 1.0)
+            assert np.allclose(predictor.reset(), means[0])
+            for t in range(Y.shape[0]-1):
+                assert np.allclose(predictor.update(Y[t]), means[t+1])
+
+
+if __name__ == "__main__":
+    test_frozen_predictor()
+    test_sparse_frozen_predictor()
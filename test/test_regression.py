@@ -0,0 +1,176 @@
+import itertools
+import numpy as np
+
+import pyglm.regression
+from pyglm.regression import SparseGaussianRegression
+
+
+def test_resample_from_prior():
+    # With no data, resampling draws from the prior
+    N, B = 4, 3
+    reg = SparseGaussianRegression(N, B, S_w=0.05, eta=0.1)
+    reg.resample([])
+    assert reg.W.shape == (N, B)
+    assert np.all(reg.W[~reg.a] == 0)
+
+
+def test_dual_path_matches_primal():
+    # With fewer observations than weights, the collapsed sampler works in
+    # the dual space. The marginal likelihoods should agree with the primal.
+    np.random.seed(0)
+    N, B, T = 5, 3, 8
+    reg = SparseGaussianRegression(N, B, S_w=0.5, eta=0.1, rho=0.5*np.ones(N))
+    X, y = np.random.randn(T, N*B), np.random.randn(T)
+    potentials = list(reg._lkhd_potentials([(X, y)]))
+    J_prior, h_prior = reg._prior_sufficient_statistics()
+    J_lkhd, h_lkhd = reg._lkhd_sufficient_statistics([(X, y)], potentials=potentials)
+    obs = reg._dual_observations(potentials)
+
+    reg.a = np.array([True, False, True, True, False])
+    primal = reg._marginal_likelihood(J_prior, h_prior, J_prior + J_lkhd, h_prior + h_lkhd)
+    dual = reg._marginal_likelihood(J_prior, h_prior, J_prior + J_lkhd, h_prior + h_lkhd, obs=obs)
+    assert np.allclose(primal, dual)
+
+
+def test_uncollapsed_sampler():
+    # The uncollapsed sampler should visit the active sets with the
+    # posterior probabilities given by the collapsed marginal likelihoods
+    np.random.seed(1)
+    N, B, T = 2, 1, 20
+    reg = SparseGaussianRegression(N, B, S_w=1.0, eta=1.0, rho=0.5*np.ones(N), collapsed=False)
+    X = np.random.randn(T, N*B)
+    y = 0.3 * X[:, 0] + np.random.randn(T)
+    potentials = list(reg._lkhd_potentials([(X, y)]))
+    J_prior, h_prior = reg._prior_sufficient_statistics()
+    J_lkhd, h_lkhd = reg._lkhd_sufficient_statistics([(X, y)], potentials=potentials)
+
+    configs = list(itertools.product([False, True], repeat=N))
+    lps = []
+    for a in configs:
+        reg.a = np.array(a)
+        lps.append(reg._marginal_likelihood(J_prior, h_prior, J_prior + J_lkhd, h_prior + h_lkhd))
+    p = np.exp(np.array(lps) - np.max(lps))
+    p /= p.sum()
+
+    counts = np.zeros(len(configs))
+    for _ in range(3000):
+        reg._uncollapsed_resample(potentials)
+        counts[configs.index(tuple(reg.a))] += 1
+    assert np.allclose(counts / counts.sum(), p, atol=0.04)
+
+
+def test_cg_sampler():
+    # Perturb-and-solve draws should have the moments of the
+    # conditional posterior of the active weights and the bias
+    np.random.seed(0)
+    N, B, T = 2, 2, 50
+    reg = SparseGaussianRegression(N, B, S_w=1.0, eta=0.5, rho=0.5*np.ones(N), W_sampler="cg")
+    X = np.random.randn(T, N*B)
+    y = X.dot(np.random.randn(N*B)) + 0.5 + np.sqrt(0.5) * np.random.randn(T)
+    potentials = list(reg._lkhd_potentials([(X, y)]))
+    J_prior, h_prior = reg._prior_sufficient_statistics()
+    J_lkhd, h_lkhd = reg._lkhd_sufficient_statistics([(X, y)], potentials=potentials)
+    mu = np.linalg.solve(J_prior + J_lkhd, h_prior + h_lkhd)
+    sd = np.sqrt(np.diag(np.linalg.inv(J_prior + J_lkhd)))
+
+    reg.a = np.ones(N, dtype=bool)
+    samples = []
+    for _ in range(2000):
+        reg._cg_resample_W(potentials)
+        samples.append(np.concatenate((reg.W.ravel(), reg.b)))
+    samples = np.array(samples)
+    assert np.allclose(samples.mean(0), mu, atol=0.15 * sd.min())
+    assert np.allclose(samples.std(0) / sd, 1, atol=0.1)
+
+
+def test_factored_weight_prior():
+    # The factored prior should give the natural parameters of the
+    # dense NxNxBxB prior, with the self connection's row overridden
+    np.random.seed(0)
+    N, B, n = 4, 3, 2
+    mu, mu_self = np.random.randn(B), np.random.randn(B)
+    L, L_self = np.random.randn(B, B), np.random.randn(B, B)
+    sigma, sigma_self = L.dot(L.T) + np.eye(B), L_self.dot(L_self.T) + np.eye(B)
+
+    mu_W = np.tile(mu, (N, N, 1))
+    sigma_W = np.tile(sigma, (N, N, 1, 1))
+    mu_W[np.arange(N), np.arange(N)] = mu_self
+    sigma_W[np.arange(N), np.arange(N)] = sigma_self
+
+    dense = SparseGaussianRegression(N, B, mu_w=mu_W[n], S_w=sigma_W[n])
+    factored = SparseGaussianRegression(N, B)
+    factored.set_weight_prior(mu, sigma, self_index=n, mu_self=mu_self, S_self=sigma_self)
+    assert np.allclose(factored.mu_w, dense.mu_w)
+    assert np.allclose(factored.S_w, dense.S_w)
+    for p_dense, p_factored in zip(dense.natural_params, factored.natural_params):
+        assert np.allclose(p_dense, p_factored)
+
+    # Without the override every group shares the prior
+    factored.set_weight_prior(mu, sigma)
+    J_w, h_w, _, _ = factored.natural_params
+    assert np.allclose(J_w[n], np.linalg.inv(sigma))
+    assert np.allclose(h_w[n], np.linalg.solve(sigma, mu))
+
+
+def test_active_set_activation():
+    # Visiting only the active columns should give the dense product,
+    # also after 'a' changes in place between calls
+    np.random.seed(0)
+    N, B, T = 6, 2, 30
+    reg = SparseGaussianRegression(N, B)
+    reg.W = np.random.randn(N, B)
+    reg.b = 0.5
+    X = np.random.randn(T, N, B)
+
+    for fraction in (1.0, 0.0):
+        # 1.0 always takes the loop over active columns, 0.0 never does
+        reg.dense_activation_fraction = fraction
+        reg.a = np.zeros(N, dtype=bool)
+        for a in ([0], [0, 3], [3], [1, 2, 5], []):
+            reg.a[:] = False
+            reg.a[a] = True
+            W_eff = (reg.a[:, None] * reg.W).ravel()
+            assert np.allclose(reg.activation(X), X.reshape((T, -1)).dot(W_eff) + 0.5)
+            assert np.array_equal(reg._active_columns() // B, np.repeat(a, B))
+
+
+def test_blocked_gram_matrix():
+    # Accumulating the Gram matrix over blocks of rows and datasets
+    # should give X^T Omega X, with the affine term in the last row
+    np.random.seed(0)
+    N, B = 3, 2
+    reg = SparseGaussianRegression(N, B)
+    potentials = []
+    for T in (50, 12):
+        X = np.random.randn(T, N*B)
+        potentials.append((X, np.random.rand(T) + 0.5, np.random.randn(T)))
+
+    row_block = pyglm.regression.ROW_BLOCK
+    pyglm.regression.ROW_BLOCK = 7
+    try:
+        J, h = reg._lkhd_sufficient_statistics(None, potentials=potentials)
+        J = J.copy()
+        J_again, _ = reg._lkhd_sufficient_statistics(None, potentials=potentials)
+    finally:
+        pyglm.regression.ROW_BLOCK = row_block
+
+    J_naive, h_naive = 0, 0
+    for X, omega, kappa in potentials:
+        X1 = np.column_stack((X, np.ones(X.shape[0])))
+        J_naive = J_naive + X1.T.dot(omega[:, None] * X1)
+        h_naive = h_naive + X1.T.dot(kappa)
+    assert np.allclose(J, J_naive) and np.allclose(h, h_naive)
+
+    # The second call reuses the workspace buffer
+    assert np.allclose(J_again, J_naive)
+    assert np.shares_memory(J_again, reg.workspace.get("J_lkhd", J.shape))
+
+
+if __name__ == "__main__":
+    test_resample_from_prior()
+    test_dual_path_matches_primal()
+    test_uncollapsed_sampler()
+    test_cg_sampler()
+    test_factored_weight_prior()
+    test_active_set_activation()
+    test_blocked_gram_matrix()
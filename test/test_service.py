@@ -0,0 +1,96 @@
+import os
+import stat
+import time
+import asyncio
+import tempfile
+import threading
+import numpy as np
+
+from pyglm.service import FitService, fit
+
+
+def _request(path, **kwargs):
+    request = dict(id="job", op="fit", model="SparseGaussianGLM",
+                   basis=dict(B=2, L=10), data=[path],
+                   N_samples=4, burnin=2, every=2, seed=0)
+    request.update(kwargs)
+    return request
+
+
+def _data():
+    path = os.path.join(tempfile.mkdtemp(), "Y.npy")
+    np.random.seed(0)
+    np.save(path, np.random.randn(200, 3))
+    return path
+
+
+def test_submit():
+    path = _data()
+    service = FitService(processes=1)
+
+    async def run(*requests):
+        return [[event async for event in service.submit(request)]
+                for request in requests]
+
+    try:
+        events, failed, no_samples = asyncio.run(run(
+            _request(path), _request(path, model="NoSuchModel"),
+            _request(path, N_samples=3, burnin=3)))
+        assert [e["event"] for e in events] == ["progress", "progress", "done"]
+        summary = events[-1]["summary"]
+        assert summary["N"] == 3
+        # The likelihood is only evaluated for the progress events
+        assert summary["log_likelihood_iterations"] == [1, 3]
+        assert summary["log_likelihoods"] == [e["log_likelihood"] for e in events[:2]]
+        assert np.array(summary["mean_weights"]).shape == (3, 3, 2)
+
+        # A burn-in as long as the fit keeps no samples, and has no means
+        assert no_samples[-1]["event"] == "done"
+        assert no_samples[-1]["summary"]["mean_weights"] is None
+
+        # A failing fit ends with an error event
+        assert failed[-1]["event"] == "error"
+        assert "NoSuchModel" in failed[-1]["message"]
+    finally:
+        service.close()
+
+
+def test_socket():
+    path = _data()
+    socket_path = os.path.join(tempfile.mkdtemp(), "fits.sock")
+    service = FitService(socket_path, processes=1)
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        task = loop.create_task(service.serve())
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        deadline = time.time() + 30
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+        events = list(fit(socket_path, _request(path, stream="samples")))
+        assert [e["event"] for e in events] == ["sample"] * 4 + ["done"]
+        assert events[-1]["summary"]["log_likelihood_iterations"] == [0, 1, 2, 3]
+        assert all(e["id"] == "job" for e in events)
+
+        events = list(fit(socket_path, _request(path, data=[path + ".missing"])))
+        assert events[-1]["event"] == "error"
+    finally:
+        loop.call_soon_threadsafe(lambda: [t.cancel() for t in asyncio.all_tasks(loop)])
+        thread.join(30)
+        loop.close()
+    assert not os.path.exists(socket_path)
+
+
+if __name__ == "__main__":
+    test_submit()
+    test_socket()
@@ -0,0 +1,34 @@
+import numpy as np
+
+from pyglm.models import SparseGaussianGLM
+from pyglm.sharded import ShardedDataset
+from pyglm.utils.basis import cosine_basis, convolve_with_basis
+
+
+def test_sharded_statistics():
+    # The potentials summed over shards should equal those of the
+    # whole recording, since each shard sees its true spike history
+    np.random.seed(0)
+    N, B, L, T = 3, 2, 10, 400
+    basis = cosine_basis(B, L=L) / L
+    model = SparseGaussianGLM(N, basis=basis)
+    Y = np.random.randn(T, N)
+    X = convolve_with_basis(Y, basis)
+
+    with ShardedDataset(Y, basis, model.regressions, n_shards=3) as sharded:
+        for n, reg in enumerate(model.regressions):
+            J, h = sharded.sufficient_statistics(n, reg)
+            J_local, h_local = reg._lkhd_sufficient_statistics([(X, Y[:, n])])
+            assert np.allclose(J, J_local)
+            assert np.allclose(h, h_local)
+
+            T_sharded, ssq = sharded.residual_statistics(n, reg)
+            assert T_sharded == T
+            assert np.allclose(ssq, np.sum((Y[:, n] - reg.mean(X))**2))
+
+        assert np.allclose(sharded.log_likelihood(model.regressions),
+                           model.log_likelihood([(X, Y)]))
+
+
+if __name__ == "__main__":
+    test_sharded_statistics()
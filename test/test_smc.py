@@ -0,0 +1,70 @@
+import numpy as np
+
+from pyglm.regression import SparseGaussianRegression
+from pyglm.models import NonlinearAutoregressiveModel, SparseBernoulliGLM
+from pyglm.smc import SMCSampler
+from pyglm.utils.basis import cosine_basis, convolve_with_basis
+
+def test_smc_gram_statistics():
+    N = 3   # Number of neurons
+    B = 2   # Number of basis functions
+    L = 10  # Length of basis functions
+
+    np.random.seed(0)
+    basis = cosine_basis(B, L=L) / L
+    regressions = [SparseGaussianRegression(N, B, S_w=0.05, eta=0.1) for n in range(N)]
+    model = NonlinearAutoregressiveModel(N, regressions, basis=basis)
+    _, Y = model.generate(T=300, keep=False)
+
+    # Feed the data in chunks, resampling every time
+    smc = SMCSampler(model, N_particles=10, ess_threshold=1.0)
+    for start in range(0, 300, 50):
+        smc.update(Y[start:start+50])
+    assert smc.T == 300
+
+    # The moves see the statistics of the whole recording
+    X = np.reshape(convolve_with_basis(Y, basis), (300, N*B))
+    assert smc._stats["T"] == 300
+    assert np.allclose(smc._stats["XX"], X.T.dot(X))
+    assert np.allclose(smc._stats["X1"], X.sum(0))
+    assert np.allclose(smc._stats["XY"], X.T.dot(Y))
+    assert np.allclose(smc._stats["yty"], (Y**2).sum(0))
+    assert len(smc._window_data) == 0
+
+    A, W, b = smc.posterior_mean()
+    assert A.shape == (N, N) and W.shape == (N, N, B) and b.shape == (N,)
+    assert np.all(np.isfinite(W)) and np.isclose(smc.normalized_weights.sum(), 1)
+
+
+def test_smc_window():
+    # Without Gram statistics the moves see a window of recent bins,
+    # so the work per update does not grow with the number of chunks
+    N, B, L = 3, 2, 10
+    np.random.seed(0)
+    basis = cosine_basis(B, L=L) / L
+    model = SparseBernoulliGLM(N, basis=basis, regression_kwargs=dict(pg_method="normal"))
+    try:
+        SMCSampler(model, N_particles=2)
+        assert False, "a window should be required"
+    except ValueError:
+        pass
+
+    smc = SMCSampler(model, N_particles=2, window=100, ess_threshold=1.0)
+    moved = []
+    for reg in model.regressions:
+        def resample(datas, _resample=reg.resample):
+            moved[-1] = max(moved[-1], sum(X.shape[0] for X, _ in datas))
+            _resample(datas)
+        reg.resample = resample
+
+    for _ in range(20):
+        moved.append(0)
+        smc.update((np.random.rand(50, N) < 0.1).astype(float))
+    assert smc.T == 1000
+    assert sum(X.shape[0] for X, _ in smc._window_data) == 100
+    assert max(moved) == 100 and moved[-1] == moved[2]
+
+
+if __name__ == "__main__":
+    test_smc_gram_statistics()
+    test_smc_window()
@@ -0,0 +1,71 @@
+import numpy as np
+
+from pyglm.tempering import ParallelTempering
+from pyglm.utils.utils import effective_sample_size
+
+
+class FixedModel(object):
+    # A stand-in replica whose log likelihood never changes, so that the
+    # exchanges are the only moves of the sampler
+    lls = []
+
+    def __init__(self):
+        self.ll = FixedModel.lls.pop(0)
+        self.adjacency = self.ll
+
+    def add_data(self, data):
+        pass
+
+    def resample_model(self):
+        pass
+
+    def log_likelihood(self):
+        return self.ll
+
+
+def test_swap_acceptance():
+    # With two replicas whose log likelihoods differ by d, the exchanges
+    # form a two state chain that should spend a fraction 1 / (1 + p) of
+    # the time with the better replica at beta = 1, where
+    # p = exp(-(beta_0 - beta_1) * d) is the acceptance probability of
+    # moving it back up the ladder
+    np.random.seed(0)
+    betas, d = np.array([1.0, 0.5]), 2.0
+    FixedModel.lls = [0.0, d]
+    pt = ParallelTempering(FixedModel, (), [None], inv_temperatures=betas, processes=False)
+    samples = pt.run(20000)
+
+    p = np.exp(-(betas[0] - betas[1]) * d)
+    assert np.isclose(np.mean(samples == d), 1 / (1 + p), atol=0.02)
+    assert np.isclose(pt.acceptance_rates[0], 2 * p / (1 + p), atol=0.02)
+    assert pt.swaps_proposed[0] == 10000
+
+    # The workers' temperatures follow the exchanges
+    for k, i in enumerate(pt.replica):
+        assert pt.workers[i].obj.inv_temperature == betas[k]
+
+
+def test_effective_sample_size():
+    # An AR(1) chain with coefficient phi has an ESS of about
+    # S (1 - phi) / (1 + phi)
+    np.random.seed(0)
+    S, phi = 20000, 0.8
+    x = np.zeros((S, 3))
+    for s in range(1, S):
+        x[s] = phi * x[s-1] + np.random.randn(3)
+    x[:, 2] = 1.0
+
+    ess = effective_sample_size(x)
+    assert np.allclose(ess[:2], S * (1 - phi) / (1 + phi), rtol=0.2)
+    assert np.isnan(ess[2])
+    assert np.isclose(effective_sample_size(np.random.randn(S)), S, rtol=0.1)
+
+    # Traces collected in a list give the same estimates
+    assert np.allclose(effective_sample_size(list(x)), ess, equal_nan=True)
+    trace = list(np.random.randn(S))
+    assert effective_sample_size(trace) == effective_sample_size(np.array(trace))
+
+
+if __name__ == "__main__":
+    test_swap_acceptance()
+    test_effective_sample_size()
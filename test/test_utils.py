@@ -0,0 +1,43 @@
+import numpy as np
+
+from pyglm.utils.utils import pg_moments, sample_pg_normal
+
+
+def sample_pg_series(b, c, size, K=200):
+    # PG(b, c) is an infinite weighted sum of Gamma(b, 1) variables
+    k = np.arange(1, K+1)
+    g = np.random.gamma(b, 1.0, size=(size, K))
+    return np.sum(g / ((k - 0.5)**2 + c**2 / (4 * np.pi**2)), axis=1) / (2 * np.pi**2)
+
+
+def test_pg_moments():
+    # The closed form moments should match draws from the series
+    # definition, and be continuous where the Taylor expansion takes over
+    np.random.seed(0)
+    for b, c in [(1, 0.0), (1, 2.0), (10, -5.0), (50, 0.5)]:
+        mean, var = pg_moments(b, c)
+        omega = sample_pg_series(b, c, 100000)
+        assert np.isclose(omega.mean(), mean, rtol=0.01)
+        assert np.isclose(omega.var(), var, rtol=0.05)
+
+    eps = 1e-3
+    for b in [1, 10]:
+        mean, var = pg_moments(b, [eps * (1 - 1e-9), eps * (1 + 1e-9)])
+        assert np.isclose(mean[0], mean[1]) and np.isclose(var[0], var[1])
+
+
+def test_sample_pg_normal():
+    np.random.seed(0)
+    b = np.repeat([5.0, 50.0, 200.0], 100000)
+    c = np.repeat([0.0, 3.0, -10.0], 100000)
+    omega = sample_pg_normal(b, c).reshape((3, -1))
+    mean, var = pg_moments(b, c)
+    mean, var = mean.reshape((3, -1))[:, 0], var.reshape((3, -1))[:, 0]
+    assert np.all(omega > 0)
+    assert np.allclose(omega.mean(1), mean, rtol=0.01)
+    assert np.allclose(omega.var(1), var, rtol=0.02)
+
+
+if __name__ == "__main__":
+    test_pg_moments()
+    test_sample_pg_normal()